@@ -0,0 +1,347 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from LogPipeline import get_logger
+from MemoryBudget import READ_CACHE, WRITE_CACHE
+
+logger = get_logger('storage')
+
+# Dung lượng mặc định của cache đọc (byte)
+READ_CACHE_SIZE = 64 * 1024 * 1024
+# Cache ghi: flush khi có từng này byte bẩn hoặc dữ liệu cũ hơn WRITE_CACHE_MAX_AGE giây,
+# chặn luồng nhận dữ liệu khi vượt quá WRITE_CACHE_MAX_DIRTY
+WRITE_CACHE_FLUSH_SIZE = 16 * 1024 * 1024
+WRITE_CACHE_MAX_DIRTY = 64 * 1024 * 1024
+WRITE_CACHE_MAX_AGE = 2.0
+
+
+class ReadCache:
+    """
+    Cache LRU giới hạn theo số byte cho các piece đọc từ đĩa khi phục vụ REQUEST.
+    Khi phát hiện đọc tuần tự (piece i rồi i + 1), các piece kế tiếp được đọc trước trên một
+    thread nền để những request sau lấy thẳng từ bộ nhớ.
+    """
+
+    def __init__(self, loader, capacity=READ_CACHE_SIZE, read_ahead=4, memory_budget=None):
+        """
+        :param loader: function(piece_id) -> bytes reading a whole piece from storage
+        :param capacity: maximum number of cached bytes
+        :param read_ahead: number of pieces to prefetch on a sequential access pattern
+        :param memory_budget: MemoryBudget the cached bytes are accounted to; nothing new is cached
+                              while it is exhausted
+        """
+        self.loader = loader
+        self.capacity = capacity
+        self.read_ahead = read_ahead
+        self.memory_budget = memory_budget
+
+        self.entries = OrderedDict()  # piece_id -> bytes, theo thứ tự dùng gần nhất ở cuối
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+
+        self.last_miss = None
+        self.prefetching = set()
+        self.prefetch_executor = None
+
+        # Các piece vừa bị miss gần đây (chỉ lưu id), piece bị hỏi lại khi còn trong đây được coi là "nóng"
+        self.ghosts = OrderedDict()
+        self.ghost_capacity = 1024
+
+    def get(self, piece_id, admit_first_miss=True):
+        """
+        Mỗi lần gọi được đếm đúng một hit hoặc một miss.
+        :param admit_first_miss: False to leave a piece out of the cache on its first miss (only its id is
+                                 remembered) and return None, the caller then sends it straight from the file
+                                 (sendfile); a piece asked again soon after is "hot" and loaded into the cache
+        :return: piece data, or None when the piece is not admitted
+        """
+        with self.lock:
+            data = self.entries.get(piece_id)
+            if data is not None:
+                self.entries.move_to_end(piece_id)
+                self.hits += 1
+                return data
+            self.misses += 1
+            if not admit_first_miss and self.ghosts.pop(piece_id, None) is None:
+                self.ghosts[piece_id] = True
+                if len(self.ghosts) > self.ghost_capacity:
+                    self.ghosts.popitem(last=False)
+                return None
+            sequential = self.last_miss is not None and piece_id == self.last_miss + 1
+            self.last_miss = piece_id
+
+        data = self.loader(piece_id)
+        self.put(piece_id, data)
+
+        if sequential and self.read_ahead > 0:
+            self.prefetch(range(piece_id + 1, piece_id + 1 + self.read_ahead))
+        return data
+
+    def peek(self, piece_id):
+        """
+        :return: cached data without loading it on a miss, or None
+        """
+        with self.lock:
+            data = self.entries.get(piece_id)
+            if data is not None:
+                self.entries.move_to_end(piece_id)
+                self.hits += 1
+            return data
+
+    def put(self, piece_id, data):
+        if data is None or len(data) > self.capacity:
+            return
+        if self.memory_budget is not None and self.memory_budget.is_exhausted(len(data)):
+            return
+        with self.lock:
+            size = self.size
+            previous = self.entries.pop(piece_id, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[piece_id] = data
+            self.size += len(data)
+
+            # Bỏ các piece lâu không dùng nhất cho tới khi nằm trong giới hạn
+            while self.size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+            self._account(self.size - size)
+
+    def _account(self, delta):
+        if self.memory_budget is None or delta == 0:
+            return
+        if delta > 0:
+            self.memory_budget.reserve(READ_CACHE, delta)
+        else:
+            self.memory_budget.release(READ_CACHE, -delta)
+
+    def prefetch(self, piece_ids):
+        with self.lock:
+            piece_ids = [piece_id for piece_id in piece_ids
+                         if piece_id not in self.entries and piece_id not in self.prefetching]
+            if not piece_ids:
+                return
+            self.prefetching.update(piece_ids)
+            if self.prefetch_executor is None:
+                self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_executor.submit(self._prefetch, piece_ids)
+
+    def _prefetch(self, piece_ids):
+        for piece_id in piece_ids:
+            try:
+                data = self.loader(piece_id)
+                if data:
+                    self.put(piece_id, data)
+                    with self.lock:
+                        self.prefetched += 1
+            except Exception as e:
+                logger.warning("Read-ahead of piece %d failed: %s", piece_id, e)
+            finally:
+                with self.lock:
+                    self.prefetching.discard(piece_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self._account(-self.size)
+            self.size = 0
+
+    def close(self):
+        self.clear()
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown(wait=False)
+            self.prefetch_executor = None
+
+    def get_statistics(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'prefetched': self.prefetched,
+                'size': self.size,
+                'capacity': self.capacity,
+            }
+
+
+class WriteCache:
+    """
+    Cache ghi (write-back) đặt trước PieceStorage.
+    Các block nhận được được giữ trong bộ nhớ rồi ghi xuống đĩa theo lô: sắp xếp theo offset,
+    gộp các block liền kề thành một lần ghi lớn, sau đó fsync một lần cho cả lô.
+    Lô được flush khi đủ kích thước hoặc quá thời gian, hoặc khi gọi flush() (dừng, tải xong).
+    Khi số byte bẩn vượt giới hạn, add() chặn luồng mạng gọi nó cho tới khi đĩa ghi kịp.
+    """
+
+    def __init__(self, storage, flush_size=WRITE_CACHE_FLUSH_SIZE, max_dirty=WRITE_CACHE_MAX_DIRTY,
+                 max_age=WRITE_CACHE_MAX_AGE, on_flush=None, memory_budget=None):
+        """
+        :param storage: PieceStorage the data is written to
+        :param on_flush: function() called after a batch is durable on disk
+        :param memory_budget: MemoryBudget the dirty bytes are accounted to
+        """
+        self.storage = storage
+        self.memory_budget = memory_budget
+        self.flush_size = flush_size
+        self.max_dirty = max(max_dirty, flush_size)
+        self.max_age = max_age
+        self.on_flush = on_flush
+
+        self.pending = {}  # offset -> data, chưa ghi
+        self.in_flight = {}  # offset -> data, đang được ghi xuống đĩa
+        self.dirty_bytes = 0
+        self.oldest = None
+
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.running = True
+        self.flusher = None
+
+        self.writes = 0
+        self.flushes = 0
+        self.blocks = 0
+        self.backpressure_waits = 0
+
+    def add(self, offset, data):
+        with self.condition:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self.flusher.start()
+
+            # Backpressure: đợi đĩa ghi kịp trước khi nhận thêm dữ liệu
+            if self.dirty_bytes >= self.max_dirty:
+                self.backpressure_waits += 1
+                self.condition.notify_all()
+                while self.dirty_bytes >= self.max_dirty and self.running:
+                    self.condition.wait()
+
+            previous = self.pending.get(offset)
+            if previous is not None:
+                self._account(-len(previous))
+            self.pending[offset] = data
+            self._account(len(data))
+            self.blocks += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            if self.dirty_bytes >= self.flush_size:
+                self.condition.notify_all()
+
+    def get(self, offset, length):
+        """
+        :return: data of a block that is not yet on disk, or None
+        """
+        with self.condition:
+            data = self.pending.get(offset)
+            if data is None:
+                data = self.in_flight.get(offset)
+        if data is not None and len(data) == length:
+            return data
+        return None
+
+    def get_dirty_offsets(self):
+        with self.condition:
+            return list(self.pending) + list(self.in_flight)
+
+    def flush(self):
+        """Ghi toàn bộ dữ liệu đang chờ xuống đĩa và fsync."""
+        with self.flush_lock:
+            with self.condition:
+                if not self.pending:
+                    return
+                self.in_flight = self.pending
+                self.pending = {}
+                self.oldest = None
+                entries = sorted(self.in_flight.items())
+
+            try:
+                for offset, data in self._coalesce(entries):
+                    self.storage.write(offset, data)
+                    self.writes += 1
+                self.storage.flush()
+                self.flushes += 1
+            except OSError:
+                # Giữ lại dữ liệu chưa ghi được để lần flush sau thử lại
+                with self.condition:
+                    for offset, data in entries:
+                        if offset in self.pending:
+                            self._account(-len(data))
+                        else:
+                            self.pending[offset] = data
+                    self.in_flight = {}
+                    if self.oldest is None:
+                        self.oldest = time.monotonic()
+                raise
+
+            with self.condition:
+                self._account(-sum(len(data) for _, data in entries))
+                self.in_flight = {}
+                self.condition.notify_all()
+
+        if self.on_flush:
+            self.on_flush()
+
+    def _account(self, delta):
+        """Cập nhật số byte bẩn (gọi khi đang giữ self.condition) và báo cho bộ đếm bộ nhớ."""
+        self.dirty_bytes += delta
+        if self.memory_budget is None or delta == 0:
+            return
+        if delta > 0:
+            self.memory_budget.reserve(WRITE_CACHE, delta)
+        else:
+            self.memory_budget.release(WRITE_CACHE, -delta)
+
+    @staticmethod
+    def _coalesce(entries):
+        """Gộp các block liền kề (đã sắp theo offset) thành từng đoạn ghi liên tục."""
+        run_offset = None
+        run = []
+        run_end = None
+        for offset, data in entries:
+            if run and offset == run_end:
+                run.append(data)
+                run_end += len(data)
+                continue
+            if run:
+                yield run_offset, run[0] if len(run) == 1 else b''.join(run)
+            run_offset, run, run_end = offset, [data], offset + len(data)
+        if run:
+            yield run_offset, run[0] if len(run) == 1 else b''.join(run)
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                while self.running and self.dirty_bytes < self.flush_size and not (
+                        self.oldest is not None and time.monotonic() - self.oldest >= self.max_age) and not (
+                        self.dirty_bytes and self.memory_budget is not None and self.memory_budget.is_exhausted()):
+                    self.condition.wait(timeout=self.max_age / 4)
+                if not self.running:
+                    return
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Write cache flush failed: %s", e)
+                time.sleep(self.max_age)
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def get_statistics(self):
+        with self.condition:
+            return {
+                'dirty_bytes': self.dirty_bytes,
+                'blocks': self.blocks,
+                'writes': self.writes,
+                'flushes': self.flushes,
+                'backpressure_waits': self.backpressure_waits,
+            }
@@ -1,9 +1,26 @@
-import hashlib
 import math
 import os
-from pathlib import Path
+import re
+import threading
+import time
 from typing import List, Dict, Any
 
+from BlockCache import ReadCache, WriteCache
+from FileManifest import FileManifest
+from HashCache import HashCache
+from LogPipeline import get_logger
+from MemoryBudget import PIECE_BUFFERS, get_memory_budget
+from PieceFileMap import PieceFileMap
+from PieceHasher import PieceHasher, PieceStream
+from PieceStorage import PieceStorage, SENDFILE_SUPPORTED
+
+logger = get_logger('storage')
+
+
+class RecheckCancelled(Exception):
+    """Recheck bị dừng giữa chừng vì torrent bị đóng."""
+
+
 class Piece:
     def __init__(self, piece_id: int, data: bytes, hash_value):
         self.piece_id = piece_id
@@ -17,23 +34,84 @@ class Piece:
     def get_data(self):
         return self.data
 
+
+class PartialPiece:
+    """
+    Piece đang được tải theo từng block: bộ đệm cấp phát sẵn đúng kích thước piece,
+    block nào đã được request (bởi peer nào, lúc nào) và block nào đã nhận.
+    """
+
+    def __init__(self, piece_id, length, block_size):
+        self.piece_id = piece_id
+        self.buffer = bytearray(length)
+        self.block_size = block_size
+        self.block_count = math.ceil(length / block_size)
+        self.requested = {}  # block index -> (peer_id, thời điểm request)
+        self.received = bytearray(self.block_count)
+        self.received_count = 0
+        # Các peer đã gửi block của piece này, để quy trách nhiệm khi piece sai hash
+        self.sources = set()
+
+    def get_block_length(self, block_index):
+        return min(self.block_size, len(self.buffer) - block_index * self.block_size)
+
+    def next_block(self, now, timeout):
+        """
+        :return: index of a block that is neither received nor requested (or whose request timed out), or None
+        """
+        for block_index in range(self.block_count):
+            if self.received[block_index]:
+                continue
+            request = self.requested.get(block_index)
+            if request is None or now - request[1] >= timeout:
+                return block_index
+        return None
+
+    def is_complete(self):
+        return self.received_count == self.block_count
+
+# Giới hạn kích thước piece khi tự chọn theo tổng dung lượng
+MIN_PIECE_LENGTH = 16384
+MAX_PIECE_LENGTH = 16777216
+TARGET_PIECES = 2048
+
+# Trường 'pieces' dạng hex (40 ký tự mỗi piece) của các torrent tạo bởi phiên bản cũ
+LEGACY_HEX_PIECES = re.compile(rb'[0-9a-fA-F]*')
+
+# Mức ưu tiên của từng file khi tải torrent nhiều file, PRIORITY_SKIP: không tải file đó
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 4
+PRIORITY_HIGH = 7
+
+# Kích thước block trong mỗi REQUEST (chuẩn 16 KiB); block đã request mà quá REQUEST_TIMEOUT giây
+# chưa nhận được thì có thể request lại từ peer khác
+BLOCK_SIZE = 16384
+REQUEST_TIMEOUT = 30.0
+
+# Chế độ tải tuần tự (streaming): số byte phía trước vị trí đang đọc được tải theo thứ tự
+STREAM_WINDOW_SIZE = 8 * 1024 * 1024
+MIN_STREAM_WINDOW = 4
+
+
 class FileManager:
-    def __init__(self, save_path= None, info= None):
+    def __init__(self, save_path= None, info= None, piece_length= None, memory_budget=None):
         if info:
-            print(info)
             self.piece_length = info[b'pieceLength']
             self.total_length = info[b'length']
-            self.piece_file_map = self.build_piece_file_map_from_torrent(info)
-            pieces = info[b'pieces']
-            self.total_pieces = len(pieces) // 40
+            self.piece_hashes = self.parse_piece_hashes(info[b'pieces'], self.total_length, self.piece_length)
+            self.total_pieces = len(self.piece_hashes)
             self.name = info[b'name'].decode('utf-8')
+            self.files = self.get_files_from_torrent(info)
 
         else:
-            self.piece_length = 524288
+            # None: tự chọn kích thước piece theo tổng dung lượng khi share
+            self.piece_length = piece_length
             self.total_length = 0
-            self.piece_file_map = {}
             self.total_pieces = 0
+            self.piece_hashes = []
             self.name = ''
+            self.files = []
 
         if save_path:
             if "." in os.path.basename(self.name):
@@ -45,14 +123,88 @@ class FileManager:
                 self.save_path = 'download'
             else:
                 self.save_path = f'download/{self.name}'
-        self.pieces = []
+
+        # Chỉ giữ hash (bảng piece_hashes đánh chỉ số theo piece id) và bitfield các piece đã có trong RAM,
+        # dữ liệu nằm trên đĩa
+        self.have = bytearray((self.total_pieces + 7) // 8)
+        self.have_count = 0
+        # Mức ưu tiên của từng file và của từng piece (lấy mức cao nhất trong các file mà piece chạm tới),
+        # None: tải toàn bộ torrent với mức PRIORITY_NORMAL
+        self.file_priorities = None
+        self.piece_priorities = None
+        # Bitfield các piece cần tải và số piece cần tải mà chưa có
+        self.wanted = None
+        self.wanted_remaining = self.total_pieces
+        # function() gọi khi có thêm piece cần tải sau khi đổi mức ưu tiên (Peer đặt, để quan tâm lại các peer)
+        self.on_wanted_added = None
+        self.storage = None
+        # Danh sách file của đường dẫn đang share (FileManifest), None khi tải
+        self.manifest = None
+        # Ánh xạ piece -> file, chỉ dựng khi cần tới (xem get_piece_file_map)
+        self.piece_file_map = None
+        self.lock = threading.Lock()
+        # Báo cho các reader đang chờ mỗi khi có thêm piece
+        self.piece_condition = threading.Condition(self.lock)
+        self.closed = False
+
+        # Chế độ streaming: các piece trong cửa sổ [stream_position, stream_position + stream_window)
+        # được tải theo thứ tự trước, ngoài cửa sổ vẫn chọn piece hiếm nhất
+        self.sequential = False
+        self.stream_position = 0
+        self.stream_window = 0
+
+        # Các piece đang được ghép từ block (piece_id -> PartialPiece)
+        self.partial_pieces = {}
+        self.partial_lock = threading.Lock()
+        # Bộ đếm bộ nhớ dùng chung của process: bộ đệm piece và các cache được tính vào đây
+        self.memory_budget = memory_budget or get_memory_budget()
+
+        # Tiến độ kiểm tra lại dữ liệu trên đĩa (recheck), None nếu chưa từng chạy
+        self.recheck_progress = None
+        # Bị xoá khi đang recheck: close() chờ recheck dừng (sau khối đang băm) rồi mới đóng file
+        self.recheck_done = threading.Event()
+        self.recheck_done.set()
+        # Các piece được ghi trong lúc recheck (đã kiểm tra hash khi nhận), None khi không recheck
+        self.recheck_added = None
+
+        # Cache ghi của torrent đang tải, dữ liệu được ghi xuống đĩa theo lô
+        self.write_cache = None
+
+        # ResumeData của torrent, được lưu lại sau mỗi lần flush
+        self.resume_data = None
+        # Cache hash của các đường dẫn đã share, None để tắt
+        self.hash_cache = HashCache()
+        # Cache LRU các piece được đọc từ đĩa khi upload
+        self.read_cache = ReadCache(self.load_cached_piece, memory_budget=self.memory_budget)
 
     def __len__(self):
-        return len(self.pieces)
+        return self.have_count
 
     def get_piece_length(self):
         return self.piece_length
 
+    @staticmethod
+    def choose_piece_length(total_length, target_pieces=TARGET_PIECES):
+        """
+        Chọn kích thước piece (luỹ thừa của 2) nhỏ nhất sao cho số piece không vượt quá target_pieces,
+        trong khoảng [MIN_PIECE_LENGTH, MAX_PIECE_LENGTH].
+        """
+        piece_length = MIN_PIECE_LENGTH
+        while piece_length < MAX_PIECE_LENGTH and piece_length * target_pieces < total_length:
+            piece_length *= 2
+        return piece_length
+
+    def get_piece_file_map(self):
+        """
+        :return: PieceFileMap of the torrent, shared with the storage once it is open
+        """
+        if self.storage is not None:
+            return self.storage.file_map
+        if self.piece_file_map is None:
+            self.piece_file_map = PieceFileMap([length for _, length in self.files], self.piece_length,
+                                               [path for path, _ in self.files])
+        return self.piece_file_map
+
     def get_exact_piece_length(self, index):
         total_pieces = self.get_total_pieces()
         if index < total_pieces - 1:
@@ -60,239 +212,719 @@ class FileManager:
         else:
             return self.total_length - (total_pieces - 1) * self.piece_length
 
-    def split_file(self, file_path):
-        self.total_length = os.path.getsize(file_path)
-
+    def split_file(self, file_path, resume_record=None):
         try:
-            with open(file_path, 'rb') as f:
-                piece_id = 0
-                while data := f.read(self.piece_length):
-                    hash_value = hashlib.sha1(data).digest()
-                    piece = Piece(piece_id=piece_id, data=data, hash_value=hash_value)
-                    self.pieces.append(piece)
-                    piece_id += 1
-            self.total_pieces = len(self.pieces)
+            self.split_manifest(FileManifest.from_file(file_path), resume_record)
         except OSError:
             raise FileNotFoundError(f"Unable to open file: {file_path}")
 
-    def split_dir(self, dir_path):
-
-        self.total_length = os.path.getsize(dir_path)
-
-
-        piece_id = 0
-        buffer = b''
+    def split_dir(self, dir_path, resume_record=None):
 
         try:
-            # Duyệt qua tất cả các file trong thư mục theo thứ tự
-            for file_path in sorted(Path(dir_path).rglob('*')):
-                if file_path.is_file():
-                    with open(file_path, 'rb') as f:
-                        while data := f.read(self.piece_length - len(buffer)):
-                            buffer += data
-                            # Nếu buffer đạt kích thước piece_length, tạo mảnh mới
-                            if len(buffer) == self.piece_length:
-                                hash_value = hashlib.sha1(buffer).digest()  # SHA-1 với độ dài 20 bytes
-                                piece = Piece(piece_id=piece_id, data=buffer, hash_value=hash_value)
-                                self.pieces.append(piece)
-                                piece_id += 1
-                                buffer = b''  # Reset buffer
-
-            # Xử lý phần dữ liệu còn lại nếu có
-            if buffer:
-                hash_value = hashlib.sha1(buffer).digest()  # Dùng SHA-1 cho mảnh cuối
-                piece = Piece(piece_id=piece_id, data=buffer, hash_value=hash_value)
-                self.pieces.append(piece)
-
-            self.total_pieces = len(self.pieces)
+            # Một lượt duyệt duy nhất, danh sách file đã sắp xếp dùng chung cho việc băm và metadata
+            self.split_manifest(FileManifest.scan(dir_path), resume_record)
         except OSError:
             raise FileNotFoundError(f"Unable to open directory: {dir_path}")
 
-    def get_piece(self, index) -> Piece:
-        for piece in self.pieces:
-            if piece.piece_id == index:
-                return piece
-
-    def has_piece(self, piece_id):
-        for piece in self.pieces:
-            if piece.piece_id == piece_id:
-                return True
+    def split_manifest(self, manifest, resume_record=None):
+        self.manifest = manifest
+        if self.piece_length is None:
+            self.piece_length = self.choose_piece_length(manifest.total_length)
 
-        return False
+        record = resume_record
+        if record is None and self.hash_cache is not None:
+            record = self.hash_cache.lookup(manifest.root, self.piece_length)
 
-    def get_pieces_code(self):
-        result = ""
-        for piece in self.pieces:
-            result += f"{piece.hash_value.hex()}"
+        if record is None:
+            # Không có hash cũ: đọc, băm và tính kích thước các file trong cùng một lượt
+            self.load_stream(manifest.get_paths(), manifest.root)
+        else:
+            self.load_files([(entry.path, entry.length) for entry in manifest], record, manifest.root)
+
+        # Đường dẫn tương đối (theo torrent) và độ dài thực tế đã băm của từng file
+        self.files = [(entry.relative_path, length) for entry, length in zip(manifest, self.storage.lengths)]
+
+    def load_stream(self, paths, root_path=None):
+        stream = PieceStream(paths, self.piece_length)
+        self.piece_hashes = [hash_value for _, _, hash_value in stream]
+
+        # Tổng độ dài là tổng kích thước các file, không phải kích thước của entry thư mục
+        self.total_length = stream.total_length
+        self.total_pieces = len(self.piece_hashes)
+        self.storage = PieceStorage(stream.files, piece_length=self.piece_length)
+        self.set_all_pieces()
+
+        if self.hash_cache is not None and root_path is not None:
+            self.hash_cache.store(root_path, self.piece_length, self.get_resume_record())
+
+    def load_files(self, files, record=None, root_path=None):
+        """
+        Mở các file cần share và tính hash cho các piece.
+        Hash được lấy lại từ bản ghi resume hoặc hash cache cho những piece mà mọi file chứa nó
+        đều không đổi, chỉ các piece bị ảnh hưởng mới phải băm lại.
+        """
+        self.total_length = sum(length for _, length in files)
+        self.total_pieces = math.ceil(self.total_length / self.piece_length)
+        self.storage = PieceStorage(files, piece_length=self.piece_length)
+
+        hashes = self.get_reusable_hashes(record)
+        missing = [piece_id for piece_id, hash_value in enumerate(hashes) if hash_value is None]
+        hasher = PieceHasher(self.piece_length)
+        if len(missing) == self.total_pieces:
+            # Các piece có thể nằm vắt qua nhiều file, storage đọc liền mạch qua ranh giới file
+            hashes = hasher.hash_storage(self.storage)
+        elif missing:
+            for piece_id, hash_value in zip(missing, hasher.hash_pieces(self.storage, missing)):
+                hashes[piece_id] = hash_value
+        if record is not None:
+            logger.info("Reused %d/%d piece hashes", self.total_pieces - len(missing), self.total_pieces)
+
+        self.piece_hashes = hashes
+        self.total_pieces = len(self.piece_hashes)
+        self.set_all_pieces()
+
+        if self.hash_cache is not None and root_path is not None and missing:
+            self.hash_cache.store(root_path, self.piece_length, self.get_resume_record())
+
+    def get_reusable_hashes(self, record):
+        """
+        Lấy lại hash từ một bản ghi cũ (resume hoặc hash cache) cho các piece mà mọi file chứa nó
+        đều không đổi (cùng kích thước, mtime, inode) và vẫn nằm ở cùng offset như lúc băm.
+        :return: list of hashes, with None for every piece that has to be hashed again
+        """
+        hashes = [None] * self.total_pieces
+        if record is None or record[b'pieceLength'] != self.piece_length:
+            return hashes
+
+        # Vị trí của từng file trong bố cục cũ
+        previous_files = {}
+        offset = 0
+        for file in record[b'files']:
+            previous_files[file[b'path'].decode()] = (offset, file)
+            offset += file[b'length']
+        previous_length = offset
+
+        changed_files = []
+        for file_index, (path, length) in enumerate(zip(self.storage.paths, self.storage.lengths)):
+            previous = previous_files.get(path)
+            if previous is None or previous[0] != self.storage.offsets[file_index]:
+                changed_files.append(file_index)
+                continue
+            if not self.is_file_unchanged(path, length, previous[1], self.get_file_stat(path)):
+                changed_files.append(file_index)
+
+        dirty = self.get_pieces_of_files(changed_files)
+        if previous_length != self.total_length and self.total_pieces > 0:
+            # Piece cuối có độ dài khác so với lần băm trước
+            dirty.add(self.total_pieces - 1)
+
+        pieces = record[b'pieces']
+        for piece_id in range(min(self.total_pieces, len(pieces) // 20)):
+            if piece_id not in dirty:
+                hashes[piece_id] = pieces[piece_id * 20:(piece_id + 1) * 20]
+        return hashes
+
+    @staticmethod
+    def is_file_unchanged(path, length, file_record, stat=None):
+        """
+        :param stat: (size, mtime, inode) already known from the manifest, None to stat the file
+        """
+        if stat is None:
+            try:
+                result = os.stat(path)
+            except OSError:
+                return False
+            stat = (result.st_size, result.st_mtime_ns, result.st_ino)
+        size, mtime, inode = stat
+        if size != length or file_record[b'length'] != length or mtime != file_record[b'mtime']:
+            return False
+        # Bản ghi resume cũ không có inode
+        return file_record.get(b'inode', inode) == inode
+
+    def get_file_stat(self, path):
+        """
+        :return: (size, mtime, inode) of a shared file as seen by the directory scan, or None
+        """
+        if self.manifest is None:
+            return None
+        entry = self.manifest.get_entry(path)
+        if entry is None:
+            return None
+        return entry.length, entry.mtime, entry.inode
+
+    def get_block_source(self, index, begin, length):
+        """
+        Nguồn dữ liệu để gửi một block: bộ nhớ nếu piece đang nằm trong cache,
+        ngược lại là các đoạn file để gửi thẳng bằng sendfile (không sao chép qua Python).
+        :return: {'block': memoryview} or {'segments': [(fd, offset, length), ...]}, or None
+        """
+        if not self.has_piece(index) or begin < 0 or length <= 0 \
+                or begin + length > self.get_exact_piece_length(index):
+            return None
+
+        data = self.read_cache.peek(index)
+        if data is None and self.write_cache is not None:
+            data = self.write_cache.get(index * self.piece_length, self.get_exact_piece_length(index))
+        if data is None:
+            # Có sendfile: piece chỉ được nạp vào cache khi bị hỏi lại (nóng), lần đầu gửi thẳng từ file
+            data = self.read_cache.get(index, admit_first_miss=not SENDFILE_SUPPORTED)
+        if data is not None:
+            return {'block': memoryview(data)[begin:begin + length]}
+
+        return {'segments': self.storage.get_block_file_segments(index, begin, length)}
+
+    def load_cached_piece(self, index):
+        # Read-ahead có thể hỏi tới piece chưa có hoặc vượt quá piece cuối
+        if index >= self.total_pieces or not self.has_piece(index):
+            return None
+        return self.read_piece(index)
+
+    def get_cache_statistics(self):
+        return self.read_cache.get_statistics()
+
+    def read_piece(self, index):
+        offset = index * self.piece_length
+        length = self.get_exact_piece_length(index)
+        # Piece có thể vẫn còn trong cache ghi, chưa xuống đĩa
+        if self.write_cache is not None:
+            data = self.write_cache.get(offset, length)
+            if data is not None:
+                return data
+        return self.storage.read(offset, length)
 
-        return result
+    def has_piece(self, piece_id):
+        return bool(self.have[piece_id >> 3] & (0x80 >> (piece_id & 7)))
 
-    def get_bitfield(self):
+    def set_all_pieces(self):
+        """Đánh dấu đã có toàn bộ piece (khi share)."""
+        self.have = bytearray(b'\xff' * ((self.total_pieces + 7) // 8))
+        remaining_bits = self.total_pieces % 8
+        if remaining_bits != 0:
+            self.have[-1] = (0xFF << (8 - remaining_bits)) & 0xFF
+        self.have_count = self.total_pieces
+        self.wanted_remaining = 0
+
+    def set_file_priorities(self, priorities):
+        """
+        Đặt mức ưu tiên cho các file của torrent. Piece nằm vắt qua ranh giới hai file mang mức
+        ưu tiên cao hơn trong hai file, nên piece biên của một file cần tải vẫn được tải dù file
+        bên cạnh bị bỏ qua.
+        :param priorities: list with one priority per file, or dict {file index or path: priority};
+                           files missing from the dict keep PRIORITY_NORMAL
+        """
+        if isinstance(priorities, dict):
+            file_priorities = [PRIORITY_NORMAL] * len(self.files)
+            indexes = {path: file_index for file_index, (path, _) in enumerate(self.files)}
+            for key, priority in priorities.items():
+                file_index = indexes[key] if isinstance(key, str) else key
+                file_priorities[file_index] = priority
+        else:
+            file_priorities = list(priorities)
+        if len(file_priorities) != len(self.files):
+            raise ValueError(f"Expected {len(self.files)} file priorities, got {len(file_priorities)}")
+
+        file_map = self.get_piece_file_map()
+        piece_priorities = bytearray(self.total_pieces)
+        for file_index, priority in enumerate(file_priorities):
+            if priority <= PRIORITY_SKIP:
+                continue
+            for piece_id in file_map.get_pieces_of_file(file_index):
+                if piece_priorities[piece_id] < priority:
+                    piece_priorities[piece_id] = priority
+
+        wanted = bytearray(len(self.have))
+        for piece_id, priority in enumerate(piece_priorities):
+            if priority:
+                wanted[piece_id >> 3] |= 0x80 >> (piece_id & 7)
+
+        with self.lock:
+            previous_remaining = self.wanted_remaining
+            self.file_priorities = file_priorities
+            self.piece_priorities = piece_priorities
+            self.wanted = wanted
+            self.wanted_remaining = self.count_wanted_remaining()
+            wanted_added = self.wanted_remaining > previous_remaining
+        if wanted_added and self.on_wanted_added is not None:
+            self.on_wanted_added()
+
+    def get_file_priorities(self):
+        if self.file_priorities is None:
+            return [PRIORITY_NORMAL] * len(self.files)
+        return list(self.file_priorities)
+
+    def get_piece_priority(self, piece_id):
+        if self.piece_priorities is None:
+            return PRIORITY_NORMAL
+        return self.piece_priorities[piece_id]
+
+    def is_wanted(self, piece_id):
+        if self.wanted is None:
+            return True
+        return bool(self.wanted[piece_id >> 3] & (0x80 >> (piece_id & 7)))
 
-        # Calculate the number of bytes required for the bitfield
-        num_bytes = (self.total_pieces + 7) // 8
-        bitfield = [0] * num_bytes  # Initialize as list of zeroed bytes
+    def count_wanted_remaining(self):
+        """Số piece cần tải mà chưa có."""
+        missing = ~int.from_bytes(self.have, 'big')
+        if self.wanted is not None:
+            missing &= int.from_bytes(self.wanted, 'big')
+        else:
+            missing &= (1 << (8 * len(self.have))) - 1
+            # Bỏ các bit thừa ở byte cuối
+            missing >>= 8 * len(self.have) - self.total_pieces
+        return bin(missing).count('1')
 
-        # Set each downloaded piece in the bitfield
-        for piece in self.pieces:
-            byte_index = piece.piece_id // 8
-            bit_index = piece.piece_id % 8
-            bitfield[byte_index] |= (1 << (7 - bit_index))
+    def get_wanted_count(self):
+        if self.wanted is None:
+            return self.total_pieces
+        return sum(bin(byte).count('1') for byte in self.wanted)
 
-        # Ensure spare bits in the last byte are cleared if not a full byte
-        remaining_bits = self.total_pieces % 8
-        if remaining_bits != 0:
-            bitfield[-1] &= (0xFF << (8 - remaining_bits))
+    def get_pieces_code(self):
+        """
+        :return: value of the 'pieces' field of the torrent: the 20-byte SHA-1 digests concatenated
+        """
+        return b''.join(self.piece_hashes)
+
+    @staticmethod
+    def parse_piece_hashes(pieces, total_length, piece_length):
+        """
+        Tách trường 'pieces' thành danh sách digest 20 byte.
+        Torrent cũ do chương trình tạo lưu mỗi hash dưới dạng 40 ký tự hex, vẫn được đọc được:
+        nhận ra nhờ độ dài gấp đôi số piece thực tế và chỉ chứa ký tự hex.
+        """
+        total_pieces = math.ceil(total_length / piece_length)
+        if len(pieces) != 20 * total_pieces and len(pieces) == 40 * total_pieces \
+                and LEGACY_HEX_PIECES.fullmatch(pieces):
+            pieces = bytes.fromhex(pieces.decode('ascii'))
+        return [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
 
-        # Convert list to bytes
-        return bytes(bitfield)
+    def get_bitfield(self):
+        # Bitfield được duy trì sẵn, các bit thừa ở byte cuối luôn bằng 0
+        return bytes(self.have)
 
     def get_total_pieces(self):
         return self.total_pieces
 
     def is_interested(self, bitfield):
-        num_pieces = math.ceil(self.total_length / self.piece_length)
-        current_piece_ids = {piece.piece_id for piece in self.pieces}
-
-        for piece_id in range(num_pieces):
-            byte_index = piece_id // 8
-            bit_index = piece_id % 8
-            # Check if the piece is available in the bitfield
-            if bitfield[byte_index] & (1 << (7 - bit_index)):
-                # Check if we don't have this piece
-                if piece_id not in current_piece_ids:
-                    return True
-
-        return False
+        # Quan tâm nếu peer có ít nhất một piece mà mình chưa có
+        num_bytes = len(self.have)
+        theirs = int.from_bytes(bytes(bitfield[:num_bytes]).ljust(num_bytes, b'\x00'), 'big')
+        ours = int.from_bytes(self.have, 'big')
+        missing = theirs & ~ours
+        if self.wanted is not None:
+            missing &= int.from_bytes(self.wanted, 'big')
+        return bool(missing)
+
+    def prepare_download(self):
+        """
+        Tạo sẵn các file đích với đúng kích thước để mỗi piece được ghi thẳng vào vị trí cuối cùng.
+        """
+        with self.lock:
+            if self.storage is not None:
+                return
+            if not os.path.exists(self.save_path):
+                os.makedirs(self.save_path)
+            files = [(os.path.join(self.save_path, path), length) for path, length in self.files]
+            self.storage = PieceStorage(files, writable=True, piece_length=self.piece_length)
+            # Chỉ tạo sẵn các file cần tải, file bị bỏ qua chỉ được tạo nếu một piece biên ghi vào nó
+            self.storage.preallocate(file_indexes=[file_index for file_index, priority
+                                                   in enumerate(self.get_file_priorities())
+                                                   if priority != PRIORITY_SKIP])
+            # Mỗi lô ghi xong (đã fsync) thì lưu lại bản ghi resume
+            self.write_cache = WriteCache(self.storage, on_flush=self.save_resume, memory_budget=self.memory_budget)
 
     def add_piece(self, piece: Piece):
-        for has_piece in self.pieces:
-            if has_piece.piece_id == piece.piece_id:
+        if self.has_piece(piece.piece_id):
+            return
+        if self.storage is None:
+            self.prepare_download()
+
+        # Piece được đưa vào cache ghi và sẽ được ghi vào đúng vị trí trong các file đích
+        # (có thể chặn lại ở đây nếu đĩa ghi không kịp)
+        self.write_cache.add(piece.piece_id * self.piece_length, piece.get_data())
+
+        with self.piece_condition:
+            if self.has_piece(piece.piece_id):
+                return
+            self.have[piece.piece_id >> 3] |= 0x80 >> (piece.piece_id & 7)
+            self.have_count += 1
+            if self.is_wanted(piece.piece_id):
+                self.wanted_remaining -= 1
+            if self.recheck_added is not None:
+                self.recheck_added.add(piece.piece_id)
+            self.piece_condition.notify_all()
+
+    def has_partial_piece(self, index):
+        return index in self.partial_pieces
+
+    def get_partial_pieces(self):
+        """
+        :return: ids of the partial pieces that still have blocks to request
+        """
+        now = time.monotonic()
+        with self.partial_lock:
+            return [piece_id for piece_id, partial in self.partial_pieces.items()
+                    if partial.next_block(now, REQUEST_TIMEOUT) is not None]
+
+    def request_block(self, index, peer_id=None):
+        """
+        Chọn block tiếp theo cần request của piece index, tạo bộ đệm cho piece nếu chưa có.
+        Piece mới chỉ được bắt đầu khi bộ đếm bộ nhớ còn chỗ cho bộ đệm của nó.
+        :return: (begin, length), or None if every block of the piece is received or already requested,
+                 or if the memory budget is exhausted
+        """
+        now = time.monotonic()
+        with self.partial_lock:
+            partial = self.partial_pieces.get(index)
+            if partial is None:
+                if self.has_piece(index) or self.closed:
+                    return None
+                length = self.get_exact_piece_length(index)
+                if not self.memory_budget.try_reserve(PIECE_BUFFERS, length):
+                    return None
+                partial = PartialPiece(index, length, BLOCK_SIZE)
+                self.partial_pieces[index] = partial
+            block_index = partial.next_block(now, REQUEST_TIMEOUT)
+            if block_index is None:
+                return None
+            partial.requested[block_index] = (peer_id, now)
+            return block_index * BLOCK_SIZE, partial.get_block_length(block_index)
+
+    def add_block(self, index, begin, data, peer_id=None):
+        """
+        Chép một block nhận được vào bộ đệm của piece.
+        :return: the assembled piece data once every block has arrived, with the set of peers that sent it,
+                 as (data, sources); None while blocks are missing or if the block was not expected
+        """
+        with self.partial_lock:
+            partial = self.partial_pieces.get(index)
+            if partial is None or begin % BLOCK_SIZE != 0:
+                return None
+            block_index = begin // BLOCK_SIZE
+            if block_index >= partial.block_count or len(data) != partial.get_block_length(block_index) \
+                    or partial.received[block_index]:
+                return None
+
+            partial.buffer[begin:begin + len(data)] = data
+            partial.received[block_index] = 1
+            partial.received_count += 1
+            partial.requested.pop(block_index, None)
+            if peer_id is not None:
+                partial.sources.add(peer_id)
+            if not partial.is_complete():
+                return None
+            # Đủ block: bỏ khỏi danh sách đang ghép, bộ đệm được chuyển thẳng cho bước kiểm tra hash
+            # (vẫn được tính vào bộ đếm bộ nhớ cho tới khi gọi release_piece_buffer)
+            del self.partial_pieces[index]
+            return partial.buffer, partial.sources
+
+    def release_piece_buffer(self, data):
+        """Trả lại bộ nhớ của một bộ đệm piece đã ghép xong, sau khi kiểm tra hash (và ghi vào cache ghi)."""
+        self.memory_budget.release(PIECE_BUFFERS, len(data))
+
+    def release_requests(self, peer_id, blocks=None):
+        """
+        Bỏ đánh dấu các block đã request từ một peer (peer ngắt kết nối hoặc choke) để request lại từ peer khác.
+        :param blocks: (index, begin) of the blocks to release, None for every block requested from the peer
+        """
+        with self.partial_lock:
+            if blocks is None:
+                for partial in self.partial_pieces.values():
+                    for block_index, (requester, _) in list(partial.requested.items()):
+                        if requester == peer_id:
+                            del partial.requested[block_index]
                 return
-        self.pieces.append(piece)
+            for index, begin in blocks:
+                partial = self.partial_pieces.get(index)
+                if partial is None:
+                    continue
+                request = partial.requested.get(begin // BLOCK_SIZE)
+                if request is not None and request[0] == peer_id:
+                    del partial.requested[begin // BLOCK_SIZE]
+
+    def wait_for_piece(self, index, timeout=None):
+        """
+        Chặn cho tới khi có piece index (dùng cho reader streaming).
+        :return: True if the piece is available, False on timeout or when the torrent is closed
+        """
+        with self.piece_condition:
+            self.piece_condition.wait_for(lambda: self.closed or self.has_piece(index), timeout)
+            return self.has_piece(index)
+
+    def set_sequential(self, enabled=True, window_size=STREAM_WINDOW_SIZE):
+        """
+        Bật/tắt chế độ streaming.
+        :param window_size: bytes ahead of the stream position that are fetched in order
+        """
+        self.stream_window = max(MIN_STREAM_WINDOW, math.ceil(window_size / self.piece_length))
+        self.sequential = enabled
+
+    def set_stream_position(self, index):
+        """Dời cửa sổ streaming tới piece index (vị trí reader đang đọc)."""
+        self.stream_position = max(0, min(index, self.total_pieces))
+
+    def get_stream_window(self):
+        """
+        :return: range of pieces to fetch in order, empty when not streaming
+        """
+        if not self.sequential:
+            return range(0)
+        return range(self.stream_position, min(self.stream_position + self.stream_window, self.total_pieces))
 
     def check_complete(self):
-        if len(self.pieces) == self.total_pieces:
+        """Đã có đủ các piece cần tải (toàn bộ torrent, hoặc các piece của những file không bị bỏ qua)."""
+        if self.wanted_remaining == 0:
             return True
         return False
 
-    def export(self):
-        # Tạo thư mục 'download' nếu chưa tồn tại
-
-        if not os.path.exists(self.save_path):
-            os.makedirs(self.save_path)
-
-        # Khởi tạo bộ đệm cho mỗi file
-        file_buffers = {}
-        for piece in self.pieces:
-            piece_data = piece.get_data()
-            piece_id = piece.piece_id
-
-            # Lấy danh sách các file liên quan đến piece hiện tại
-
-            mappings = self.piece_file_map[piece_id]
-
-            for mapping in mappings:
-                file_name = mapping['file']
-                offset = mapping['offset']
-                length = mapping['length']
-
-                # Đảm bảo file buffer được mở và sẵn sàng để ghi
-                if file_name not in file_buffers:
-                    path = os.path.join(self.save_path, file_name)
-                    dir_path = os.path.dirname(path)
-                    if not os.path.exists(dir_path):
-                        os.makedirs(dir_path)
-                    file_buffers[file_name] = open(path, 'wb')
-
-                # Ghi dữ liệu của piece vào file đích tại vị trí offset
-                file_buffers[file_name].seek(offset)
-                file_buffers[file_name].write(piece_data[:length])
-
-                # Cắt dữ liệu đã ghi xong nếu còn lại trong piece
-                piece_data = piece_data[length:]
-
-        # Đóng tất cả các file buffer
-        for file in file_buffers.values():
-            file.close()
-
-        print("Export completed successfully.")
-
-    def build_piece_file_map_from_torrent(self, torrent_info):
-
-        piece_length = torrent_info[b'pieceLength']
-        pieces = torrent_info[b'pieces']
-        total_pieces = len(pieces) // 40  # Mỗi piece có một SHA1 hash dài 20 bytes
-        print(f"Length of pieces: {len(pieces)}")
-        print(f"Total pieces calculated: {total_pieces}")
-        print(f"Pieces (hex): {pieces.hex()}")
-        print(f"Piece length: {piece_length}")
-        piece_file_map = []
-
-        # Kiểm tra nếu có 'files' thì là multi-file, ngược lại là single-file
+    def get_files_from_torrent(self, torrent_info):
+        """
+        Trả về danh sách (đường dẫn tương đối, độ dài) của các file theo thứ tự trong torrent
+        """
         if b'files' in torrent_info:
-            # Multi-file torrent
-            files = [
-                {'length': file[b'length'], 'path': [part.decode() for part in file[b'path']]}
-                for file in torrent_info[b'files']
-            ]
-            print(f"Files: {files}")
-            current_file_index = 0
-            current_file_offset = 0
-
-            for piece_index in range(total_pieces):
-                piece_data = []
-                piece_remaining = piece_length
-
-                while piece_remaining > 0 and current_file_index < len(files):
-                    current_file = files[current_file_index]
-                    current_file_remaining = current_file['length'] - current_file_offset
-
-                    if piece_remaining <= current_file_remaining:
-                        piece_data.append({
-                            'file': '/'.join(current_file['path']),
-                            'offset': current_file_offset,
-                            'length': piece_remaining
-                        })
-                        current_file_offset += piece_remaining
-                        piece_remaining = 0
-                    else:
-                        piece_data.append({
-                            'file': '/'.join(current_file['path']),
-                            'offset': current_file_offset,
-                            'length': current_file_remaining
-                        })
-                        piece_remaining -= current_file_remaining
-                        current_file_index += 1
-                        current_file_offset = 0
-
-                piece_file_map.append(piece_data)
+            return [('/'.join(part.decode() for part in file[b'path']), file[b'length'])
+                    for file in torrent_info[b'files']]
+        return [(torrent_info[b'name'].decode(), torrent_info[b'length'])]
 
+    def export(self):
+        """
+        Các piece đã được ghi thẳng vào file khi nhận được, chỉ cần đẩy nốt phần còn lại xuống đĩa.
+        """
+        if self.write_cache is not None:
+            self.write_cache.flush()
+        elif self.storage is not None:
+            self.storage.flush()
+
+        incomplete = self.get_incomplete_files()
+        if incomplete:
+            logger.warning("Export finished with %d incomplete file(s): %s", len(incomplete), ', '.join(incomplete))
         else:
-            # Single-file torrent
-            file_name = torrent_info[b'name'].decode()
-            file_length = torrent_info[b'length']
-            current_file_offset = 0
-
-            for piece_index in range(total_pieces):
-                piece_data = []
-                piece_remaining = piece_length
-
-                if piece_remaining <= (file_length - current_file_offset):
-                    piece_data.append({
-                        'file': file_name,
-                        'offset': current_file_offset,
-                        'length': piece_remaining
-                    })
-                    current_file_offset += piece_remaining
+            logger.info("Export completed successfully.")
+
+    def get_incomplete_files(self):
+        """
+        :return: names of the wanted files that still miss at least one of their pieces
+        """
+        file_map = self.get_piece_file_map()
+        priorities = self.get_file_priorities()
+        return [file_map.names[file_index] for file_index in range(len(file_map))
+                if priorities[file_index] != PRIORITY_SKIP and not all(self.has_piece(piece_id) for piece_id in file_map.get_pieces_of_file(file_index))]
+
+    def close(self):
+        with self.piece_condition:
+            self.closed = True
+            self.piece_condition.notify_all()
+        # Recheck đang chạy thấy closed ở lần báo tiến độ kế tiếp và dừng lại
+        self.recheck_done.wait()
+        with self.partial_lock:
+            for partial in self.partial_pieces.values():
+                self.memory_budget.release(PIECE_BUFFERS, len(partial.buffer))
+            self.partial_pieces.clear()
+        self.read_cache.close()
+        if self.write_cache is not None:
+            self.write_cache.close()
+        if self.storage is not None:
+            self.storage.flush()
+            self.save_resume()
+            self.storage.close()
+
+    def get_write_cache_statistics(self):
+        if self.write_cache is None:
+            return None
+        return self.write_cache.get_statistics()
+
+    def get_resume_record(self):
+        files = []
+        for path, length in zip(self.storage.paths, self.storage.lengths):
+            # File đang share: dùng kết quả stat lúc duyệt thư mục (trước khi đọc), không stat lại
+            stat = self.get_file_stat(path)
+            if stat is not None:
+                _, mtime, inode = stat
+            else:
+                try:
+                    stat = os.stat(path)
+                    mtime, inode = stat.st_mtime_ns, stat.st_ino
+                except OSError:
+                    mtime, inode = 0, 0
+            files.append({'path': path, 'length': length, 'mtime': mtime, 'inode': inode})
+
+        # Chỉ ghi nhận các piece đã thực sự nằm trên đĩa
+        have = bytearray(self.have)
+        if self.write_cache is not None:
+            for offset in self.write_cache.get_dirty_offsets():
+                piece_id = offset // self.piece_length
+                have[piece_id >> 3] &= ~(0x80 >> (piece_id & 7)) & 0xFF
+
+        record = {
+            'pieceLength': self.piece_length,
+            'have': bytes(have),
+            'pieces': b''.join(self.piece_hashes),
+            'files': files,
+        }
+        if self.file_priorities is not None:
+            record['priorities'] = self.file_priorities
+        return record
+
+    def save_resume(self):
+        """Lưu bản ghi resume; chỉ gọi sau khi dữ liệu đã được flush xuống đĩa."""
+        if self.resume_data is None or self.storage is None:
+            return
+        try:
+            self.resume_data.save(self.get_resume_record())
+        except OSError as e:
+            logger.error("Unable to save resume data: %s", e)
+
+    def load_resume(self, record):
+        """
+        Khôi phục các piece đã tải từ bản ghi resume.
+        File không đổi (cùng kích thước và mtime) thì tin bản ghi; các piece thuộc file đã đổi
+        được kiểm tra lại hash trên đĩa, song song trên mọi core (PieceHasher).
+        Có thể mất lâu với file lớn nên được gọi trên thread của torrent (Peer.resume_and_download),
+        tiến độ báo qua get_recheck_progress như recheck.
+        :return: number of pieces restored
+        :raise RecheckCancelled: if the torrent is closed while checking
+        """
+        if record is None or self.storage is None or record[b'pieceLength'] != self.piece_length:
+            return 0
+        if record[b'pieces'] != b''.join(self.piece_hashes) or len(record[b'have']) != len(self.have):
+            return 0
+        changed_files = self.get_changed_files(record)
+        if changed_files is None:
+            return 0
+
+        have = bytearray(record[b'have'])
+        piece_ids = sorted(piece_id for piece_id in self.get_pieces_of_files(changed_files)
+                           if have[piece_id >> 3] & (0x80 >> (piece_id & 7)))
+        if piece_ids:
+            self.recheck_done.clear()
+            try:
+                if self.closed:
+                    raise RecheckCancelled("torrent closed before resume check")
+                self.recheck_progress = {'checking': True, 'checked': 0, 'total': len(piece_ids), 'valid': 0}
+                try:
+                    hashes = PieceHasher(self.piece_length).hash_pieces(self.storage, piece_ids, self.total_length,
+                                                                        progress=self.on_recheck_progress)
+                finally:
+                    self.recheck_progress['checking'] = False
+            finally:
+                self.recheck_done.set()
+            for piece_id, digest in zip(piece_ids, hashes):
+                if digest != self.piece_hashes[piece_id]:
+                    have[piece_id >> 3] &= ~(0x80 >> (piece_id & 7)) & 0xFF
+
+        with self.lock:
+            self.have = have
+            self.have_count = sum(bin(byte).count('1') for byte in self.have)
+            self.wanted_remaining = self.count_wanted_remaining()
+        if piece_ids:
+            self.recheck_progress['valid'] = self.have_count
+
+        logger.info("Resumed %d/%d pieces, rechecked %d changed file(s)", self.have_count, self.total_pieces, len(changed_files))
+        return self.have_count
+
+    def get_changed_files(self, record):
+        """
+        So sánh các file hiện tại với bản ghi resume.
+        :return: indexes of files whose size or mtime changed, or None if the file layout differs
+        """
+        recorded = record[b'files']
+        if len(recorded) != len(self.storage.paths):
+            return None
+
+        changed_files = []
+        for file_index, (path, length, file) in enumerate(zip(self.storage.paths, self.storage.lengths, recorded)):
+            if file[b'path'].decode() != path or file[b'length'] != length:
+                return None
+            if not self.is_file_unchanged(path, length, file):
+                changed_files.append(file_index)
+        return changed_files
+
+    def get_pieces_of_files(self, file_indexes):
+        """Tập các piece có chứa byte của những file đã cho."""
+        file_map = self.get_piece_file_map()
+        piece_ids = set()
+        for file_index in file_indexes:
+            piece_ids.update(file_map.get_pieces_of_file(file_index))
+        return piece_ids
+
+    def recheck(self):
+        """
+        Kiểm tra lại dữ liệu trên đĩa với hash trong torrent, bất kể bản ghi resume.
+        Chỉ các piece cần tải được băm (file bị bỏ qua không được đọc hay tạo ra), song song trên mọi core
+        (PieceHasher); bitfield được dựng lại từ những piece khớp hash.
+        Có thể gọi khi torrent đang tải: trong lúc kiểm tra không chọn piece mới (is_rechecking), các piece
+        nhận xong trong lúc đó được giữ lại.
+        :return: number of valid pieces
+        :raise RecheckCancelled: if the torrent is closed while checking
+        """
+        self.recheck_done.clear()
+        try:
+            if self.closed:
+                raise RecheckCancelled("torrent closed before recheck")
+            if self.storage is None:
+                self.prepare_download()
+            with self.piece_condition:
+                self.recheck_added = set()
+            if self.write_cache is not None:
+                self.write_cache.flush()
+
+            hasher = PieceHasher(self.piece_length)
+            if self.wanted is None:
+                piece_ids = range(self.total_pieces)
+            else:
+                piece_ids = [piece_id for piece_id in range(self.total_pieces) if self.is_wanted(piece_id)]
+            self.recheck_progress = {'checking': True, 'checked': 0, 'total': len(piece_ids), 'valid': 0}
+            try:
+                if len(piece_ids) == self.total_pieces:
+                    # Đọc tuần tự theo khối lớn
+                    hashes = hasher.hash_storage(self.storage, self.total_length, progress=self.on_recheck_progress)
                 else:
-                    piece_data.append({
-                        'file': file_name,
-                        'offset': current_file_offset,
-                        'length': file_length - current_file_offset
-                    })
-                    current_file_offset += file_length - current_file_offset
-
-                piece_file_map.append(piece_data)
-
-        return piece_file_map
\ No newline at end of file
+                    hashes = hasher.hash_pieces(self.storage, piece_ids, self.total_length,
+                                                progress=self.on_recheck_progress)
+            finally:
+                self.recheck_progress['checking'] = False
+
+            have = bytearray(len(self.have))
+            for piece_id, digest in zip(piece_ids, hashes):
+                if digest == self.piece_hashes[piece_id]:
+                    have[piece_id >> 3] |= 0x80 >> (piece_id & 7)
+
+            with self.piece_condition:
+                for piece_id in self.recheck_added:
+                    have[piece_id >> 3] |= 0x80 >> (piece_id & 7)
+                self.recheck_added = None
+                previous_remaining = self.wanted_remaining
+                self.have = have
+                self.have_count = sum(bin(byte).count('1') for byte in have)
+                self.wanted_remaining = self.count_wanted_remaining()
+                wanted_added = self.wanted_remaining > previous_remaining
+                self.piece_condition.notify_all()
+        finally:
+            with self.piece_condition:
+                self.recheck_added = None
+            self.recheck_done.set()
+
+        self.recheck_progress['valid'] = self.have_count
+        self.read_cache.clear()
+        self.save_resume()
+        # Piece hỏng được tìm thấy: tải lại, kể cả khi torrent đã tải xong
+        if wanted_added and self.on_wanted_added is not None:
+            self.on_wanted_added()
+
+        logger.info("Recheck: %d/%d pieces valid", self.have_count, self.total_pieces)
+        return self.have_count
+
+    def is_rechecking(self):
+        return self.recheck_added is not None
+
+    def on_recheck_progress(self, checked):
+        self.recheck_progress['checked'] = checked
+        if self.closed:
+            raise RecheckCancelled("torrent closed during recheck")
+
+    def get_recheck_progress(self):
+        """
+        :return: {'checking', 'checked', 'total', 'valid'} of the last recheck, or None
+        """
+        if self.recheck_progress is None:
+            return None
+        return dict(self.recheck_progress)
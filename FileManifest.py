@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# path: đường dẫn đầy đủ, relative_path: đường dẫn tương đối so với thư mục gốc, phân tách bằng '/'
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'relative_path', 'length', 'mtime', 'inode'])
+
+# Số file được stat trong một tác vụ của thread pool
+STAT_BATCH = 256
+SCAN_WORKERS = 16
+
+
+class FileManifest:
+    """
+    Danh sách file (đã sắp xếp) của một thư mục được share, lấy trong một lượt duyệt duy nhất.
+    Cả metadata torrent (User._input_directory) lẫn việc băm (FileManager.split_dir) dùng chung
+    danh sách này nên thứ tự file luôn khớp nhau.
+
+    Thư mục được duyệt bằng os.scandir (loại entry lấy từ readdir, không cần stat); các thư mục con
+    và việc stat file được chia cho một thread pool, vì trên hệ thống file mạng mỗi lần stat là
+    một round trip và chạy song song nhanh hơn nhiều.
+    """
+
+    def __init__(self, root, entries):
+        self.root = root
+        self.entries = entries
+        self.total_length = sum(entry.length for entry in entries)
+        self.by_path = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get_paths(self):
+        return [entry.path for entry in self.entries]
+
+    def get_entry(self, path):
+        """
+        :return: ManifestEntry of a full path, or None
+        """
+        if self.by_path is None:
+            self.by_path = {entry.path: entry for entry in self.entries}
+        return self.by_path.get(path)
+
+    @staticmethod
+    def from_file(path):
+        stat = os.stat(path)
+        return FileManifest(path, [ManifestEntry(path, os.path.basename(path), stat.st_size,
+                                                 stat.st_mtime_ns, stat.st_ino)])
+
+    @staticmethod
+    def scan(root, workers=SCAN_WORKERS):
+        """
+        Duyệt toàn bộ cây thư mục root.
+        Symlink tới file được theo như file thường, symlink tới thư mục thì bỏ qua (tránh vòng lặp).
+        :return: FileManifest sorted by path components
+        """
+        if not os.path.isdir(root):
+            raise NotADirectoryError(root)
+
+        scanner = _TreeScanner(root, workers)
+        entries = scanner.run()
+        # Sắp xếp theo từng thành phần của đường dẫn, giống thứ tự của Path.rglob được sắp xếp
+        entries.sort(key=lambda entry: entry.relative_path.split('/'))
+        return FileManifest(root, entries)
+
+
+class _TreeScanner:
+    """Duyệt song song: mỗi thư mục và mỗi lô STAT_BATCH file là một tác vụ của pool."""
+
+    def __init__(self, root, workers):
+        self.root = root
+        self.workers = max(1, workers)
+        self.entries = []
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.done = threading.Event()
+        self.error = None
+
+    def run(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            self._submit(self._scan_directory, self.root, '')
+            self.done.wait()
+        finally:
+            self.executor.shutdown()
+        if self.error is not None:
+            raise self.error
+        return self.entries
+
+    def _submit(self, function, *args):
+        with self.lock:
+            self.pending += 1
+        self.executor.submit(self._run_task, function, *args)
+
+    def _run_task(self, function, *args):
+        try:
+            function(*args)
+        except OSError as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+        finally:
+            with self.lock:
+                self.pending -= 1
+                finished = self.pending == 0
+            if finished:
+                self.done.set()
+
+    def _scan_directory(self, path, relative_path):
+        files = []
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                relative = f'{relative_path}/{entry.name}' if relative_path else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    self._submit(self._scan_directory, entry.path, relative)
+                elif entry.is_file():
+                    files.append((entry, relative))
+                    if len(files) == STAT_BATCH:
+                        self._submit(self._stat_files, files)
+                        files = []
+        if files:
+            self._stat_files(files)
+
+    def _stat_files(self, files):
+        entries = []
+        for entry, relative in files:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # File bị xoá trong lúc duyệt
+                continue
+            entries.append(ManifestEntry(entry.path, relative, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+        with self.lock:
+            self.entries.extend(entries)
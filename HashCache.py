@@ -0,0 +1,50 @@
+import hashlib
+import os
+import threading
+
+import bencodepy
+
+from LogPipeline import get_logger
+
+logger = get_logger('storage')
+
+HASH_CACHE_DIR = 'HashCache'
+
+
+class HashCache:
+    """
+    Cache hash các piece của những đường dẫn đã share, lưu trên đĩa.
+    Mỗi bản ghi ứng với một (đường dẫn gốc, piece_length) và chứa danh sách file
+    (path, length, mtime, inode) cùng hash của các piece, cùng định dạng với bản ghi resume.
+    FileManager chỉ dùng lại hash của những piece mà mọi file chứa nó đều không đổi.
+    """
+
+    def __init__(self, cache_dir=HASH_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+
+    def get_cache_path(self, root_path, piece_length):
+        key = f'{os.path.abspath(root_path)}:{piece_length}'.encode('utf-8')
+        return os.path.join(self.cache_dir, f'{hashlib.sha1(key).hexdigest()}.hashes')
+
+    def lookup(self, root_path, piece_length):
+        """
+        :return: cached record of this path and piece length, or None
+        """
+        try:
+            with open(self.get_cache_path(root_path, piece_length), 'rb') as f:
+                return bencodepy.decode(f.read())
+        except (OSError, bencodepy.BencodeDecodeError):
+            return None
+
+    def store(self, root_path, piece_length, record):
+        path = self.get_cache_path(root_path, piece_length)
+        try:
+            with self.lock:
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                with open(f'{path}.tmp', 'wb') as f:
+                    f.write(bencodepy.encode(record))
+                os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logger.warning("Unable to write hash cache: %s", e)
@@ -0,0 +1,71 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+LOG_FILE = 'bittorrent_app.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+# Logger gốc của thư viện, mỗi phân hệ là một logger con: bittorrent.wire, bittorrent.storage, ...
+ROOT_LOGGER = 'bittorrent'
+
+_lock = threading.Lock()
+_listener = None
+
+
+def get_logger(subsystem):
+    """
+    :param subsystem: 'wire', 'peer', 'storage', 'hash', 'tracker', 'user', ...
+    :return: logger of a subsystem of the library
+    """
+    return logging.getLogger(f'{ROOT_LOGGER}.{subsystem}')
+
+
+def setup_logging(level=logging.INFO, filename=LOG_FILE, console=False, levels=None):
+    """
+    Dựng đường log bất đồng bộ của process: mọi logger (kể cả root logger mà app.py dùng) đẩy bản ghi
+    vào một hàng đợi qua QueueHandler, một thread QueueListener ghi chúng ra file hoặc console.
+    Thread gọi log vẫn ghép các tham số %s vào message (QueueHandler.prepare), nhưng không bao giờ
+    phải chờ I/O của log; các lời gọi DEBUG bị bỏ qua ngay ở bước kiểm tra level nên không tốn gì.
+    Gọi lại lần nữa không làm gì.
+    :param filename: log file, None for no file
+    :param console: also write records to stderr
+    :param levels: per-subsystem levels, e.g. {'wire': logging.DEBUG}
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        formatter = logging.Formatter(LOG_FORMAT)
+        handlers = []
+        if filename:
+            handlers.append(logging.FileHandler(filename, encoding='utf-8'))
+        if console:
+            handlers.append(logging.StreamHandler(sys.stderr))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(level)
+        for subsystem, subsystem_level in (levels or {}).items():
+            get_logger(subsystem).setLevel(subsystem_level)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Ghi nốt các bản ghi còn trong hàng đợi và dừng thread ghi log."""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,102 @@
+import threading
+
+# Giới hạn mặc định cho dữ liệu truyền tải nằm trong bộ nhớ của cả process (byte)
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Các loại bộ nhớ được theo dõi
+PIECE_BUFFERS = 'piece_buffers'  # bộ đệm ghép piece (đang tải và đang chờ kiểm tra hash)
+READ_CACHE = 'read_cache'
+WRITE_CACHE = 'write_cache'
+RECEIVE = 'receive'  # payload của message đang nhận
+SEND = 'send'  # dữ liệu đang chờ gửi
+
+
+class MemoryBudget:
+    """
+    Bộ đếm bộ nhớ dùng chung cho mọi Peer trong process.
+    Mỗi nơi giữ dữ liệu truyền tải (bộ đệm piece, cache, buffer gửi/nhận) báo số byte mình đang giữ;
+    khi tổng vượt giới hạn, Peer ngừng bắt đầu piece mới và PeerHandler tạm dừng đọc socket
+    cho tới khi đĩa và verifier giải phóng bớt bộ nhớ.
+    """
+
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.usage = {}  # loại -> số byte
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+        self.throttled = 0
+        self.read_pauses = 0
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def reserve(self, category, size):
+        """Ghi nhận size byte, luôn thành công (dữ liệu đã nằm trong bộ nhớ)."""
+        with self.condition:
+            self.usage[category] = self.usage.get(category, 0) + size
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def try_reserve(self, category, size):
+        """
+        Ghi nhận size byte nếu còn chỗ trong giới hạn.
+        :return: False if the budget would be exceeded (nothing is reserved)
+        """
+        with self.condition:
+            if self.used + size > self.limit:
+                self.throttled += 1
+                return False
+            self.usage[category] = self.usage.get(category, 0) + size
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, category, size):
+        with self.condition:
+            self.usage[category] = self.usage.get(category, 0) - size
+            self.used -= size
+            if self.used < self.limit:
+                self.condition.notify_all()
+
+    def is_exhausted(self, size=0):
+        return self.used + size > self.limit
+
+    def wait_for_room(self, timeout=None):
+        """
+        Chờ cho tới khi mức dùng xuống dưới giới hạn.
+        :return: False if the budget is still exhausted after timeout seconds
+        """
+        with self.condition:
+            if self.used < self.limit:
+                return True
+            self.read_pauses += 1
+            return self.condition.wait_for(lambda: self.used < self.limit, timeout)
+
+    def record_read_pause(self):
+        """Đếm một lần tạm dừng đọc socket không đi qua wait_for_room (PeerEngine)."""
+        with self.condition:
+            self.read_pauses += 1
+
+    def get_statistics(self):
+        with self.condition:
+            statistics = {
+                'limit': self.limit,
+                'used': self.used,
+                'peak': self.peak,
+                'throttled': self.throttled,
+                'read_pauses': self.read_pauses,
+            }
+            statistics.update(self.usage)
+            return statistics
+
+
+# Bộ đếm mặc định của process, mọi User/Peer dùng chung nếu không truyền bộ đếm riêng
+_process_budget = MemoryBudget()
+
+
+def get_memory_budget():
+    return _process_budget
@@ -0,0 +1,122 @@
+import struct
+
+from MemoryBudget import RECEIVE
+
+# Kích thước mặc định của bộ đệm nhận mỗi kết nối (đủ cho vài PIECE 16 KiB)
+READ_BUFFER_SIZE = 32 * 1024
+# Message dài hơn thế này bị coi là lỗi giao thức (PIECE cả piece lớn nhất vẫn nằm trong giới hạn)
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024 + 13
+
+HANDSHAKE_LENGTH = 68
+
+_LENGTH = struct.Struct('>I')
+
+
+class MessageReader:
+    """
+    Tách message của giao thức peer từ một bộ đệm bytearray dùng lại cho mọi lần đọc.
+    Socket ghi thẳng vào phần trống của bộ đệm (recv_into, hoặc asyncio.BufferedProtocol), mỗi lần đọc
+    có thể chứa nhiều message và tất cả các message đã đủ đều được tách ra ngay.
+    Payload được trả về dưới dạng memoryview trỏ vào bộ đệm, không sao chép: nó chỉ hợp lệ cho tới
+    lần đọc kế tiếp, nơi xử lý cần giữ lại dữ liệu phải tự sao chép (ví dụ bytes(payload)).
+    """
+
+    def __init__(self, size=READ_BUFFER_SIZE, memory_budget=None):
+        self.size = size
+        self.memory_budget = memory_budget
+        self.buffer = None
+        self.view = None
+        self.start = 0  # đầu phần dữ liệu chưa xử lý
+        self.end = 0  # cuối phần dữ liệu đã nhận
+        self.needed = 0  # độ dài message đang nhận dở (kể cả 4 byte độ dài), 0 nếu chưa biết
+        self._allocate(size)
+
+    def _allocate(self, size):
+        """Cấp bộ đệm mới, chép phần dữ liệu chưa xử lý sang đầu bộ đệm."""
+        buffer = bytearray(size)
+        pending = self.end - self.start
+        if pending:
+            buffer[:pending] = self.view[self.start:self.end]
+        if self.memory_budget is not None:
+            if self.buffer is not None:
+                self.memory_budget.release(RECEIVE, len(self.buffer))
+            self.memory_budget.reserve(RECEIVE, size)
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    def get_buffer(self):
+        """
+        :return: writable memoryview of the free space at the end of the buffer
+        """
+        if self.end == len(self.buffer) or self.needed > len(self.buffer) - self.start:
+            pending = self.end - self.start
+            required = max(self.needed, pending + 1)
+            if required <= len(self.buffer) and self.start > 0:
+                # Dồn phần chưa xử lý về đầu bộ đệm (cùng độ dài nên không đổi kích thước bytearray)
+                self.buffer[:pending] = self.view[self.start:self.end]
+                self.start = 0
+                self.end = pending
+            else:
+                self._allocate(max(required, 2 * len(self.buffer)))
+        return self.view[self.end:]
+
+    def advance(self, count):
+        """Ghi nhận count byte vừa được ghi vào get_buffer()."""
+        self.end += count
+
+    def recv_from(self, conn):
+        """
+        Đọc từ socket thẳng vào bộ đệm.
+        :return: number of bytes read, 0 when the connection is closed
+        """
+        count = conn.recv_into(self.get_buffer())
+        self.end += count
+        return count
+
+    def read_handshake(self):
+        """
+        :return: the 68-byte handshake once it has been received, the bytes after it stay in the buffer
+        """
+        if self.end - self.start < HANDSHAKE_LENGTH:
+            self.needed = HANDSHAKE_LENGTH
+            return None
+        handshake = bytes(self.view[self.start:self.start + HANDSHAKE_LENGTH])
+        self.start += HANDSHAKE_LENGTH
+        self.needed = 0
+        return handshake
+
+    def messages(self):
+        """
+        Trả về lần lượt các message đã nhận đủ trong bộ đệm; keep-alive bị bỏ qua.
+        Mỗi message phải được xử lý xong trước khi lấy message tiếp theo.
+        :return: iterator of (message_type, payload memoryview)
+        """
+        view = self.view
+        while self.end - self.start >= 4:
+            length = _LENGTH.unpack_from(view, self.start)[0]
+            if length == 0:
+                self.start += 4
+                continue
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError(f"message of {length} bytes is too long")
+            if self.end - self.start - 4 < length:
+                self.needed = 4 + length
+                return
+            message_start = self.start
+            self.start += 4 + length
+            yield view[message_start + 4], view[message_start + 5:message_start + 4 + length]
+
+        self.needed = 0
+        if self.start == self.end:
+            self.start = self.end = 0
+            # Trả lại bộ đệm đã phải nới ra cho một message lớn
+            if len(self.buffer) > self.size:
+                self._allocate(self.size)
+
+    def close(self):
+        if self.memory_budget is not None and self.buffer is not None:
+            self.memory_budget.release(RECEIVE, len(self.buffer))
+        self.buffer = None
+        self.view = None
@@ -1,5 +1,3 @@
-import hashlib
-
 import threading
 import socket
 from threading import Thread
@@ -10,13 +8,21 @@ import json
 
 
 from PeerHandler import PeerHandler
-from FileManager import FileManager, Piece
+from PeerEngine import AsyncPeerHandler
+from FileManager import FileManager, Piece, RecheckCancelled
+from PieceHasher import PieceVerifier
+from LogPipeline import get_logger
 
 from PeerServer import PeerServer
+
+logger = get_logger('peer')
 EVENT_STATE = ['STARTED', 'STOPPED', 'COMPLETED']
 
 class Peer:
-    def __init__(self, peer_ip, peer_port, info, file_manager):
+    def __init__(self, peer_ip, peer_port, info, file_manager, engine=None):
+        """
+        :param engine: PeerEngine running the connections on one event loop, None for a thread per connection
+        """
         self.peer_id = self.generate_peer_id()
 
         self.peer_ip = peer_ip
@@ -30,15 +36,29 @@ class Peer:
         self.peer_server = PeerServer(self.peer_id, peer_ip, peer_port, self.info_hash)
 
         self.is_running = False
+        # Đặt bởi stop(): recheck_and_download không được tham gia swarm sau khi torrent đã bị dừng
+        self.stopped = False
         self.peer_handlers: dict[(str, int), PeerHandler] = {}
         self.threads: dict[(str, int), Thread] = {}
         self.peer_server_thread = None
         self.file_manager = file_manager
+        self.engine = engine
+        # Cổng lắng nghe trên engine (asyncio server), None khi dùng thread
+        self.server = None
 
         self.bitfields = {}  # Lưu trữ bitfield từ mỗi peer (peer_id -> bitfield)
         self.piece_frequencies = {}  # Đếm tần suất xuất hiện của mỗi piece
         self.lock = threading.Lock()
 
+        # Kiểm tra SHA-1 các piece nhận được trên thread pool riêng, piece sai được request lại
+        self.verifier = PieceVerifier(lambda piece_id: self.file_manager.piece_hashes[piece_id],
+                                      self.on_piece_verified)
+        self.completed = False
+        # Bật lại một file bị bỏ qua (kể cả khi đã tải xong) thì tải tiếp
+        file_manager.on_wanted_added = self.on_wanted_added
+        # Bộ đếm bộ nhớ dùng chung của process (của FileManager), cũng được dùng bởi các PeerHandler
+        self.memory_budget = file_manager.memory_budget
+
         self.scrape_response = ""
     def generate_peer_id(self):
         client_id = "PY"  # Two characters for client id (e.g., PY for Python)
@@ -53,12 +73,14 @@ class Peer:
         Với mỗi peer sẽ tạo một thread chạy PeerHandler để communicate
         :return: void
         """
+        # Tạo sẵn các file đích để ghi thẳng từng piece khi nhận được
+        self.file_manager.prepare_download()
         # Tạo server để lắng nghe và phản hồi yêu cầu từ các peer khác
         self.start_server()
         # Gửi request và nhận về peer list từ tracker server
         response = self.peer_server.announce_request("STARTED")
         response = json.loads(response)
-        print(response)
+        logger.info("Announce response: %s", response)
 
         peers = response['peers']
 
@@ -71,9 +93,14 @@ class Peer:
             if ip == self.peer_ip and port == self.peer_port:
                 continue
 
+            if self.engine is not None:
+                self.connect_async(ip, port)
+                continue
+
             conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             conn.connect((ip, port))
-            peer_handler = PeerHandler(conn, (ip, port), self.info_hash, self.peer_id, self.callback)
+            peer_handler = PeerHandler(conn, (ip, port), self.info_hash, self.peer_id, self.callback,
+                                       memory_budget=self.memory_budget)
             thread = Thread(target=peer_handler.run)
 
             with self.lock:
@@ -83,15 +110,54 @@ class Peer:
                 thread.start()
 
 
+    def connect_async(self, ip, port):
+        peer_handler = AsyncPeerHandler(self.engine, (ip, port), self.info_hash, self.peer_id, self.callback,
+                                        memory_budget=self.memory_budget)
+        with self.lock:
+            self.peer_handlers[(ip, port)] = peer_handler
+        try:
+            self.engine.connect(ip, port, peer_handler)
+        except (OSError, TimeoutError) as e:
+            logger.warning("Cannot connect to %s:%s: %s", ip, port, e)
+            with self.lock:
+                self.peer_handlers.pop((ip, port), None)
+            # connection_lost không được gọi khi chưa kết nối được: trả lại bộ đệm nhận cho MemoryBudget
+            peer_handler.reader.close()
+
+    def register_handler(self, peer_handler):
+        """Ghi nhận một kết nối đến trên engine (gọi từ event loop)."""
+        with self.lock:
+            self.peer_handlers[tuple(peer_handler.addr)] = peer_handler
+
+    def recheck_and_download(self):
+        """Kiểm tra lại dữ liệu đã có trên đĩa rồi mới tham gia swarm, chỉ tải những piece còn thiếu."""
+        try:
+            self.file_manager.recheck()
+        except RecheckCancelled:
+            return
+        if self.stopped:
+            return
+        self.download()
+
+    def resume_and_download(self, record):
+        """Khôi phục các piece đã tải từ bản ghi resume (băm lại file đã đổi) rồi mới tham gia swarm."""
+        try:
+            self.file_manager.load_resume(record)
+        except RecheckCancelled:
+            return
+        if self.stopped:
+            return
+        self.download()
+
     def upload(self):
 
         self.start_server()
         respond = self.peer_server.announce_request("STARTED")
-        print(respond)
+        logger.info("Announce response: %s", respond)
 
     def scrape_tracker(self):
         response = self.peer_server.scrape_request()
-        print("Scrape tracker: ", response)
+        logger.info("Scrape tracker: %s", response)
         self.scrape_response = response
 
     def get_scrape_response(self):
@@ -101,13 +167,15 @@ class Peer:
             return "No information"
 
     def stop(self):
+        self.stopped = True
         self.is_running = False
 
         self.peer_server.announce_request("STOPPED")
 
         for (ip, port) in list(self.peer_handlers.keys()):
-            self.peer_handlers[(ip, port)].stop()
-            self.peer_handlers.pop((ip, port))
+            peer_handler = self.peer_handlers.pop((ip, port), None)
+            if peer_handler is not None:
+                peer_handler.stop()
 
         for (ip, port) in list(self.threads.keys()):
             self.threads[(ip, port)].join()
@@ -115,6 +183,13 @@ class Peer:
 
         if self.peer_server_thread:
             self.peer_server_thread.join()
+        if self.server is not None:
+            self.engine.close_server(self.server)
+            self.server = None
+
+        # Các piece đang được kiểm tra được ghi xong trước khi đóng file
+        self.verifier.close()
+        self.file_manager.close()
 
     def stop_peer_handler(self, addr):
         """Stop and clean up a peer handler and its thread"""
@@ -125,7 +200,7 @@ class Peer:
             if addr_key not in self.peer_handlers:
                 return
 
-            print(f"Stopping connection to {addr}")
+            logger.info("Stopping connection to %s", addr)
 
             # Get the handler and thread
             handler = self.peer_handlers[addr_key]
@@ -160,41 +235,119 @@ class Peer:
             return  {'bitfield' : self.file_manager.get_bitfield()}
 
         elif event_type == 'request_piece_index':
-            index = self.get_rarest_piece()
-            print("Piece index: ", index)
-            length = self.file_manager.get_exact_piece_length(index)
-
-            return {'index': index, 'begin': 0, 'length': length}
-
-        elif event_type == 'request_piece':
+            # Mỗi REQUEST chỉ xin một block (BLOCK_SIZE), không phải cả piece
+            block = self.pick_block(peer_id)
+            if block is None:
+                return None
+            index, begin, length = block
+            return {'index': index, 'begin': begin, 'length': length}
+
+        elif event_type == 'request_block':
             index = int(data['index'])
-            return self.file_manager.get_piece(index)
+            begin = int(data['begin'])
+            length = int(data['length'])
+            source = self.file_manager.get_block_source(index, begin, length)
+            if source is None:
+                return None
+            source.update({'index': index, 'begin': begin})
+            return source
 
         elif event_type == 'piece_received':
             index = int(data['index'])
             begin = int(data['begin'])
             data = data['block']
-            hash_value = hashlib.sha256(data).hexdigest()
-            piece = Piece(index, data, hash_value)
+            if index >= self.file_manager.get_total_pieces():
+                logger.warning("Ignoring invalid block %d:%d (length %d) from %s", index, begin, len(data), peer_id)
+                return self.file_manager.check_complete()
+
+            # Ghép block vào bộ đệm của piece; chỉ piece đã đủ block mới được kiểm tra hash
+            assembled = self.file_manager.add_block(index, begin, data, peer_id)
+            if assembled is not None:
+                buffer, sources = assembled
+                # Băm và ghi piece trên thread pool của verifier, thread đọc socket đi tiếp ngay
+                if not self.verifier.submit(Piece(index, buffer, self.file_manager.piece_hashes[index]), sources):
+                    self.file_manager.release_piece_buffer(buffer)
+            return self.file_manager.check_complete()
+        elif event_type == 'requests_cancelled':
+            # Các block peer sẽ không gửi (bị choke) được request lại, có thể từ peer khác
+            self.file_manager.release_requests(peer_id, data['blocks'])
+        elif event_type == 'stop':
+            addr = data['addr']
+            # Các block đang chờ từ peer này được request lại từ peer khác
+            self.file_manager.release_requests(peer_id)
+            self.stop_peer_handler(addr)
 
-            self.file_manager.add_piece(piece)
 
-            is_complete = self.file_manager.check_complete()
+    def on_piece_verified(self, piece, sources, ok):
+        """
+        Gọi từ thread của verifier sau khi kiểm tra hash một piece.
+        Piece đúng được ghi vào FileManager; piece sai bị bỏ, được tính cho mọi peer đã gửi block của nó
+        và được request lại.
+        """
+        if ok:
+            try:
+                self.file_manager.add_piece(piece)
+            finally:
+                self.file_manager.release_piece_buffer(piece.get_data())
+            if self.file_manager.check_complete():
+                self.on_download_complete()
+            return
+
+        self.file_manager.release_piece_buffer(piece.get_data())
+        logger.warning("Piece %d from %s failed hash check", piece.piece_id, ', '.join(sorted(sources)))
+        handler = None
+        for peer_id in sources:
+            source_handler = self.get_peer_handler(peer_id)
+            if source_handler is not None and source_handler.report_hash_failure():
+                handler = source_handler
+
+        # Request lại piece (piece sai đã được bỏ khỏi danh sách chờ kiểm tra nên có thể được chọn lại)
+        if handler is None:
+            with self.lock:
+                handler = next((other for other in self.peer_handlers.values()
+                                if other.running and other.am_interested and not other.peer_choking), None)
+        if handler is not None:
+            handler.request_next_piece()
 
-            if is_complete:
-                self.file_manager.export()
+    def on_download_complete(self):
+        with self.lock:
+            if self.completed:
+                return
+            self.completed = True
+            handlers = list(self.peer_handlers.values())
 
-                self.peer_server.announce_request("COMPLETED")
-            return is_complete
-        elif event_type == 'stop':
-            addr = data['addr']
-            self.stop_peer_handler(addr)
+        self.file_manager.export()
+        self.peer_server.announce_request("COMPLETED")
+        for handler in handlers:
+            if handler.running and handler.am_interested:
+                handler.send_not_interested()
 
+    def on_wanted_added(self):
+        """
+        Gọi khi đổi mức ưu tiên làm có thêm piece cần tải: bỏ trạng thái đã tải xong và gửi INTERESTED
+        tới các peer có piece cần tải (có thể đã gửi NOT_INTERESTED khi tải xong các file được chọn).
+        """
+        with self.lock:
+            self.completed = False
+            handlers = [(handler, self.bitfields.get(handler.client_id)) for handler in self.peer_handlers.values()]
+        for handler, bitfield in handlers:
+            if handler.running and not handler.am_interested and bitfield is not None \
+                    and self.file_manager.is_interested(bitfield):
+                handler.send_interested()
+
+    def get_peer_handler(self, peer_id):
+        with self.lock:
+            return next((handler for handler in self.peer_handlers.values() if handler.client_id == peer_id), None)
 
     def start_server(self):
         """Khởi chạy server để lắng nghe các yêu cầu từ peer khác."""
         if not self.is_running:
             self.is_running = True
+            if self.engine is not None:
+                self.server = self.engine.listen('0.0.0.0', self.peer_port, lambda: AsyncPeerHandler(
+                    self.engine, None, self.info_hash, self.peer_id, self.callback,
+                    memory_budget=self.memory_budget, on_connected=self.register_handler))
+                return
             self.peer_server_thread = threading.Thread(target=self.listen)
             self.peer_server_thread.start()
 
@@ -208,7 +361,8 @@ class Peer:
             try:
                 conn, addr = server_socket.accept()
                 ip, port = addr
-                peer_handler = PeerHandler(conn, addr, self.info_hash, self.peer_id, self.callback)
+                peer_handler = PeerHandler(conn, addr, self.info_hash, self.peer_id, self.callback,
+                                           memory_budget=self.memory_budget)
                 thread = threading.Thread(target=peer_handler.run)
                 with self.lock:
                     self.peer_handlers[(ip, port)] = peer_handler
@@ -237,20 +391,86 @@ class Peer:
                     self.piece_frequencies[piece_index] = 0
                 self.piece_frequencies[piece_index] += 1
 
-    def get_rarest_piece(self):
+    def pick_block(self, peer_id):
+        """
+        Chọn block tiếp theo để request. Ở chế độ streaming, các piece còn thiếu trong cửa sổ phía trước
+        vị trí đang đọc (mà có peer đang có) được ưu tiên tuyệt đối; sau đó là các piece đã tải dở
+        (để piece sớm đủ block và được ghi), cuối cùng mới bắt đầu piece mới theo rarest-first.
+        Chỉ chọn các piece mà peer được request (peer_id) có trong bitfield của nó.
+        :return: (index, begin, length), or None if there is nothing left to request
+        """
+        bitfield = self.bitfields.get(peer_id)
+        if bitfield is None or self.file_manager.is_rechecking():
+            # Đang recheck: bitfield sắp được dựng lại, chưa chọn piece mới
+            return None
+
+        for piece_index in self.file_manager.get_stream_window():
+            if self.has_bit(bitfield, piece_index) and not self.file_manager.has_piece(piece_index) \
+                    and self.file_manager.is_wanted(piece_index) and not self.verifier.is_pending(piece_index):
+                block = self.file_manager.request_block(piece_index, peer_id)
+                if block is not None:
+                    return (piece_index, *block)
+
+        for piece_index in self.file_manager.get_partial_pieces():
+            if not self.has_bit(bitfield, piece_index):
+                continue
+            block = self.file_manager.request_block(piece_index, peer_id)
+            if block is not None:
+                return (piece_index, *block)
+
+        piece_index = self.get_rarest_piece(bitfield)
+        if piece_index is None:
+            return None
+        block = self.file_manager.request_block(piece_index, peer_id)
+        return None if block is None else (piece_index, *block)
+
+    @staticmethod
+    def has_bit(bitfield, piece_index):
+        byte_index = piece_index >> 3
+        return byte_index < len(bitfield) and bool(bitfield[byte_index] & (0x80 >> (piece_index & 7)))
+
+    def get_rarest_piece(self, bitfield=None):
         """
-        Tìm ra piece hiếm nhất dựa trên tần suất xuất hiện trong các bitfield
+        Tìm ra piece cần tải có mức ưu tiên cao nhất, trong cùng mức ưu tiên thì chọn piece hiếm nhất
+        dựa trên tần suất xuất hiện trong các bitfield. Piece chỉ thuộc các file bị bỏ qua không được chọn.
+        :param bitfield: bitfield of the peer to request from, only its pieces are chosen; None for any peer
         """
         rarest_piece = None
-        min_frequency = float('inf')
+        best = None
 
         for piece_index, frequency in self.piece_frequencies.items():
-            if frequency < min_frequency and not self.file_manager.has_piece(piece_index):
-                min_frequency = frequency
+            if bitfield is not None and not self.has_bit(bitfield, piece_index):
+                continue
+            if self.file_manager.has_piece(piece_index) or not self.file_manager.is_wanted(piece_index) \
+                    or self.verifier.is_pending(piece_index) or self.file_manager.has_partial_piece(piece_index):
+                continue
+            key = (-self.file_manager.get_piece_priority(piece_index), frequency)
+            if best is None or key < best:
+                best = key
                 rarest_piece = piece_index
 
         return rarest_piece
 
+    def get_message_statistics(self):
+        """Tổng số message đã gửi và số lần gửi xuống socket (sau khi gom) của mọi kết nối."""
+        with self.lock:
+            handlers = list(self.peer_handlers.values())
+        messages_sent = 0
+        sends = 0
+        for handler in handlers:
+            statistics = handler.get_statistics()
+            messages_sent += statistics['messages_sent']
+            sends += statistics['sends']
+        return {'messages_sent': messages_sent, 'sends': sends}
+
     def get_transfer_information(self):
-        progress = len(self.file_manager)/ self.file_manager.get_total_pieces() * 100
-        return {"progress": progress, "peers": len(self.peer_handlers), "speed": 0}
\ No newline at end of file
+        # Tiến độ tính trên các piece cần tải, không phải toàn bộ torrent
+        wanted = self.file_manager.get_wanted_count()
+        progress = (wanted - self.file_manager.wanted_remaining) / wanted * 100 if wanted else 100.0
+        return {"progress": progress, "peers": len(self.peer_handlers), "speed": 0,
+                "read_cache": self.file_manager.get_cache_statistics(),
+                "write_cache": self.file_manager.get_write_cache_statistics(),
+                "verification": self.verifier.get_statistics(),
+                "partial_pieces": len(self.file_manager.partial_pieces),
+                "messages": self.get_message_statistics(),
+                "recheck": self.file_manager.get_recheck_progress()}
\ No newline at end of file
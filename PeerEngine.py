@@ -0,0 +1,318 @@
+import asyncio
+import contextlib
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from LogPipeline import get_logger
+from PeerHandler import PeerHandler, MessageType, READ_PAUSE_TIMEOUT
+
+logger = get_logger('wire')
+
+# Số thread phục vụ REQUEST (đọc đĩa) cho mọi kết nối của engine
+ENGINE_WORKERS = 8
+# Thời gian chờ kết nối tới một peer (giây)
+CONNECT_TIMEOUT = 10.0
+# Số REQUEST của một kết nối được phục vụ đồng thời trên thread pool, các REQUEST khác chờ trong hàng đợi
+# của kết nối: một peer chậm không thể chiếm hết thread pool dùng chung
+MAX_REQUESTS_IN_FLIGHT = 4
+
+
+class PeerEngine:
+    """
+    Chạy mọi kết nối peer của mọi torrent trên một event loop asyncio duy nhất (một thread),
+    thay cho hai thread mỗi kết nối. Việc đọc đĩa khi phục vụ REQUEST chạy trên thread pool
+    của engine, kiểm tra hash vẫn chạy trên PieceVerifier của từng Peer.
+    """
+
+    def __init__(self, workers=ENGINE_WORKERS):
+        self.workers = workers
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='peer-engine')
+            self.thread = threading.Thread(target=self._run, name='peer-engine', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    def call(self, function, *args):
+        """Chạy function trên thread của event loop (ngay nếu đang ở đó)."""
+        if self.in_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def run(self, coroutine, timeout=None):
+        """Chạy coroutine trên event loop và chờ kết quả từ thread khác."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def submit(self, function, *args):
+        return self.executor.submit(function, *args)
+
+    def listen(self, host, port, factory):
+        """
+        Mở cổng lắng nghe, mỗi kết nối đến được gắn với một AsyncPeerHandler do factory() tạo.
+        :return: asyncio server, to be passed to close_server
+        """
+        return self.run(self.loop.create_server(factory, host, port))
+
+    def close_server(self, server):
+        async def close():
+            server.close()
+            await server.wait_closed()
+        self.run(close(), timeout=5)
+
+    def connect(self, host, port, handler):
+        """Kết nối tới một peer và gắn kết nối với handler (AsyncPeerHandler)."""
+        self.run(asyncio.wait_for(self.loop.create_connection(lambda: handler, host, port), CONNECT_TIMEOUT))
+
+    def get_statistics(self):
+        return {'connections': len(self.connections), 'threads': threading.active_count()}
+
+
+class AsyncPeerHandler(PeerHandler, asyncio.BufferedProtocol):
+    """
+    PeerHandler chạy trên PeerEngine: transport đọc thẳng vào bộ đệm của MessageReader, message được tách
+    ngay trên event loop và xử lý bằng cùng handle_message và cùng Peer.callback như bản dùng thread.
+    REQUEST được phục vụ trên thread pool của engine; gửi từ thread khác được chuyển về event loop.
+    """
+
+    def __init__(self, engine, addr, info_hash, peer_id, callback, memory_budget=None, on_connected=None):
+        """
+        :param addr: address of the remote peer, None for an incoming connection (taken from the socket)
+        :param on_connected: function(handler) called once the connection is established
+        """
+        super().__init__(None, addr, info_hash, peer_id, callback, memory_budget=memory_budget)
+        self.engine = engine
+        self.on_connected = on_connected
+        self.transport = None
+        self.handshake_done = False
+        self.tick_handle = None
+        self.reading_paused = False
+        self.pause_deadline = 0.0
+        # True khi bộ đệm gửi của transport đầy: ngừng đọc và ngừng phục vụ REQUEST của kết nối này
+        self.writing_paused = False
+        # REQUEST chờ phục vụ (payload) và số REQUEST đang được phục vụ trên thread pool, chỉ dùng trên event loop
+        self.request_queue = deque()
+        self.requests_in_flight = 0
+        # Mỗi message được ghi vào transport bằng một lần write duy nhất nên không thể bị xen kẽ,
+        # không cần khoá gửi
+        self.send_lock = contextlib.nullcontext()
+
+    def run(self):
+        raise RuntimeError("AsyncPeerHandler is driven by PeerEngine")
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.addr is None:
+            self.addr = transport.get_extra_info('peername')[:2]
+        self.engine.connections.add(self)
+        if self.on_connected:
+            self.on_connected(self)
+        self.send_handshake()
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.advance(nbytes)
+        if not self.handshake_done:
+            handshake = self.reader.read_handshake()
+            if handshake is None:
+                return
+            if not self.parse_handshake(handshake):
+                self._cleanup()
+                return
+            self.handshake_done = True
+            self.send_bitfield()
+            self.tick_handle = self.engine.loop.call_later(1.0, self._tick)
+
+        # Tách và xử lý mọi message đã nhận đủ, phần còn thiếu được giữ lại cho lần sau
+        try:
+            # Các message trả lời được gom và ghi một lần sau cả lượt
+            with self.batch():
+                for message_type, payload in self.reader.messages():
+                    self.dispatch(message_type, payload)
+                    if not self.running:
+                        break
+        except ValueError as e:
+            logger.warning("Protocol error from %s: %s", self.addr, e)
+            self._cleanup()
+            return
+
+        # Backpressure: tạm ngừng đọc khi bộ nhớ dành cho dữ liệu truyền tải đã dùng hết
+        if self.memory_budget is not None and self.memory_budget.is_exhausted() and self.running:
+            self.memory_budget.record_read_pause()
+            self.reading_paused = True
+            self.pause_deadline = self.engine.loop.time() + READ_PAUSE_TIMEOUT
+            self._update_reading()
+            self.engine.loop.call_later(0.05, self._check_resume)
+
+    def dispatch(self, message_type, payload):
+        if message_type == MessageType.REQUEST:
+            # Đọc đĩa trên thread pool, event loop không bị chặn
+            # (payload trỏ vào bộ đệm nhận sẽ bị ghi đè, nên được sao chép)
+            self.request_queue.append(bytes(payload))
+            self._dispatch_requests()
+        else:
+            self.handle_message(message_type, payload)
+
+    def _dispatch_requests(self):
+        # Thread pool chỉ đọc đĩa, block được trả về event loop để ghi: thread không bao giờ chờ socket
+        while (self.request_queue and self.requests_in_flight < MAX_REQUESTS_IN_FLIGHT
+               and not self.writing_paused and self.running):
+            payload = self.request_queue.popleft()
+            self.requests_in_flight += 1
+            future = self.engine.submit(self.handle_message, MessageType.REQUEST, payload)
+            future.add_done_callback(lambda _: self.engine.call(self._request_done))
+
+    def _request_done(self):
+        self.requests_in_flight -= 1
+        self._dispatch_requests()
+
+    def connection_lost(self, exc):
+        self.engine.connections.discard(self)
+        self.request_queue.clear()
+        self._cleanup()
+        self.reader.close()
+        self.callback(self.client_id, "stop", {"addr": self.addr})
+
+    def pause_writing(self):
+        # Peer không đọc kịp: ngừng đọc để không nhận thêm REQUEST cho tới khi bộ đệm gửi vơi đi
+        self.writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self._update_reading()
+        self._dispatch_requests()
+
+    def _update_reading(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.reading_paused or self.writing_paused:
+            if self.transport.is_reading():
+                self.transport.pause_reading()
+        elif not self.transport.is_reading():
+            self.transport.resume_reading()
+
+    def _check_resume(self):
+        if not self.reading_paused or not self.running:
+            return
+        if self.memory_budget.is_exhausted() and self.engine.loop.time() < self.pause_deadline:
+            self.engine.loop.call_later(0.05, self._check_resume)
+            return
+        self.reading_paused = False
+        self._update_reading()
+
+    def _tick(self):
+        # Thay cho thread request
+        if not self.running:
+            return
+        self.tick()
+        self.tick_handle = self.engine.loop.call_later(1.0, self._tick)
+
+    # Gửi dữ liệu: hàng đợi gửi luôn được lấy ra và ghi trên event loop, nên thứ tự giữa các thread được giữ
+
+    def _send_buffers(self, buffers, flags=0):
+        self.engine.call(self._write, buffers)
+
+    def flush(self):
+        if not self.engine.in_loop():
+            self.engine.call(self.flush)
+            return
+        buffers = self._take_outbound()
+        if buffers:
+            self._write(buffers)
+
+    def send_piece(self, piece):
+        # Header và dữ liệu block được ghi cùng các message nhỏ đang chờ trong một lần ghi
+        try:
+            segments = piece.get('segments')
+            if segments is None:
+                buffers = [piece['block']]
+            else:
+                buffers = [self._read_file(fd, offset, length) for fd, offset, length in segments]
+            length = sum(len(buffer) for buffer in buffers)
+            header = struct.pack('>IBII', 9 + length, MessageType.PIECE.value, piece['index'], piece['begin'])
+            with self.outbound_lock:
+                self.messages_sent += 1
+            self.engine.call(self._write_piece, [header] + buffers)
+        except KeyError as e:
+            logger.error("Missing piece field: %s", e)
+        except Exception as e:
+            logger.warning("Error in send_piece to %s: %s", self.addr, e)
+
+    def _write_piece(self, buffers):
+        queued = self._take_outbound()
+        if not queued:
+            with self.outbound_lock:
+                self.sends += 1
+        self._write(queued + buffers)
+
+    def _write(self, buffers):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.writelines(buffers)
+
+    @staticmethod
+    def _read_file(fd, offset, count):
+        # Đường sendfile của PeerHandler không dùng được ở đây: transport asyncio chỉ ghi bytes, còn
+        # loop.sendfile đọc đĩa trên thread của event loop (một lần đọc đĩa chậm chặn mọi kết nối) và cấm ghi
+        # gì khác vào kết nối cho tới khi xong. Đổi lại là một lần sao chép: đọc (trên thread pool) rồi ghi,
+        # tốn thêm khoảng 0.6 CPU s/GB so với sendfile (benchmarks/bench_upload.py). Block nằm trong cache
+        # đọc (piece hay được xin) vẫn được ghi thẳng từ bộ nhớ.
+        chunks = []
+        while count > 0:
+            chunk = os.pread(fd, count, offset)
+            if not chunk:
+                raise ConnectionError("unexpected end of file")
+            chunks.append(chunk)
+            offset += len(chunk)
+            count -= len(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def _cleanup(self):
+        with self.cleanup_lock:
+            if self.cleanup_done:
+                return
+            self.running = False
+            self.cleanup_done = True
+        self.engine.call(self._close_transport)
+
+    def _close_transport(self):
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+            self.tick_handle = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def close(self):
+        self._cleanup()
+
+
+# Engine mặc định của process, mọi User/Peer dùng chung
+_process_engine = PeerEngine()
+
+
+def get_peer_engine():
+    _process_engine.start()
+    return _process_engine
@@ -1,3 +1,7 @@
+import contextlib
+import logging
+import os
+import select
 import socket
 import struct
 import threading
@@ -5,6 +9,25 @@ import time
 from enum import IntEnum
 from threading import Event
 
+from LogPipeline import get_logger
+from MemoryBudget import SEND
+from MessageReader import MessageReader
+
+logger = get_logger('wire')
+
+# Số piece sai hash tối đa một peer được gửi trước khi bị ngắt kết nối
+MAX_HASH_FAILURES = 3
+# Số REQUEST tối đa đang chờ PIECE trên mỗi kết nối (pipelining)
+MAX_PENDING_REQUESTS = 16
+# REQUEST chưa được trả lời sau từng này giây thì bỏ khỏi hàng đợi (block được request lại từ peer khác)
+PENDING_REQUEST_TIMEOUT = 30.0
+# Hàng đợi gửi được đẩy xuống socket khi đủ từng này byte, kể cả khi đang gom message
+OUTBOUND_FLUSH_SIZE = 64 * 1024
+# Số buffer tối đa của một lần sendmsg (nhiều hơn thì sendmsg lỗi EMSGSIZE)
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and os.sysconf('SC_IOV_MAX') > 0 else 1024
+# Thời gian tối đa tạm dừng đọc socket mỗi message khi hết bộ nhớ cho phép (giây), sau đó vẫn đọc tiếp
+# để các piece đang tải dở có thể hoàn thành và giải phóng bộ đệm
+READ_PAUSE_TIMEOUT = 1.0
 
 class MessageType(IntEnum):
     CHOKE = 0
@@ -19,7 +42,7 @@ class MessageType(IntEnum):
 
 
 class PeerHandler:
-    def __init__(self, conn, addr, info_hash, peer_id, callback):
+    def __init__(self, conn, addr, info_hash, peer_id, callback, memory_budget=None):
         self.conn = conn
         self.addr = addr
         self.info_hash = info_hash
@@ -41,12 +64,29 @@ class PeerHandler:
 
         # Peer state
         self.bitfield = None
+        # Các REQUEST đang chờ PIECE: (index, begin) -> (length, thời điểm gửi)
         self.pending_requests = {}
-        self.max_pending_requests = 5
+        self.max_pending_requests = MAX_PENDING_REQUESTS
+        self.request_lock = threading.Lock()
+        self.hash_failures = 0
+
+        # MemoryBudget dùng chung, None để không giới hạn
+        self.memory_budget = memory_budget
+        # Bộ đệm nhận dùng lại cho mọi lần đọc, tách message không sao chép
+        self.reader = MessageReader(memory_budget=memory_budget)
 
         # Lock for thread safety
         self.cleanup_lock = threading.Lock()
         self.cleanup_done = False
+        # Giữ cho header và dữ liệu của một message không bị xen kẽ khi gửi từ nhiều thread
+        self.send_lock = threading.Lock()
+        # Hàng đợi gửi: các message nhỏ được gom lại và gửi bằng một lần sendmsg (scatter/gather)
+        self.outbound = []
+        self.outbound_bytes = 0
+        self.outbound_lock = threading.Lock()
+        self.batch_depth = 0
+        self.messages_sent = 0
+        self.sends = 0
 
     def run(self):
         if self.two_way_handshake():
@@ -63,47 +103,49 @@ class PeerHandler:
             self.request_thread.join()
         else:
             self._cleanup()
-            self.callback(self.peer_id, "stop", {"addr": self.addr})
+            self.reader.close()
+            self.callback(self.client_id, "stop", {"addr": self.addr})
 
     def listen(self):
         try:
             while self.running:
-                # First read the message length (4 bytes)
-                length_prefix = self.conn.recv(4)
-                if not length_prefix:
-                    break
-
-                # Unpack the length
-                length = struct.unpack(">I", length_prefix)[0]
-
-                # Keep-alive message
-                if length == 0:
-                    continue
+                # Backpressure: tạm ngừng đọc khi bộ nhớ dành cho dữ liệu truyền tải đã dùng hết
+                if self.memory_budget is not None:
+                    self.memory_budget.wait_for_room(READ_PAUSE_TIMEOUT)
 
-                # Read the message type
-                message_type = struct.unpack("B", self.conn.recv(1))[0]
-
-                # Read the payload
-                payload = b""
-                remaining = length - 1
-                while remaining > 0:
-                    chunk = self.conn.recv(min(remaining, 16384))
-                    if not chunk:
-                        break
-                    payload += chunk
-                    remaining -= len(chunk)
-
-                self.handle_message(message_type, payload)
+                # Một lần recv_into có thể chứa nhiều message, xử lý hết các message đã đủ
+                if self.reader.recv_from(self.conn) == 0:
+                    break
+                # Các message trả lời (REQUEST, INTERESTED, ...) được gom và gửi một lần sau cả lượt
+                with self.batch():
+                    for message_type, payload in self.reader.messages():
+                        self.handle_message(message_type, payload)
+                        if not self.running:
+                            break
 
         except Exception as e:
-            print(f"Error in listen loop: {e}")
+            logger.warning("Error in listen loop with %s: %s", self.addr, e)
         finally:
             self._cleanup()
-            self.callback(self.peer_id, "stop", {"addr": self.addr})
+            self.reader.close()
+            self.callback(self.client_id, "stop", {"addr": self.addr})
 
     def request(self):
         while self.running:
             time.sleep(1)
+            self.tick()
+
+    def tick(self):
+        """
+        Gọi mỗi giây: bỏ các REQUEST quá hạn và lấp lại hàng đợi, kể cả các request bị hoãn
+        (hết bộ nhớ cho piece mới).
+        """
+        if not self.running:
+            return
+        self.flush()
+        self.expire_requests()
+        if self.am_interested and not self.peer_choking:
+            self.request_next_piece()
 
     def stop(self):
         """Called by parent to stop the peer handler"""
@@ -114,6 +156,11 @@ class PeerHandler:
         with self.cleanup_lock:
             if not self.cleanup_done:
                 self.running = False
+                try:
+                    # close() không đánh thức thread đang chặn trong recv(), shutdown() thì có
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
                 try:
                     self.conn.close()
                 except Exception:
@@ -124,82 +171,138 @@ class PeerHandler:
         try:
             if message_type == MessageType.CHOKE:
                 self.peer_choking = 1
-                print(f"Peer {self.addr} choked us")
+                logger.debug("Peer %s choked us", self.addr)
+                # Peer bỏ qua các REQUEST đang chờ khi choke, trả chúng về để request lại
+                self.return_requests()
 
             elif message_type == MessageType.UNCHOKE:
                 self.peer_choking = 0
-                print(f"Peer {self.addr} unchoked us")
+                logger.debug("Peer %s unchoked us", self.addr)
 
                 if self.am_interested:
-                    data = self.callback(self.client_id, "request_piece_index")
-                    print(data)
-                    self.send_request(data['index'], data['begin'], data['length'])
+                    self.request_next_piece()
 
             elif message_type == MessageType.INTERESTED:
                 self.peer_interested = 1
-                print(f"Peer {self.addr} is interested")
+                logger.debug("Peer %s is interested", self.addr)
                 self.send_unchoke()
 
             elif message_type == MessageType.NOT_INTERESTED:
                 self.peer_interested = 0
-                print(f"Peer {self.addr} is not interested")
+                logger.debug("Peer %s is not interested", self.addr)
 
             elif message_type == MessageType.HAVE:
                 piece_index = struct.unpack(">I", payload)[0]
-                print(f"Peer {self.addr} has piece {piece_index}")
+                logger.debug("Peer %s has piece %d", self.addr, piece_index)
                 if self.bitfield:
                     self.bitfield[piece_index] = 1
 
             elif message_type == MessageType.BITFIELD:
                 bitfield = bytearray(payload)
-                print(f"Received bitfield from {self.addr}, bitfield: {bitfield}")
+                logger.debug("Received bitfield from %s, bitfield: %r", self.addr, bitfield)
                 data = self.callback(self.client_id, "bitfield_received", {'bitfield':bitfield})
-                print(data)
+                logger.debug("Bitfield response: %s", data)
                 if data['interested']:
                     self.send_interested()
                 else:
                     self.send_not_interested()
 
             elif message_type == MessageType.REQUEST:
-                print(f"Received request from {self.addr}")
 
                 if self.am_choking:
-                    print(f"Ignoring request from {self.addr}")
+                    logger.debug("Ignoring request from %s", self.addr)
                     return
 
                 index, begin, length = self.validate_request(payload)
-                print(f"Receive from {self.addr}, index: {index}, begin: {begin}, length: {length}")
+                logger.debug("Request from %s, index: %d, begin: %d, length: %d", self.addr, index, begin, length)
 
-                piece = self.callback(self.client_id, "request_piece", {'index':index, 'begin':begin, 'length':length})
-                self.send_piece({'index' : index, 'begin': begin, 'block': piece.get_data()})
+                piece = self.callback(self.client_id, "request_block", {'index':index, 'begin':begin, 'length':length})
+                if piece is None:
+                    logger.info("Cannot serve request from %s, index: %d", self.addr, index)
+                    return
+                self.send_piece(piece)
 
             elif message_type == MessageType.PIECE:
                 # Handle received piece data
                 if len(payload) < 8:
                     return
-                index = struct.unpack(">I", payload[0:4])[0]
-                begin = struct.unpack(">I", payload[4:8])[0]
+                index, begin = struct.unpack_from(">II", payload)
+                # memoryview trỏ vào bộ đệm nhận: block chỉ được sao chép một lần, vào bộ đệm của piece
                 block = payload[8:]
-                print(f"Received piece {index} at offset {begin}, length {len(block)}")
+                with self.request_lock:
+                    self.pending_requests.pop((index, begin), None)
+                logger.debug("Received piece %d at offset %d, length %d from %s", index, begin, len(block), self.addr)
                 # Call callback to handle the received piece
                 is_complete = self.callback(self.client_id, "piece_received", {'index' : index,'begin': begin,'block': block})
                 if is_complete:
                     self.send_not_interested()
-                else:
-                    data = self.callback(self.client_id, "request_piece_index")
-                    print(data)
-                    self.send_request(data['index'], data['begin'], data['length'])
+                elif len(self.pending_requests) <= self.max_pending_requests // 2:
+                    # Lấp lại hàng đợi khi đã vơi một nửa: các REQUEST đi thành từng nhóm trong một lần gửi
+                    self.request_next_piece()
 
         except Exception as e:
-            print(f"Error handling message type {message_type}: {e}")
+            logger.error("Error handling message type %s: %s", message_type, e)
 
 
+    def request_next_piece(self):
+        """
+        Lấp hàng đợi REQUEST: hỏi Peer các block tiếp theo cần tải và gửi REQUEST cho tới khi có
+        max_pending_requests request đang chờ, dừng sớm nếu không còn block nào.
+        """
+        requests = []
+        with self.request_lock:
+            while self.running and len(self.pending_requests) < self.max_pending_requests:
+                data = self.callback(self.client_id, "request_piece_index")
+                if not data:
+                    break
+                self.pending_requests[(data['index'], data['begin'])] = (data['length'], time.monotonic())
+                requests.append(data)
+        # Gửi ngoài khoá (gửi có thể phải chờ socket), các REQUEST được gom vào một lần gửi
+        with self.batch():
+            for data in requests:
+                self.send_request(data['index'], data['begin'], data['length'])
+
+    def return_requests(self):
+        """Trả các block đã request mà chưa nhận được về cho Peer để chúng được request lại."""
+        with self.request_lock:
+            blocks = list(self.pending_requests)
+            self.pending_requests.clear()
+        if blocks:
+            self.callback(self.client_id, "requests_cancelled", {'blocks': blocks})
+
+    def expire_requests(self):
+        now = time.monotonic()
+        with self.request_lock:
+            for block, (_, sent) in list(self.pending_requests.items()):
+                if now - sent >= PENDING_REQUEST_TIMEOUT:
+                    del self.pending_requests[block]
+
+    def report_hash_failure(self):
+        """
+        Ghi nhận một piece sai hash nhận từ peer này, ngắt kết nối khi vượt quá MAX_HASH_FAILURES.
+        :return: True if the connection is kept
+        """
+        self.hash_failures += 1
+        if self.hash_failures >= MAX_HASH_FAILURES:
+            logger.warning("Disconnecting %s: %d pieces failed hash check", self.addr, self.hash_failures)
+            self._cleanup()
+            return False
+        return True
+
     def two_way_handshake(self):
 
         # Gửi thông điệp handshake tới peer client
         self.send_handshake()
-        # Nhận response từ peer (handshake message)
-        response = self.conn.recv(1024)  # Receive the handshake message
+        # Nhận đúng 68 byte handshake, phần nhận thừa (thường là bitfield) được giữ lại cho listen
+        try:
+            response = self.reader.read_handshake()
+            while response is None:
+                if self.reader.recv_from(self.conn) == 0:
+                    return False
+                response = self.reader.read_handshake()
+        except OSError as e:
+            logger.warning("Handshake receive failed: %s", e)
+            return False
 
         # Phân tích thông điệp handshake nhận được
         if self.parse_handshake(response):
@@ -213,7 +316,7 @@ class PeerHandler:
         Check the info_hash and return True if valid, False otherwise.
         """
         try:
-            print(f"handshake response: {response}")
+            logger.debug("Handshake response: %r", response)
             # Handshake message format:
             # <pstrlen><pstr><reserved><info_hash><peer_id>
             pstrlen = struct.unpack("B", response[0:1])[0]  # Length of the protocol string
@@ -224,14 +327,13 @@ class PeerHandler:
             self.client_id = received_peer_id
             # Check protocol string and info_hash (compare raw bytes, no decoding)
             if pstr == "BitTorrent protocol" and received_info_hash == self.info_hash:
-                print(f"Handshake received successfully from {self.addr}")
-                print(f"Peer ID: {received_peer_id}")
+                logger.info("Handshake received from %s, peer ID: %r", self.addr, received_peer_id)
                 return True
             else:
-                print("Handshake invalid")
+                logger.warning("Invalid handshake from %s", self.addr)
                 return False
         except Exception as e:
-            print(f"Handshake parsing failed: {e}")
+            logger.warning("Handshake parsing failed: %s", e)
             return False
 
     def send_handshake(self):
@@ -266,25 +368,25 @@ class PeerHandler:
                 self.peer_id
             )
 
-            print(f"handshake message: {handshake_message}")
+            logger.debug("Handshake message: %r", handshake_message)
             # Send the handshake message
-            self.conn.send(handshake_message)
-            print(f"Handshake sent to {self.addr}")
+            self._send_buffers([handshake_message])
+            logger.debug("Handshake sent to %s", self.addr)
         except Exception as e:
-            print(f"Handshake send failed: {e}")
+            logger.warning("Handshake send failed: %s", e)
 
     def send_interested(self):
 
         """Send interested message to peer"""
         self.send_message(MessageType.INTERESTED)
         self.am_interested = 1
-        print(f"Sent interested message to {self.addr}")
+        logger.debug("Sent interested message to %s", self.addr)
 
     def send_not_interested(self):
         """Send not interested message to peer"""
         self.send_message(MessageType.NOT_INTERESTED)
         self.am_interested = 0
-        print(f"Sent not interested message to {self.addr}")
+        logger.debug("Sent not interested message to %s", self.addr)
 
     def listen_for_unchoke(self):
         """
@@ -301,43 +403,89 @@ class PeerHandler:
                 msg_id = struct.unpack("B", message[4:5])[0]
 
                 if msg_id == 1:  # Unchoke
-                    print(f"Nhận thông điệp 'unchoke' từ peer {self.addr}")
+                    logger.debug("Nhận thông điệp 'unchoke' từ peer %s", self.addr)
                     self.peer_choking = 0
                     break
         except Exception as e:
-            print(f"Lắng nghe 'unchoke' thất bại: {e}")
+            logger.warning("Lắng nghe 'unchoke' thất bại: %s", e)
 
     def send_bitfield(self):
         """Send bitfield message to the peer."""
         data = self.callback(self.peer_id, "request_bitfield")
         bitfield = data['bitfield']
-        print(f"My bitfield: {bitfield}")
+        logger.debug("My bitfield: %r", bitfield)
         self.send_message(MessageType.BITFIELD, payload=bitfield)
-        print(f"Sent bitfield message to {self.addr}")
+        logger.debug("Sent bitfield message to %s", self.addr)
 
     def send_message(self, message_type, payload=b''):
-        """Utility method to send a message with proper length prefix"""
+        """
+        Đưa message vào hàng đợi gửi. Hàng đợi được gửi ngay, trừ khi đang trong một lượt gom (batch):
+        khi đó nó được gửi lúc kết thúc lượt gom hoặc khi đã đủ OUTBOUND_FLUSH_SIZE byte.
+        """
         try:
             # Convert message_type to integer
             if not isinstance(message_type, MessageType):
                 raise TypeError(f"Expected MessageType, got {type(message_type)}")
 
-            message_type_int = message_type.value
             message_length = len(payload) + 1  # +1 for message type
-            message = struct.pack('>IB', message_length, message_type_int) + payload
-            if message_type != MessageType.PIECE:
-                print("Packed message:", message)  # Debug packed message
-
-            self.conn.send(message)
+            header = struct.pack('>IB', message_length, message_type.value)
+            if message_type != MessageType.PIECE and logger.isEnabledFor(logging.DEBUG):
+                # Chỉ ghép header + payload khi thực sự ghi log DEBUG
+                logger.debug("Packed message: %r", header + payload)
+
+            with self.outbound_lock:
+                self.outbound.append(header)
+                if payload:
+                    self.outbound.append(payload)
+                self.outbound_bytes += 4 + message_length
+                self.messages_sent += 1
+                flush = self.batch_depth == 0 or self.outbound_bytes >= OUTBOUND_FLUSH_SIZE
+            if flush:
+                self.flush()
         except Exception as e:
-            print(f"Error sending message type {message_type}: {e}")
+            logger.warning("Error sending message type %s to %s: %s", message_type, self.addr, e)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Gom các message được gửi trong khối with (từ mọi thread) thành một lần gửi khi ra khỏi khối."""
+        with self.outbound_lock:
+            self.batch_depth += 1
+        try:
+            yield
+        finally:
+            with self.outbound_lock:
+                self.batch_depth -= 1
+                flush = self.batch_depth == 0 and bool(self.outbound)
+            if flush:
+                self.flush()
+
+    def flush(self):
+        """Gửi toàn bộ hàng đợi gửi bằng một lần sendmsg."""
+        with self.send_lock:
+            buffers = self._take_outbound()
+            if buffers:
+                self._send_buffers(buffers)
+
+    def _take_outbound(self):
+        with self.outbound_lock:
+            buffers = self.outbound
+            if buffers:
+                self.outbound = []
+                self.outbound_bytes = 0
+                self.sends += 1
+            return buffers
+
+    def get_statistics(self):
+        with self.outbound_lock:
+            return {'messages_sent': self.messages_sent, 'sends': self.sends,
+                    'pending_requests': len(self.pending_requests)}
 
     def send_request(self,index, begin, length):
 
         """Send request for a specific block"""
         payload = struct.pack('>III', index, begin, length)
         self.send_message(MessageType.REQUEST, payload)
-        print(f"Requested block - index: {index}, begin: {begin}, length: {length}")
+        logger.debug("Requested block from %s - index: %d, begin: %d, length: %d", self.addr, index, begin, length)
 
     def send_unchoke(self):
         """Send unchoke message to the peer."""
@@ -349,23 +497,84 @@ class PeerHandler:
         return index, begin, length
 
     def send_piece(self, piece):
+        """
+        Gửi PIECE message mà không ghép block vào một bytes mới:
+        header 13 byte và block được gửi bằng sendmsg (scatter/gather) nếu block nằm trong bộ nhớ,
+        hoặc header rồi dữ liệu gửi thẳng từ file bằng os.sendfile (block có thể nằm vắt qua nhiều file).
+        :param piece: {'index', 'begin', 'block'} or {'index', 'begin', 'segments': [(fd, offset, length), ...]}
+        """
         try:
             # Đảm bảo piece chứa các trường cần thiết
             index = piece['index']
             begin = piece['begin']
-            block = piece['block']
-
-            # Đóng gói payload
-            payload = struct.pack('>II', index, begin) + block
-
-            # Gửi message với message_type là 7 (ID cho piece message)
-            self.send_message(MessageType.PIECE, payload)
+            segments = piece.get('segments')
+            if segments is None:
+                block = piece['block']
+                length = len(block)
+            else:
+                length = sum(segment_length for _, _, segment_length in segments)
+
+            # <length prefix><message id = 7><index><begin>
+            header = struct.pack('>IBII', 9 + length, MessageType.PIECE.value, index, begin)
+
+            with self.send_lock:
+                # Các message nhỏ đang chờ trong hàng đợi được gửi trước, cùng lần gửi với header
+                buffers = self._take_outbound()
+                with self.outbound_lock:
+                    self.messages_sent += 1
+                    if not buffers:
+                        self.sends += 1
+                if segments is None:
+                    if self.memory_budget is not None:
+                        self.memory_budget.reserve(SEND, length)
+                    try:
+                        self._send_buffers(buffers + [header, block])
+                    finally:
+                        if self.memory_budget is not None:
+                            self.memory_budget.release(SEND, length)
+                else:
+                    # MSG_MORE: để kernel gộp header với dữ liệu sendfile phía sau vào cùng gói tin
+                    self._send_buffers(buffers + [header], getattr(socket, 'MSG_MORE', 0))
+                    for fd, offset, segment_length in segments:
+                        self._send_file(fd, offset, segment_length)
 
         except KeyError as e:
-            print(f"Missing piece field: {e}")
+            logger.error("Missing piece field: %s", e)
         except Exception as e:
-            print(f"Error in send_piece: {e}")
-
+            logger.warning("Error in send_piece to %s: %s", self.addr, e)
+
+    def _send_buffers(self, buffers, flags=0):
+        """Gửi hết các buffer, dùng sendmsg nếu có để không phải nối chúng lại."""
+        if not hasattr(self.conn, 'sendmsg'):
+            self.conn.sendall(b''.join(buffers))
+            return
+        views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+        while views:
+            # Hàng đợi chỉ bị giới hạn theo số byte, có thể chứa hơn IOV_MAX message nhỏ
+            sent = self.conn.sendmsg(views[:IOV_MAX], [], flags)
+            # Bỏ phần đã gửi, giữ lại phần còn thiếu nếu bị gửi thiếu
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
+
+    def _send_file(self, fd, offset, count):
+        """Gửi count byte của file bắt đầu từ offset thẳng từ kernel bằng os.sendfile."""
+        if not hasattr(os, 'sendfile'):
+            self.conn.sendall(os.pread(fd, count, offset))
+            return
+        out_fd = self.conn.fileno()
+        while count > 0:
+            try:
+                sent = os.sendfile(out_fd, fd, offset, count)
+            except BlockingIOError:
+                select.select([], [out_fd], [])
+                continue
+            if sent == 0:
+                raise ConnectionError("sendfile sent 0 bytes")
+            offset += sent
+            count -= sent
 
     def close(self):
         """Clean shutdown of peer connection"""
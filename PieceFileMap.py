@@ -0,0 +1,63 @@
+from array import array
+from bisect import bisect_right
+
+
+class PieceFileMap:
+    """
+    Ánh xạ piece -> các đoạn byte trong file, tính khi cần thay vì dựng sẵn cho mọi piece.
+    Chỉ lưu mảng offset tích luỹ của các file (array 'q', 8 byte mỗi file); một khoảng byte
+    được tra bằng bisect trên mảng này, nên bộ nhớ chỉ tỉ lệ với số file chứ không với số piece.
+    """
+
+    def __init__(self, lengths, piece_length=None, names=None):
+        """
+        :param lengths: length of every file in torrent order
+        :param piece_length: piece length, needed only for piece/block lookups
+        :param names: optional file names (paths relative to the torrent root), same order as lengths
+        """
+        self.piece_length = piece_length
+        self.names = names
+        self.lengths = array('q', lengths)
+
+        # offsets[i] là vị trí bắt đầu của file i trong dải byte của torrent
+        self.offsets = array('q', bytes(8 * len(self.lengths)))
+        total = 0
+        for file_index, length in enumerate(self.lengths):
+            self.offsets[file_index] = total
+            total += length
+        self.total_length = total
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def segments(self, offset, length):
+        """
+        Yield (file_index, file_offset, segment_length) for the byte range [offset, offset + length).
+        """
+        if length <= 0:
+            return
+        file_index = bisect_right(self.offsets, offset) - 1
+        while length > 0 and file_index < len(self.lengths):
+            file_offset = offset - self.offsets[file_index]
+            segment_length = min(length, self.lengths[file_index] - file_offset)
+            if segment_length > 0:
+                yield file_index, file_offset, segment_length
+                offset += segment_length
+                length -= segment_length
+            file_index += 1
+
+    def get_block_segments(self, index, begin, length):
+        """
+        :return: list of (file_index, file_offset, length) covered by a block of piece index
+        """
+        return list(self.segments(index * self.piece_length + begin, length))
+
+    def get_pieces_of_file(self, file_index):
+        """
+        :return: range of the pieces holding bytes of the file (empty for an empty file)
+        """
+        length = self.lengths[file_index]
+        if length == 0:
+            return range(0)
+        start = self.offsets[file_index]
+        return range(start // self.piece_length, (start + length - 1) // self.piece_length + 1)
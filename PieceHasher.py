@@ -0,0 +1,277 @@
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from LogPipeline import get_logger
+
+logger = get_logger('hash')
+
+# Mỗi lần đọc ít nhất từng này byte, để đĩa được đọc tuần tự theo khối lớn dù piece nhỏ
+MIN_READ_SIZE = 4 * 1024 * 1024
+# Mỗi khối đọc tối đa từng này byte (trừ khi một piece đã lớn hơn), bất kể số core và kích thước piece
+MAX_READ_SIZE = 32 * 1024 * 1024
+
+
+def sha1_digest(data):
+    return hashlib.sha1(data).digest()
+
+
+def get_chunk_pieces(piece_length, workers):
+    """
+    Số piece mỗi khối đọc: đủ cho mọi worker và ít nhất MIN_READ_SIZE byte, nhưng không quá MAX_READ_SIZE byte
+    (piece 16 MiB trên máy nhiều core không được kéo khối lên hàng GiB).
+    """
+    pieces = max(2 * workers, 8, MIN_READ_SIZE // piece_length)
+    return max(1, min(pieces, MAX_READ_SIZE // piece_length))
+
+
+class PieceHasher:
+    """
+    Băm SHA-1 các piece song song khi tạo torrent.
+    Dữ liệu được đọc tuần tự theo từng khối lớn (nhiều piece một lần) rồi các piece trong khối
+    được băm trên thread pool. hashlib nhả GIL khi băm nên thread là đủ để dùng hết các core.
+    Kết quả luôn trả về theo đúng thứ tự piece.
+    """
+
+    def __init__(self, piece_length, workers=None, chunk_pieces=None):
+        self.piece_length = piece_length
+        self.workers = workers or os.cpu_count() or 1
+        # Mỗi lần đọc đủ piece cho mọi worker, để đĩa được đọc tuần tự theo khối lớn
+        self.chunk_pieces = chunk_pieces or get_chunk_pieces(piece_length, self.workers)
+
+    def hash_storage(self, storage, total_length=None, progress=None):
+        """
+        Hash every piece of a PieceStorage.
+        :param progress: optional function(pieces_hashed) called after each chunk
+        :return: list of 20-byte SHA-1 digests in piece order
+        """
+        if total_length is None:
+            total_length = storage.total_length
+
+        if self.workers == 1:
+            return self.hash_storage_serial(storage, total_length, progress)
+
+        chunk_length = self.chunk_pieces * self.piece_length
+        hashes = []
+        in_flight = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for offset in range(0, total_length, chunk_length):
+                # Giữ tối đa hai khối trong bộ nhớ: một khối đang băm, một khối đang đọc.
+                # Khối cũ hơn phải băm xong và được bỏ trước khi đọc khối mới
+                while len(in_flight) > 1:
+                    hashes.extend(future.result() for future in in_flight.popleft())
+                    if progress:
+                        progress(len(hashes))
+
+                chunk = memoryview(storage.read(offset, min(chunk_length, total_length - offset)))
+                in_flight.append([executor.submit(sha1_digest, chunk[start:start + self.piece_length])
+                                  for start in range(0, len(chunk), self.piece_length)])
+                del chunk
+
+            while in_flight:
+                hashes.extend(future.result() for future in in_flight.popleft())
+                if progress:
+                    progress(len(hashes))
+
+        return hashes
+
+    def hash_pieces(self, storage, piece_ids, total_length=None, progress=None):
+        """
+        Hash only the given pieces (e.g. pieces of files that changed since the last share).
+        :param progress: optional function(pieces_hashed) called after every chunk_pieces pieces
+        :return: list of digests in the same order as piece_ids
+        """
+        if total_length is None:
+            total_length = storage.total_length
+        piece_ids = list(piece_ids)
+
+        def hash_piece(piece_id):
+            offset = piece_id * self.piece_length
+            return sha1_digest(storage.read(offset, min(self.piece_length, total_length - offset)))
+
+        hashes = []
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            # Từng nhóm chunk_pieces piece: báo tiến độ đều đặn, và progress có thể dừng giữa chừng
+            # (bằng exception) mà không phải chờ các piece còn lại
+            for start in range(0, len(piece_ids), self.chunk_pieces):
+                group = piece_ids[start:start + self.chunk_pieces]
+                hashes.extend(executor.map(hash_piece, group) if executor else map(hash_piece, group))
+                if progress:
+                    progress(len(hashes))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        return hashes
+
+    def hash_storage_serial(self, storage, total_length=None, progress=None):
+        """Hash pieces one after another on the calling thread."""
+        if total_length is None:
+            total_length = storage.total_length
+
+        hashes = []
+        for offset in range(0, total_length, self.piece_length):
+            hashes.append(sha1_digest(storage.read(offset, min(self.piece_length, total_length - offset))))
+            if progress and len(hashes) % self.chunk_pieces == 0:
+                progress(len(hashes))
+        if progress:
+            progress(len(hashes))
+        return hashes
+
+
+class PieceStream:
+    """
+    Đọc tuần tự một danh sách file như một dải byte liên tục và sinh ra (piece_id, view, hash).
+    Dữ liệu được readinto thẳng vào hai bộ đệm bytearray cấp phát sẵn (một khối đang được băm
+    trên thread pool, một khối đang được đọc), không nối bytes nên không có bản sao thừa.
+    Kích thước từng file và tổng độ dài được tính ngay trong lượt đọc này.
+
+    view chỉ hợp lệ cho tới khi lấy phần tử tiếp theo của khối sau, vì bộ đệm sẽ được dùng lại.
+    """
+
+    def __init__(self, paths, piece_length, workers=None, chunk_pieces=None):
+        self.paths = paths
+        self.piece_length = piece_length
+        self.workers = workers or os.cpu_count() or 1
+        # Hai bộ đệm cấp phát sẵn, mỗi bộ đệm tối đa MAX_READ_SIZE byte
+        self.chunk_pieces = chunk_pieces or get_chunk_pieces(piece_length, self.workers)
+
+        # Được điền trong lúc đọc: list of (path, length) và tổng độ dài
+        self.files = []
+        self.total_length = 0
+
+    def __iter__(self):
+        chunk_length = self.chunk_pieces * self.piece_length
+        buffers = [bytearray(chunk_length), bytearray(chunk_length)]
+        chunks = self._fill_chunks(buffers)
+        pending = deque()
+        piece_id = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for view in chunks:
+                pieces = [view[start:start + self.piece_length] for start in range(0, len(view), self.piece_length)]
+                pending.append((pieces, [executor.submit(sha1_digest, piece) for piece in pieces]))
+
+                # Khối trước đã băm xong thì trả về, trong lúc khối vừa đọc đang được băm
+                if len(pending) > 1:
+                    piece_id = yield from self._yield_chunk(pending.popleft(), piece_id)
+
+            while pending:
+                piece_id = yield from self._yield_chunk(pending.popleft(), piece_id)
+
+    @staticmethod
+    def _yield_chunk(chunk, piece_id):
+        pieces, futures = chunk
+        for piece, future in zip(pieces, futures):
+            yield piece_id, piece, future.result()
+            piece_id += 1
+        return piece_id
+
+    def _fill_chunks(self, buffers):
+        """
+        Đổ dữ liệu của các file vào lần lượt từng bộ đệm, trả về memoryview của phần đã đầy.
+        Một piece có thể nằm vắt qua nhiều file.
+        """
+        buffer_index = 0
+        view = memoryview(buffers[buffer_index])
+        position = 0
+
+        for path in self.paths:
+            length = 0
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    read = f.readinto(view[position:])
+                    if not read:
+                        break
+                    position += read
+                    length += read
+                    if position == len(view):
+                        yield view
+                        buffer_index ^= 1
+                        view = memoryview(buffers[buffer_index])
+                        position = 0
+            self.files.append((path, length))
+            self.total_length += length
+
+        if position:
+            yield view[:position]
+
+
+class PieceVerifier:
+    """
+    Kiểm tra SHA-1 các piece nhận được trên một thread pool riêng, để thread đọc socket
+    không bao giờ phải chờ băm. Kết quả (khớp hay không) được báo lại qua on_verified,
+    gọi trên thread của pool.
+    """
+
+    def __init__(self, expected_hash, on_verified, workers=None):
+        """
+        :param expected_hash: function(piece_id) -> 20-byte SHA-1 digest from the torrent
+        :param on_verified: function(piece, source, ok) called once the piece has been checked,
+                            source is whatever was passed to submit (e.g. the peers that sent the piece)
+        """
+        self.expected_hash = expected_hash
+        self.on_verified = on_verified
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.lock = threading.Lock()
+
+        self.pending = set()  # piece id đang chờ hoặc đang được kiểm tra
+        self.verified = 0
+        self.failed = 0
+
+    def submit(self, piece, source=None):
+        """
+        Đưa piece vào hàng đợi kiểm tra, không chặn.
+        :return: False if the piece is already being verified
+        """
+        with self.lock:
+            if piece.piece_id in self.pending:
+                return False
+            self.pending.add(piece.piece_id)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.executor.submit(self._verify, piece, source)
+        return True
+
+    def is_pending(self, piece_id):
+        return piece_id in self.pending
+
+    def _verify(self, piece, source):
+        ok = sha1_digest(piece.get_data()) == self.expected_hash(piece.piece_id)
+        if ok:
+            # Piece đúng vẫn được tính là đang chờ cho tới khi on_verified ghi nhận xong,
+            # piece sai được bỏ khỏi danh sách trước để có thể request lại ngay
+            self._notify(piece, source, ok)
+        with self.lock:
+            self.pending.discard(piece.piece_id)
+            if ok:
+                self.verified += 1
+            else:
+                self.failed += 1
+        if not ok:
+            self._notify(piece, source, ok)
+
+    def _notify(self, piece, source, ok):
+        try:
+            self.on_verified(piece, source, ok)
+        except Exception as e:
+            logger.error("Error handling verified piece %d: %s", piece.piece_id, e)
+
+    def close(self):
+        """Chờ các piece đang kiểm tra xong (để chúng kịp được ghi) rồi dừng pool."""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def get_statistics(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'verified': self.verified,
+                'failed': self.failed,
+            }
@@ -0,0 +1,162 @@
+import os
+import threading
+
+from PieceFileMap import PieceFileMap
+
+# os.sendfile không có trên Windows
+SENDFILE_SUPPORTED = hasattr(os, 'sendfile')
+
+
+class PieceStorage:
+    """
+    Lưu dữ liệu của torrent trên đĩa thay vì giữ trong RAM.
+    Nội dung torrent được xem như một dải byte liên tục đi qua các file theo đúng thứ tự
+    trong metadata; mỗi lần đọc/ghi chỉ chạm tới đúng đoạn byte cần thiết (pread/pwrite).
+    """
+
+    def __init__(self, files, writable=False, piece_length=None):
+        """
+        :param files: list of (path, length) in torrent order
+        :param writable: open files for writing (download) instead of read-only (share)
+        :param piece_length: piece length of the torrent, for piece lookups on file_map
+        """
+        self.paths = [path for path, _ in files]
+        self.writable = writable
+
+        self.file_map = PieceFileMap([length for _, length in files], piece_length, self.paths)
+        self.lengths = self.file_map.lengths
+        self.offsets = self.file_map.offsets
+        self.total_length = self.file_map.total_length
+
+        self.fds = {}
+        self.lock = threading.Lock()
+
+    def _get_fd(self, file_index, create=True):
+        """
+        :param create: create a missing file (writable storage only); if False, return None for a missing file
+        """
+        fd = self.fds.get(file_index)
+        if fd is None:
+            with self.lock:
+                fd = self.fds.get(file_index)
+                if fd is None:
+                    path = self.paths[file_index]
+                    if self.writable:
+                        if not create and not os.path.exists(path):
+                            return None
+                        dir_path = os.path.dirname(path)
+                        if dir_path and not os.path.exists(dir_path):
+                            os.makedirs(dir_path, exist_ok=True)
+                        flags = os.O_RDWR | os.O_CREAT
+                    else:
+                        flags = os.O_RDONLY
+                    fd = os.open(path, flags | getattr(os, 'O_BINARY', 0))
+                    self.fds[file_index] = fd
+        return fd
+
+    def segments(self, offset, length):
+        """
+        Yield (file_index, file_offset, segment_length) for the byte range [offset, offset + length).
+        """
+        return self.file_map.segments(offset, length)
+
+    def get_file_segments(self, offset, length):
+        """
+        :return: list of (fd, file_offset, segment_length) covering [offset, offset + length), for os.sendfile
+        """
+        return [(self._get_fd(file_index), file_offset, segment_length)
+                for file_index, file_offset, segment_length in self.segments(offset, length)]
+
+    def get_block_file_segments(self, index, begin, length):
+        """
+        :return: list of (fd, file_offset, segment_length) covering a block of piece index
+        """
+        return [(self._get_fd(file_index), file_offset, segment_length)
+                for file_index, file_offset, segment_length in self.file_map.get_block_segments(index, begin, length)]
+
+    def read(self, offset, length):
+        chunks = []
+        for file_index, file_offset, segment_length in self.segments(offset, length):
+            # Đọc không tạo file: file chưa có (ví dụ file bị bỏ qua) được đọc như byte 0
+            fd = self._get_fd(file_index, create=False)
+            chunk = b'' if fd is None else self._pread(fd, segment_length, file_offset)
+            # File ngắn hơn metadata (chưa tải xong, bị cắt): phần thiếu đọc như byte 0
+            # để các piece phía sau vẫn đúng vị trí
+            if len(chunk) < segment_length:
+                chunk += bytes(segment_length - len(chunk))
+            chunks.append(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        position = 0
+        for file_index, file_offset, segment_length in self.segments(offset, len(view)):
+            self._pwrite(self._get_fd(file_index), view[position:position + segment_length], file_offset)
+            position += segment_length
+
+    def preallocate(self, sparse=True, file_indexes=None):
+        """
+        Tạo trước các file với đúng kích thước cuối cùng.
+        sparse=True chỉ đặt kích thước file (không chiếm block trên đĩa),
+        ngược lại dùng posix_fallocate nếu hệ điều hành hỗ trợ.
+        :param file_indexes: files to create, None for all of them
+        """
+        if file_indexes is None:
+            file_indexes = range(len(self.lengths))
+        for file_index in file_indexes:
+            length = self.lengths[file_index]
+            fd = self._get_fd(file_index)
+            if os.fstat(fd).st_size >= length:
+                continue
+            if not sparse and hasattr(os, 'posix_fallocate') and length > 0:
+                os.posix_fallocate(fd, 0, length)
+            else:
+                os.ftruncate(fd, length)
+
+    def flush(self):
+        """Đẩy dữ liệu đã ghi xuống đĩa."""
+        if not self.writable:
+            return
+        with self.lock:
+            fds = list(self.fds.values())
+        for fd in fds:
+            os.fsync(fd)
+
+    def _pread(self, fd, length, offset):
+        if hasattr(os, 'pread'):
+            data = os.pread(fd, length, offset)
+            # pread có thể trả về ít hơn yêu cầu, đọc tiếp cho đủ
+            while len(data) < length:
+                chunk = os.pread(fd, length - len(data), offset + len(data))
+                if not chunk:
+                    break
+                data += chunk
+            return data
+        # Windows không có pread: seek + read dưới lock
+        with self.lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def _pwrite(self, fd, data, offset):
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+            return
+        with self.lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.fds.clear()
@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+
+import bencodepy
+
+RESUME_DIR = 'Resume'
+SHARE_INDEX = 'shares.json'
+
+
+class ResumeData:
+    """
+    Lưu trạng thái của một torrent theo info_hash: bitfield các piece đã có, hash các piece,
+    kích thước và mtime của từng file. Khi khởi động lại, Peer dùng bản ghi này để không phải
+    tải lại hoặc băm lại những gì đã có.
+    """
+
+    def __init__(self, info_hash, resume_dir=RESUME_DIR):
+        self.info_hash = info_hash
+        self.resume_dir = resume_dir
+        self.path = os.path.join(resume_dir, f'{info_hash.hex()}.resume')
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        :return: decoded resume record, or None if there is no usable record
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                return bencodepy.decode(f.read())
+        except (OSError, bencodepy.BencodeDecodeError):
+            return None
+
+    def save(self, record):
+        """Ghi bản ghi ra file tạm rồi đổi tên, tránh để lại file hỏng nếu bị dừng giữa chừng."""
+        if not os.path.exists(self.resume_dir):
+            os.makedirs(self.resume_dir, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with self.lock:
+            with open(tmp_path, 'wb') as f:
+                f.write(bencodepy.encode(record))
+            os.replace(tmp_path, self.path)
+
+    def register_share(self, path):
+        """Ghi nhớ info_hash của đường dẫn đã share để lần share sau tìm lại được bản ghi."""
+        if not os.path.exists(self.resume_dir):
+            os.makedirs(self.resume_dir, exist_ok=True)
+        index = ResumeData._load_share_index(self.resume_dir)
+        index[os.path.abspath(path)] = self.info_hash.hex()
+        index_path = os.path.join(self.resume_dir, SHARE_INDEX)
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(f'{index_path}.tmp', index_path)
+
+    @staticmethod
+    def find_share(path, resume_dir=RESUME_DIR):
+        """
+        :return: ResumeData of a previous share of this path, or None
+        """
+        info_hash = ResumeData._load_share_index(resume_dir).get(os.path.abspath(path))
+        if info_hash is None:
+            return None
+        return ResumeData(bytes.fromhex(info_hash), resume_dir)
+
+    @staticmethod
+    def _load_share_index(resume_dir):
+        try:
+            with open(os.path.join(resume_dir, SHARE_INDEX), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,104 @@
+import io
+import time
+
+from FileManager import PRIORITY_SKIP, PRIORITY_HIGH
+
+
+class StreamReader(io.RawIOBase):
+    """
+    Đọc một file của torrent trong lúc torrent vẫn đang được tải (streaming).
+    Mỗi lần đọc dời cửa sổ tải tuần tự của FileManager tới vị trí đang đọc và chỉ chặn
+    khi piece chứa byte cần đọc chưa có. Có thể bọc trong io.BufferedReader nếu cần.
+    """
+
+    def __init__(self, file_manager, file_index=0, timeout=None):
+        """
+        :param file_manager: FileManager of a torrent being downloaded
+        :param file_index: index of the file in the torrent
+        :param timeout: seconds to wait for a missing piece before raising TimeoutError, None to wait forever
+        """
+        super().__init__()
+        self.file_manager = file_manager
+        self.timeout = timeout
+
+        file_map = file_manager.get_piece_file_map()
+        self.start = file_map.offsets[file_index]
+        self.length = file_map.lengths[file_index]
+        self.position = 0
+
+        # File bị bỏ qua sẽ không bao giờ được tải, reader cần nó nên đưa lên ưu tiên cao. Peer được báo qua
+        # FileManager.on_wanted_added và quan tâm lại các peer, kể cả khi các file khác đã tải xong
+        priorities = file_manager.get_file_priorities()
+        if priorities[file_index] == PRIORITY_SKIP:
+            priorities[file_index] = PRIORITY_HIGH
+            file_manager.set_file_priorities(priorities)
+        if not file_manager.sequential:
+            file_manager.set_sequential(True)
+        file_manager.set_stream_position(self.start // file_manager.piece_length)
+
+        # Thống kê: thời điểm mở, thời gian tới byte đầu tiên, số lần và tổng thời gian phải chờ piece
+        self.opened_at = time.monotonic()
+        self.time_to_first_byte = None
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        if offset < self.length:
+            self.file_manager.set_stream_position((self.start + offset) // self.file_manager.piece_length)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed reader")
+        if self.position >= self.length or len(buffer) == 0:
+            return 0
+
+        piece_length = self.file_manager.piece_length
+        offset = self.start + self.position
+        index = offset // piece_length
+        begin = offset - index * piece_length
+        self.file_manager.set_stream_position(index)
+
+        if not self.file_manager.has_piece(index):
+            self.stalls += 1
+            started = time.monotonic()
+            available = self.file_manager.wait_for_piece(index, self.timeout)
+            self.stall_time += time.monotonic() - started
+            if not available:
+                if self.file_manager.closed:
+                    raise EOFError(f"Torrent closed while waiting for piece {index}")
+                raise TimeoutError(f"Piece {index} not available after {self.timeout} seconds")
+
+        data = self.file_manager.read_cache.get(index)
+        count = min(len(buffer), len(data) - begin, self.length - self.position)
+        buffer[:count] = memoryview(data)[begin:begin + count]
+        self.position += count
+
+        if self.time_to_first_byte is None:
+            self.time_to_first_byte = time.monotonic() - self.opened_at
+        return count
+
+    def get_statistics(self):
+        return {
+            'position': self.position,
+            'length': self.length,
+            'time_to_first_byte': self.time_to_first_byte,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+        }
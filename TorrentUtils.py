@@ -3,6 +3,10 @@ import hashlib
 import base64
 import urllib.parse
 
+from LogPipeline import get_logger
+
+logger = get_logger('torrent')
+
 
 class TorrentUtils:
 
@@ -70,7 +74,7 @@ class TorrentUtils:
         # Encode the 'info' part and generate the SHA-1 hash
         hash_contents = bencodepy.encode(subj)
         info_hash = hashlib.sha1(hash_contents).digest()
-        print(f"info_hash from magnet: {info_hash}")
+        logger.debug("info_hash from magnet: %s", info_hash)
         info_hash_hex = info_hash.hex()
 
         # Get the name of the directory or file
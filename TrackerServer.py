@@ -4,6 +4,12 @@ from urllib.parse import urlparse, parse_qs
 from typing import Dict, List, Optional
 import uuid
 import threading
+
+from LogPipeline import get_logger, setup_logging
+
+logger = get_logger('tracker')
+
+
 class TrackerServer:
     def __init__(self, host: str = 'localhost', port: int = 5050):
         self.host = host
@@ -15,18 +21,18 @@ class TrackerServer:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind(('0.0.0.0', self.port))
             s.listen()
-            print(f"Tracker server listening on {self.host}:{self.port}")
+            logger.info("Tracker server listening on %s:%s", self.host, self.port)
             while True:
                 conn, addr = s.accept()
                 """ with conn: """
-                print(f"Connected by {addr}")
+                logger.debug("Connected by %s", addr)
                 threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
                 
 
     def handle_connection(self, conn, addr):
         with conn:
             data = conn.recv(1024).decode('utf-8')
-            print(f"Data received: {data} from {addr}")
+            logger.debug("Data received: %r from %s", data, addr)
             # Data received
             response = self.handle_request(data)
             conn.sendall(response.encode('utf-8'))
@@ -56,7 +62,7 @@ class TrackerServer:
             event = params.get('event', [None])[0]
             downloaded = params.get('downloaded', [None])[0]
 
-            print(f"Test {info_hash} {peer_id} {ip} {port} {event} {downloaded}")
+            logger.info("Announce %s from %s at %s:%s, event %s, downloaded %s", info_hash, peer_id, ip, port, event, downloaded)
 
             if not all([info_hash, peer_id, ip, port]):
                 return self.create_error_response("Missing required parameters")
@@ -72,7 +78,7 @@ class TrackerServer:
         # Create and return the response
         response = self.create_response(info_hash, request_type)
                 
-        print(response)
+        logger.debug("Response: %s", response)
         return response
 
     def add_peer(self, info_hash: str, peer_id: str, ip: str, port: str, downloaded: str):
@@ -115,5 +121,6 @@ class TrackerServer:
         return json.dumps({'failure reason': reason})
 
 if __name__ == "__main__":
+    setup_logging(filename=None, console=True)
     tracker = TrackerServer()
     tracker.start()
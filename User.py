@@ -5,44 +5,86 @@ from threading import Thread
 
 
 from FileManager import FileManager
+from MemoryBudget import get_memory_budget
+from PeerEngine import get_peer_engine
 from info import *
 from MetaInfo import MetaInfo
+from ResumeData import ResumeData
+from StreamReader import StreamReader
 from TorrentUtils import TorrentUtils
 from Peer import Peer
+from LogPipeline import get_logger
 import socket
 
+logger = get_logger('user')
+
 class Status:
     def __init__(self):
         self.connected = 1
         self.download_speed = 0.0
         self.upload_speed = 0.0
         self.peer_count = 0
+        # Bộ nhớ dành cho dữ liệu truyền tải (MemoryBudget.get_statistics)
+        self.memory = {}
 
 
 class User:
-    def __init__(self, userId, name: str = "Anonymous"):
+    def __init__(self, userId, name: str = "Anonymous", memory_budget=None, threaded=False):
+        """
+        :param memory_budget: MemoryBudget shared by every transfer, None for the process-wide one
+        :param threaded: run each peer connection on its own threads instead of the process-wide PeerEngine
+        """
         self.name = name
         self.peers: dict[str, Peer] = {}
         self.threads: dict[str, Thread] = {}
         self.userId = userId
+        self.memory_budget = memory_budget or get_memory_budget()
+        # Mọi kết nối của mọi torrent chạy trên một event loop dùng chung
+        self.engine = None if threaded else get_peer_engine()
 
-    def download(self, file_path, save_path):
+    def download(self, file_path, save_path, file_priorities=None, sequential=False, recheck=False):
+        """
+        :param file_priorities: priority of each file of a multi-file torrent (list, or dict keyed by
+                                file index or path), FileManager.PRIORITY_SKIP to leave a file out;
+                                None keeps the priorities of the previous run, or downloads everything
+        :param sequential: fetch pieces in order from the start (streaming), see open_stream
+        :param recheck: hash the data already in save_path instead of trusting the resume record,
+                        e.g. to seed a dataset that is already on disk; progress is reported by
+                        get_transfer_information under 'recheck'
+        """
         # if self.isTorrent(file):
         info_torrent = TorrentUtils.get_info_from_file(file_path)
         # else:
         #     info = TorrentUtils.get_info_from_magnet(file)
 
         ip, port = self._get_ip_port()
-        file_manager = FileManager(save_path, info_torrent[b'info'])
+        file_manager = FileManager(save_path, info_torrent[b'info'], memory_budget=self.memory_budget)
 
         with open(file_path, 'rb') as file:
             bencode_info = file.read()
         magnet = TorrentUtils.make_magnet_from_bencode(bencode_info)
         info = TorrentUtils.get_info_from_magnet(magnet)
 
-        peer = Peer(ip, port, info, file_manager)
-        print(f"Peer ID: {peer.peer_id}")
-        thread = Thread(target=peer.download)
+        # Khôi phục các piece đã tải ở lần chạy trước (nếu có)
+        resume_data = ResumeData(info['info_hash'])
+        resume_record = resume_data.load()
+        if file_priorities is None and resume_record is not None:
+            file_priorities = resume_record.get(b'priorities')
+        if file_priorities is not None:
+            file_manager.set_file_priorities(file_priorities)
+        if sequential:
+            file_manager.set_sequential(True)
+        file_manager.resume_data = resume_data
+        file_manager.prepare_download()
+
+        peer = Peer(ip, port, info, file_manager, engine=self.engine)
+        logger.info("Peer ID: %s", peer.peer_id)
+        # Kiểm tra dữ liệu trên đĩa (recheck hoặc file đã đổi từ lần chạy trước) trên thread của torrent,
+        # không chặn GUI
+        if recheck:
+            thread = Thread(target=peer.recheck_and_download)
+        else:
+            thread = Thread(target=peer.resume_and_download, args=(resume_record,))
 
         self.peers.update({peer.peer_id: peer})
         self.threads.update({peer.peer_id: thread})
@@ -51,26 +93,37 @@ class User:
         return peer.peer_id
 
 
-    def share(self, path):
+    def share(self, path, piece_length=None):
+        """
+        :param piece_length: bytes per piece, None to choose it from the total size of the content
+        """
+        file_manager = FileManager(piece_length=piece_length, memory_budget=self.memory_budget)
 
-        file_manager = FileManager()
+        # Dùng lại hash của lần share trước nếu các file không đổi
+        previous_share = ResumeData.find_share(path)
+        resume_record = previous_share.load() if previous_share else None
 
         if os.path.isdir(path):
-            file_manager.split_dir(path)
+            file_manager.split_dir(path, resume_record)
             magnet_link = self._input_directory(path, file_manager)
         elif os.path.isfile(path):
-            file_manager.split_file(path)
+            file_manager.split_file(path, resume_record)
             magnet_link = self._input_file(path, file_manager)
         else:
             raise "Invalid path"
 
-        print(f"Magnet link: {magnet_link}")
+        logger.info("Magnet link: %s", magnet_link)
 
         info = TorrentUtils.get_info_from_magnet(magnet_link)
+
+        resume_data = ResumeData(info['info_hash'])
+        file_manager.resume_data = resume_data
+        file_manager.save_resume()
+        resume_data.register_share(path)
         ip, port = self._get_ip_port()
 
-        peer = Peer(ip, port, info, file_manager)
-        print(f"Peer ID: {peer.peer_id}")
+        peer = Peer(ip, port, info, file_manager, engine=self.engine)
+        logger.info("Peer ID: %s", peer.peer_id)
         thread = Thread(target=peer.upload)
 
         self.peers.update({peer.peer_id: peer})
@@ -88,14 +141,14 @@ class User:
         #     info = TorrentUtils.get_info_from_magnet(file)
 
         ip, port = self._get_ip_port()
-        file_manager = FileManager(info=info_torrent[b'info'])
+        file_manager = FileManager(info=info_torrent[b'info'], memory_budget=self.memory_budget)
 
         with open(file, 'rb') as file:
             bencode_info = file.read()
         magnet = TorrentUtils.make_magnet_from_bencode(bencode_info)
         info = TorrentUtils.get_info_from_magnet(magnet)
 
-        peer = Peer(ip, port, info, file_manager)
+        peer = Peer(ip, port, info, file_manager, engine=self.engine)
         thread = Thread(target=peer.scrape_tracker)
 
 
@@ -128,15 +181,10 @@ class User:
         """
         Cho phép người dùng nhập vào một directory và chuyển nó thành bencode.
         """
-        # Lấy các file trong directory và chuyển thành danh sách File
+        # Danh sách file lấy từ lượt duyệt thư mục của FileManager.split_dir, cùng thứ tự với lúc băm
         directory_name = os.path.basename(os.path.normpath(dir_path))
-        files = []
-        for root, dirs, file_names in os.walk(dir_path):
-            for file_name in file_names:
-                file_path = os.path.join(root, file_name)
-                file_size = os.path.getsize(file_path)
-                file_relative_path = os.path.relpath(file_path, dir_path).split(os.sep)
-                files.append(File(file_size, file_relative_path))
+        files = [File(file_size, file_relative_path.split('/'))
+                 for file_relative_path, file_size in file_manager.files]
 
         # Tạo InfoMultiFile cho directory
         piece_length = file_manager.get_piece_length()
@@ -164,7 +212,8 @@ class User:
         Cho phép người dùng nhập vào một file và chuyển nó thành bencode.
         """
         file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
+        # Kích thước đúng như lúc băm
+        file_size = file_manager.files[0][1]
 
         # Tạo InfoSingleFile cho file
         piece_length = file_manager.get_piece_length()
@@ -209,10 +258,37 @@ class User:
                 if b"announce" in content and b"info" in content and b"pieces" in content:
                     return True
         except Exception as e:
-            print("Error reading file:", e)
+            logger.error("Error reading file: %s", e)
 
         return False
 
+    def open_stream(self, peer_id, file=0, timeout=None):
+        """
+        Mở một file của torrent đang tải để đọc ngay, không cần chờ tải xong.
+        Các piece phía trước vị trí đọc được tải theo thứ tự, read() chỉ chặn khi piece cần đọc chưa có.
+        :param file: index or path (relative to the torrent root) of the file
+        :param timeout: seconds to wait for a missing piece before read() raises TimeoutError
+        :return: StreamReader (a readable, seekable raw file object)
+        """
+        file_manager = self.peers[peer_id].file_manager
+        if isinstance(file, str):
+            file = [path for path, _ in file_manager.files].index(file)
+        return StreamReader(file_manager, file, timeout)
+
+    def recheck(self, peer_id):
+        """
+        Kiểm tra lại (forced recheck) dữ liệu trên đĩa của một torrent, chạy trên thread riêng.
+        Torrent có thể đang tải: việc chọn piece mới tạm dừng trong lúc kiểm tra, piece hỏng sẽ được tải lại.
+        Tiến độ được báo qua get_transfer_information(peer_id)['recheck'].
+        """
+        thread = Thread(target=self.peers[peer_id].file_manager.recheck, daemon=True)
+        thread.start()
+        return thread
+
+    def set_file_priorities(self, peer_id, file_priorities):
+        """Đổi mức ưu tiên các file của một torrent đang tải, áp dụng cho các piece được chọn sau đó."""
+        self.peers[peer_id].file_manager.set_file_priorities(file_priorities)
+
     def ban_peer(self, peer_id, peer_ip):
         pass
 
@@ -227,12 +303,19 @@ class User:
         'connected': Boolean,
         'download_speed': float,
         'upload_speed': float,
-        'peer_count': int
+        'peer_count': int,
+        'memory': {'limit', 'used', 'peak', 'throttled', 'read_pauses', bytes per category}
          }
         """
         status = Status()
+        status.peer_count = sum(len(peer.peer_handlers) for peer in self.peers.values())
+        status.memory = self.memory_budget.get_statistics()
         return status
 
+    def set_memory_limit(self, limit):
+        """Đổi giới hạn bộ nhớ (byte) cho dữ liệu truyền tải của mọi torrent dùng chung bộ đếm."""
+        self.memory_budget.set_limit(limit)
+
     def get_transfer_information(self, peer_id):
         return self.peers[peer_id].get_transfer_information()
 
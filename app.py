@@ -11,12 +11,9 @@ from dataclasses import dataclass
 from enum import Enum
 import json as js
 import time
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='bittorrent_app.log'
-)
+from LogPipeline import setup_logging
+# Set up logging: app và thư viện cùng ghi vào bittorrent_app.log qua một hàng đợi
+setup_logging(filename='bittorrent_app.log')
 
 
 class TransferStatus(Enum):
@@ -558,7 +555,8 @@ class BitTorrentApp:
             "Connection Status",
             "Download Speed",
             "Upload Speed",
-            "Peers"
+            "Peers",
+            "Memory"
         ]
 
         for item in status_items:
@@ -921,6 +919,9 @@ class BitTorrentApp:
             self.status_labels["Peers"].config(
                 text=str(stats.peer_count)
             )
+            self.status_labels["Memory"].config(
+                text=f"{stats.memory['used'] / (1 << 20):.1f} / {stats.memory['limit'] / (1 << 20):.0f} MB"
+            )
 
         except Exception as e:
             logging.error(f"Failed to update status bar: {e}")
@@ -0,0 +1,115 @@
+"""
+Benchmark 1000 kết nối loopback tới một Peer đang share: mô hình hai thread mỗi kết nối (PeerHandler)
+so với một event loop dùng chung (PeerEngine). Phía client là socket thường (không thread), chỉ
+handshake rồi để kết nối nhàn rỗi; chỉ tài nguyên của phía Peer được đo.
+Mỗi mô hình chạy trong một process riêng để số liệu RSS không lẫn vào nhau.
+Đo số thread, RSS tăng thêm, thời gian CPU khi mở kết nối và khi nhàn rỗi.
+
+    python benchmarks/bench_engine.py [connections] [idle_seconds]
+"""
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HANDSHAKE_LENGTH = 68
+
+
+def get_rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def connect_clients(port, count, info_hash):
+    """Mở count kết nối, gửi handshake và chờ handshake trả lời của Peer."""
+    handshake = b'\x13BitTorrent protocol' + b'\x00' * 8 + info_hash
+    clients = []
+    for index in range(count):
+        client = socket.create_connection(('127.0.0.1', port))
+        client.sendall(handshake + f'-BE0001-{index:012d}'.encode())
+        clients.append(client)
+    for client in clients:
+        received = b''
+        while len(received) < HANDSHAKE_LENGTH:
+            chunk = client.recv(4096)
+            if not chunk:
+                raise ConnectionError("peer closed the connection")
+            received += chunk
+    return clients
+
+
+def run_model(model, count, idle_seconds):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    from FileManager import FileManager
+    from Peer import Peer
+    from PeerEngine import get_peer_engine
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'data.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(4 << 20))
+    file_manager = FileManager()
+    file_manager.hash_cache = None
+    file_manager.split_file(path)
+    info = {'info_hash': os.urandom(20), 'length': file_manager.total_length, 'name': 'data.bin', 'trackers': []}
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    engine = get_peer_engine() if model == 'asyncio' else None
+    peer = Peer('127.0.0.1', port, info, file_manager, engine=engine)
+    peer.start_server()
+    time.sleep(0.5)
+
+    threads_before = threading.active_count()
+    rss_before = get_rss()
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    clients = connect_clients(port, count, info['info_hash'])
+    # Chờ Peer ghi nhận đủ các kết nối
+    while len(peer.peer_handlers) < count and time.perf_counter() - started < 60:
+        time.sleep(0.05)
+    connect_time = time.perf_counter() - started
+    connect_cpu = time.process_time() - cpu_before
+
+    cpu_before = time.process_time()
+    time.sleep(idle_seconds)
+    idle_cpu = time.process_time() - cpu_before
+    result = (len(peer.peer_handlers), threading.active_count() - threads_before, get_rss() - rss_before,
+              connect_time, connect_cpu, idle_cpu)
+
+    connected, threads, rss, connect_time, connect_cpu, idle_cpu = result
+    print(f"  {model:<9} connections {connected:5d}  threads {threads:+5d}  RSS {rss / (1 << 20):+8.1f} MB  "
+          f"connect {connect_time:5.2f} s (CPU {connect_cpu:5.2f} s)  "
+          f"idle CPU {idle_cpu / idle_seconds * 100:5.1f} %")
+    sys.stdout.flush()
+    # Không dọn dẹp từng kết nối: process kết thúc ngay
+    os._exit(0)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--model':
+        run_model(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    idle_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{count} loopback connections, {idle_seconds:g} s idle")
+    for model in ('threaded', 'asyncio'):
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--model', model, str(count), str(idle_seconds)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Microbenchmark tách message từ luồng dữ liệu nhận được: cách cũ của PeerHandler.listen
+(recv(4), recv(1), rồi payload += chunk) so với MessageReader (recv_into vào bộ đệm dùng lại,
+payload là memoryview). Luồng gồm các PIECE 16 KiB xen với HAVE/REQUEST nhỏ, được đọc từ một
+socket giả trả về tối đa read_size byte mỗi lần gọi như kernel; chỉ đo chi phí tách message.
+
+    python benchmarks/bench_framing.py [megabytes] [read_size]
+"""
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MessageReader import MessageReader
+
+BLOCK_SIZE = 16384
+
+
+class FakeSocket:
+    """Trả về dữ liệu của một luồng có sẵn, tối đa read_size byte mỗi lần, đếm số lần gọi."""
+
+    def __init__(self, data, read_size):
+        self.data = memoryview(data)
+        self.position = 0
+        self.read_size = read_size
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        size = min(size, self.read_size)
+        chunk = bytes(self.data[self.position:self.position + size])
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        size = min(len(buffer), self.read_size, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def build_stream(megabytes):
+    block = os.urandom(BLOCK_SIZE)
+    messages = []
+    for index in range(megabytes * 1024 * 1024 // BLOCK_SIZE):
+        messages.append(struct.pack('>IBII', 9 + BLOCK_SIZE, 7, index // 32, index % 32 * BLOCK_SIZE) + block)
+        messages.append(struct.pack('>IBI', 5, 4, index))
+        messages.append(struct.pack('>IBIII', 13, 6, index, 0, BLOCK_SIZE))
+    return b''.join(messages), len(messages)
+
+
+def parse_legacy(conn):
+    """Vòng đọc cũ của PeerHandler.listen."""
+    count = 0
+    received = 0
+    while True:
+        length_prefix = conn.recv(4)
+        if not length_prefix:
+            break
+        length = struct.unpack(">I", length_prefix)[0]
+        if length == 0:
+            continue
+        message_type = struct.unpack("B", conn.recv(1))[0]
+        payload = b""
+        remaining = length - 1
+        while remaining > 0:
+            chunk = conn.recv(min(remaining, 16384))
+            if not chunk:
+                break
+            payload += chunk
+            remaining -= len(chunk)
+        count += 1
+        received += len(payload)
+    return count, received
+
+
+def parse_reader(conn):
+    reader = MessageReader()
+    count = 0
+    received = 0
+    while reader.recv_from(conn):
+        for message_type, payload in reader.messages():
+            count += 1
+            received += len(payload)
+    return count, received
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    data, total = build_stream(megabytes)
+    print(f"{len(data) / (1 << 20):.1f} MB stream, {total} messages, up to {read_size} bytes per read")
+
+    results = {}
+    for label, parse in (('recv + concat (old)', parse_legacy), ('MessageReader', parse_reader)):
+        conn = FakeSocket(data, read_size)
+        start = time.perf_counter()
+        count, received = parse(conn)
+        elapsed = time.perf_counter() - start
+        results[label] = (count, received)
+        print(f"  {label:<20} {elapsed:6.3f} s  {len(data) / elapsed / (1 << 20):8.1f} MB/s  "
+              f"{count / elapsed / 1000:7.1f} k msg/s  {conn.calls:7d} reads")
+    assert len(set(results.values())) == 1 and next(iter(results.values()))[0] == total
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+So sánh thời gian băm piece khi share: đường băm tuần tự cũ và pipeline băm song song.
+
+    python benchmarks/bench_piece_hashing.py [size_mb]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PieceHasher import PieceHasher
+from PieceStorage import PieceStorage
+
+PIECE_LENGTH = 524288
+
+
+def make_file(path, size):
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(block[:min(len(block), size - written)])
+            written += len(block)
+
+
+def run(label, hasher, storage):
+    start = time.perf_counter()
+    hashes = hasher(storage)
+    elapsed = time.perf_counter() - start
+    mb = storage.total_length / (1 << 20)
+    print(f"{label:<28} {elapsed:8.3f} s  {mb / elapsed:9.1f} MB/s  ({len(hashes)} pieces)")
+    return hashes
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        make_file(path, size_mb << 20)
+        storage = PieceStorage([(path, os.path.getsize(path))])
+
+        print(f"{size_mb} MB, piece length {PIECE_LENGTH}, {os.cpu_count()} cores")
+        serial = run("serial", PieceHasher(PIECE_LENGTH, workers=1).hash_storage_serial, storage)
+        parallel = run("parallel", PieceHasher(PIECE_LENGTH).hash_storage, storage)
+        assert serial == parallel, "parallel hashes differ from serial hashes"
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
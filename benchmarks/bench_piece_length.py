@@ -0,0 +1,57 @@
+"""
+Ảnh hưởng của kích thước piece lên metadata: so sánh piece cố định 512 KiB với piece tự chọn
+theo tổng dung lượng (FileManager.choose_piece_length). Torrent được tạo giả lập, không cần dữ liệu thật.
+
+    python benchmarks/bench_piece_length.py
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bencodepy
+
+from FileManager import FileManager
+from MetaInfo import MetaInfo
+from info import File, InfoMultiFile
+
+FIXED_PIECE_LENGTH = 524288
+NUM_FILES = 1000
+
+
+def build_torrent(total_length, piece_length):
+    file_length = total_length // NUM_FILES
+    files = [File(file_length, ['data', f'{index:05d}.bin']) for index in range(NUM_FILES)]
+    total_pieces = (file_length * NUM_FILES + piece_length - 1) // piece_length
+    # Hash SHA-1 dạng nhị phân, 20 byte mỗi piece như torrent thật
+    pieces = os.urandom(20) * total_pieces
+    info = InfoMultiFile(piece_length, pieces, 'dataset', files)
+    return MetaInfo(info, 'http://localhost:5050', datetime.now(), 'No comment', 'bench').get_bencode()
+
+
+def measure(total_length, piece_length):
+    encoded = build_torrent(total_length, piece_length)
+    info = bencodepy.decode(encoded)[b'info']
+
+    start = time.perf_counter()
+    file_manager = FileManager(info=info)
+    setup = time.perf_counter() - start
+
+    return file_manager.get_total_pieces(), len(encoded), len(file_manager.get_bitfield()), setup
+
+
+def main():
+    print(f"{'content':>8} {'policy':>8} {'piece':>9} {'pieces':>8} {'torrent':>11} {'bitfield':>9} {'setup':>9}")
+    for size_gb in (1, 10, 100):
+        total_length = size_gb << 30
+        for label, piece_length in (("fixed", FIXED_PIECE_LENGTH),
+                                    ("auto", FileManager.choose_piece_length(total_length))):
+            pieces, torrent_size, bitfield_size, setup = measure(total_length, piece_length)
+            print(f"{size_gb:>6}GB {label:>8} {piece_length >> 10:>7}KB {pieces:>8} "
+                  f"{torrent_size / 1024:>9.1f}KB {bitfield_size:>8}B {setup * 1000:>7.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark cho have-set của FileManager với 100k piece:
+so sánh danh sách Piece quét tuyến tính (cách cũ) với bitfield đánh chỉ số theo piece id.
+
+    python benchmarks/bench_piece_lookup.py [num_pieces]
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileManager import FileManager, Piece
+from Peer import Peer
+
+
+class ListHaveSet:
+    """Cách lưu cũ: list các Piece, mọi thao tác đều quét toàn bộ list."""
+
+    def __init__(self, total_pieces):
+        self.total_pieces = total_pieces
+        self.pieces = []
+
+    def add_piece(self, piece):
+        for has_piece in self.pieces:
+            if has_piece.piece_id == piece.piece_id:
+                return
+        self.pieces.append(piece)
+
+    def has_piece(self, piece_id):
+        for piece in self.pieces:
+            if piece.piece_id == piece_id:
+                return True
+        return False
+
+    def get_bitfield(self):
+        bitfield = [0] * ((self.total_pieces + 7) // 8)
+        for piece in self.pieces:
+            bitfield[piece.piece_id // 8] |= (1 << (7 - piece.piece_id % 8))
+        return bytes(bitfield)
+
+
+def timed(label, func, repeat=1, scale=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat * scale
+    print(f"  {label:<40} {elapsed * 1e6:14.1f} us")
+    return elapsed
+
+
+def main():
+    num_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    owned = random.Random(1).sample(range(num_pieces), num_pieces // 2)
+    peer_bitfield = b'\xff' * ((num_pieces + 7) // 8)
+    frequencies = {index: 1 + index % 7 for index in range(num_pieces)}
+    # Mẫu ngẫu nhiên trên toàn bộ piece id, gồm cả piece đã có và chưa có
+    sample = random.Random(2).sample(range(num_pieces), 200)
+
+    print(f"{num_pieces} pieces, {len(owned)} owned")
+
+    print("list scan (old):")
+    legacy = ListHaveSet(num_pieces)
+    legacy.pieces = [Piece(index, b'', b'') for index in owned]
+    timed("has_piece (per call)", lambda: [legacy.has_piece(index) for index in sample], scale=1 / len(sample))
+    timed("get_bitfield", legacy.get_bitfield, repeat=5)
+    timed("rarest-first scan (extrapolated)", lambda: [legacy.has_piece(index) for index in sample],
+          scale=num_pieces / len(sample))
+
+    print("indexed bitfield (new):")
+    file_manager = FileManager()
+    file_manager.total_pieces = num_pieces
+    file_manager.have = bytearray((num_pieces + 7) // 8)
+    for index in owned:
+        file_manager.have[index >> 3] |= 0x80 >> (index & 7)
+    file_manager.have_count = len(owned)
+    timed("has_piece (per call)", lambda: [file_manager.has_piece(index) for index in sample], scale=1 / len(sample))
+    timed("get_bitfield", file_manager.get_bitfield, repeat=100)
+    timed("is_interested", lambda: file_manager.is_interested(peer_bitfield), repeat=100)
+    peer = SimpleNamespace(piece_frequencies=frequencies, file_manager=file_manager)
+    timed("rarest-first scan", lambda: Peer.get_rarest_piece(peer), repeat=5)
+
+
+if __name__ == '__main__':
+    main()
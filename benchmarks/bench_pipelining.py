@@ -0,0 +1,132 @@
+"""
+Benchmark pipelining REQUEST qua loopback có độ trễ giả lập: leecher kết nối tới seeder qua một proxy
+TCP giữ mỗi đoạn dữ liệu lại RTT/2 theo mỗi chiều. So sánh thông lượng tải với số REQUEST đang chờ
+tối đa mỗi kết nối (1 = gửi-rồi-chờ như trước), cùng số message leecher gửi và số lần ghi xuống socket
+sau khi gom.
+Không cần tracker: seeder và leecher được dựng trực tiếp từ FileManager và Peer.
+
+    python benchmarks/bench_pipelining.py [size_mb] [rtt_ms]
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PeerHandler
+from FileManager import FileManager
+from Peer import Peer
+from PeerEngine import get_peer_engine
+
+DEPTHS = (1, 5, 16)
+
+
+class DelayProxy:
+    """Proxy TCP chuyển tiếp dữ liệu sau delay giây theo mỗi chiều, giữ nguyên thứ tự."""
+
+    def __init__(self, target_port, delay):
+        self.target_port = target_port
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, '127.0.0.1', 0), self.loop).result()
+        self.port = server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        asyncio.ensure_future(self.pipe(reader, upstream_writer))
+        asyncio.ensure_future(self.pipe(upstream_reader, writer))
+
+    async def pipe(self, reader, writer):
+        queue = asyncio.Queue()
+
+        async def forward():
+            while True:
+                due, data = await queue.get()
+                wait = due - self.loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        asyncio.ensure_future(forward())
+        while True:
+            try:
+                data = await reader.read(65536)
+            except ConnectionError:
+                data = b''
+            queue.put_nowait((self.loop.time() + self.delay, data))
+            if not data:
+                return
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rtt = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    engine = get_peer_engine()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_mb << 20))
+
+        print(f"{size_mb} MB over loopback with {rtt * 1000:g} ms RTT")
+        seeder_manager = FileManager()
+        seeder_manager.hash_cache = None
+        seeder_manager.split_file(path)
+        info_hash = os.urandom(20)
+        info = {'info_hash': info_hash, 'length': seeder_manager.total_length, 'name': 'data.bin', 'trackers': []}
+        torrent_info = {b'pieceLength': seeder_manager.piece_length, b'pieces': seeder_manager.get_pieces_code(),
+                        b'name': b'data.bin', b'length': seeder_manager.total_length}
+
+        seeder_port = free_port()
+        Peer('127.0.0.1', seeder_port, info, seeder_manager, engine=engine).start_server()
+        proxy = DelayProxy(seeder_port, rtt / 2)
+
+        results = []
+        for depth in DEPTHS:
+            PeerHandler.MAX_PENDING_REQUESTS = depth
+            save_path = os.path.join(tmp, f'out{depth}')
+            leecher_manager = FileManager(save_path, torrent_info)
+            leecher_manager.prepare_download()
+            leecher = Peer('127.0.0.1', free_port(), info, leecher_manager, engine=engine)
+
+            started = time.perf_counter()
+            leecher.connect_async('127.0.0.1', proxy.port)
+            with leecher_manager.piece_condition:
+                leecher_manager.piece_condition.wait_for(leecher_manager.check_complete, timeout=300)
+            elapsed = time.perf_counter() - started
+            complete = leecher_manager.check_complete()
+            messages = leecher.get_message_statistics()
+
+            for handler in list(leecher.peer_handlers.values()):
+                handler.stop()
+            leecher.verifier.close()
+            leecher_manager.close()
+            with open(path, 'rb') as original, open(os.path.join(save_path, 'data.bin'), 'rb') as copy:
+                complete = complete and original.read() == copy.read()
+            results.append((depth, elapsed, complete, messages))
+
+        for depth, elapsed, complete, messages in results:
+            print(f"  {depth:2d} outstanding  {elapsed:6.2f} s  {size_mb / elapsed:6.2f} MB/s  "
+                  f"{messages['messages_sent']:5d} messages in {messages['sends']:5d} sends"
+                  f"{'' if complete else '  (incomplete)'}")
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark việc duyệt thư mục trước khi share một cây có rất nhiều file:
+cách cũ (os.walk + os.path.getsize cho metadata, rồi sorted(Path.rglob) + is_file cho việc băm)
+so với một lượt FileManifest.scan (os.scandir, stat song song).
+
+    python benchmarks/bench_scan.py [num_files] [files_per_dir]
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileManifest import FileManifest
+
+
+def make_tree(root, num_files, files_per_dir):
+    for index in range(num_files):
+        directory = os.path.join(root, f'{index // files_per_dir // 100:03d}', f'{index // files_per_dir:05d}')
+        if index % files_per_dir == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f'{index:07d}.bin'), 'wb') as f:
+            f.write(b'x' * (index % 97))
+
+
+def scan_legacy(root):
+    # User._input_directory
+    files = []
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            files.append((os.path.relpath(file_path, root).split(os.sep), os.path.getsize(file_path)))
+    # FileManager.split_dir
+    paths = [str(file_path) for file_path in sorted(Path(root).rglob('*')) if file_path.is_file()]
+    return files, paths
+
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    files_per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, num_files, files_per_dir)
+        print(f"{num_files} files, {files_per_dir} per directory")
+
+        legacy_time, (files, paths) = measure(lambda: scan_legacy(root))
+        print(f"  os.walk + rglob (old)  {legacy_time:7.2f} s")
+        for workers in (1, 4, 16):
+            scan_time, manifest = measure(lambda: FileManifest.scan(root, workers))
+            print(f"  scandir, {workers:2d} workers   {scan_time:7.2f} s")
+
+        assert manifest.get_paths() == paths
+        ordered = [entry.relative_path.split('/') for entry in manifest] == [path for path, _ in files]
+        print(f"  os.walk order matches the hashing order: {ordered}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark việc băm một thư mục gồm rất nhiều file nhỏ khi share:
+cách cũ (nối bytes buffer += data qua ranh giới file) so với PieceStream (readinto vào bộ đệm cấp phát sẵn).
+
+    python benchmarks/bench_split_dir.py [num_files] [max_file_size]
+"""
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PieceHasher import PieceStream
+
+PIECE_LENGTH = 524288
+
+
+def make_tree(root, num_files, max_file_size):
+    rng = random.Random(1)
+    payload = os.urandom(max_file_size)
+    for index in range(num_files):
+        directory = os.path.join(root, f'{index // 1000:03d}')
+        if index % 1000 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f'{index:06d}.bin'), 'wb') as f:
+            f.write(payload[:rng.randint(1, max_file_size)])
+
+
+def split_dir_concat(paths):
+    """Cách cũ: buffer += data, mỗi piece bị sao chép nhiều lần."""
+    hashes = []
+    buffer = b''
+    for path in paths:
+        with open(path, 'rb') as f:
+            while data := f.read(PIECE_LENGTH - len(buffer)):
+                buffer += data
+                if len(buffer) == PIECE_LENGTH:
+                    hashes.append(hashlib.sha1(buffer).digest())
+                    buffer = b''
+    if buffer:
+        hashes.append(hashlib.sha1(buffer).digest())
+    return hashes
+
+
+def split_dir_stream(paths):
+    return [hash_value for _, _, hash_value in PieceStream(paths, PIECE_LENGTH)]
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    max_file_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, num_files, max_file_size)
+        paths = [str(path) for path in sorted(Path(root).rglob('*')) if path.is_file()]
+        total = sum(os.path.getsize(path) for path in paths)
+        print(f"{len(paths)} files, {total / (1 << 20):.1f} MB, piece length {PIECE_LENGTH}")
+
+        results = {}
+        for label, split in (("buffer += data (old)", split_dir_concat), ("PieceStream readinto", split_dir_stream)):
+            start = time.perf_counter()
+            results[label] = split(paths)
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<24} {elapsed:8.3f} s  {total / (1 << 20) / elapsed:8.1f} MB/s")
+
+        assert len(set(map(tuple, results.values()))) == 1, "hashes differ"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Loopback benchmark chế độ streaming: một User share file, một User khác tải và đọc file đó qua
+User.open_stream trong lúc đang tải. Reader nhảy tới giữa file (như tua video) rồi đọc tới cuối với
+tốc độ phát cố định. Đo thời gian tới byte đầu tiên và số lần reader phải chờ piece (stall),
+so sánh rarest-first (không có cửa sổ streaming) với cửa sổ tải tuần tự.
+Cần cổng 5050 trống cho tracker.
+
+    python benchmarks/bench_streaming.py [size_mb] [playback_mb_per_s]
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TrackerServer import TrackerServer
+from User import User
+
+READ_SIZE = 64 * 1024
+
+
+def run(label, seeder, path, sequential, playback_rate, out):
+    """
+    :return: reader statistics and number of bytes read
+    :raise TimeoutError: if the transfer stalls before the reader reaches the end of the file
+    """
+    seeder.share(path)
+    # Chờ seeder announce xong, leecher chỉ lấy peer list từ tracker một lần
+    time.sleep(0.5)
+    torrent = os.path.join('Torrents', f'{os.path.basename(path)}.torrent')
+    leecher = User(label)
+    transfer_id = leecher.download(torrent, out)
+    reader = leecher.open_stream(transfer_id, 0, timeout=5)
+    if not sequential:
+        # Chỉ chờ piece, không dời cửa sổ tải: thứ tự tải là rarest-first như trước
+        leecher.peers[transfer_id].file_manager.set_sequential(False)
+
+    reader.seek(reader.length // 2)
+    started = time.monotonic()
+    read = 0
+    try:
+        while True:
+            data = reader.read(READ_SIZE)
+            if not data:
+                break
+            read += len(data)
+            # Giữ tốc độ đọc như một trình phát
+            delay = started + read / playback_rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        leecher.stop(transfer_id)
+    return reader.get_statistics(), read
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    playback_rate = (float(sys.argv[2]) if len(sys.argv) > 2 else 32) * (1 << 20)
+
+    tracker = TrackerServer()
+    # TrackerServer không đặt SO_REUSEADDR, báo lỗi sớm thay vì để các peer chờ mãi
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(('0.0.0.0', tracker.port))
+    except OSError as e:
+        print(f"Tracker port {tracker.port} is not available: {e}")
+        return
+    threading.Thread(target=tracker.start, daemon=True).start()
+    time.sleep(0.3)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        seeder = User('seeder')
+        print(f"{size_mb} MB file, seek to the middle, read at {playback_rate / (1 << 20):.1f} MB/s")
+        for label, sequential in (('rarest', False), ('streaming', True)):
+            # Mỗi lần chạy dùng một file khác để có info_hash và bản ghi resume riêng
+            path = os.path.join(tmp, f'{label}.bin')
+            with open(path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1 << 20))
+            try:
+                statistics, read = run(label, seeder, path, sequential, playback_rate, os.path.join(tmp, f'out_{label}'))
+            except TimeoutError as e:
+                # Các thread của User vẫn chạy, thoát ngay với mã lỗi
+                print(f"  {label:<12} transfer stalled: {e}", file=sys.stderr)
+                os._exit(1)
+            print(f"  {label:<12} TTFB {statistics['time_to_first_byte'] * 1000:8.1f} ms  "
+                  f"stalls {statistics['stalls']:4d}  stalled {statistics['stall_time']:6.2f} s  "
+                  f"read {read / (1 << 20):.1f} MB")
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
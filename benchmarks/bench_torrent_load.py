@@ -0,0 +1,59 @@
+"""
+Benchmark kích thước và thời gian nạp torrent có 200k piece:
+trường 'pieces' dạng hex 40 ký tự mỗi piece (cách cũ) so với digest nhị phân 20 byte.
+Đo thời gian bencode, decode .torrent và dựng FileManager từ info.
+
+    python benchmarks/bench_torrent_load.py [num_pieces]
+"""
+import hashlib
+import os
+import sys
+import time
+
+import bencodepy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FileManager import FileManager
+
+PIECE_LENGTH = 262144
+
+
+def build_torrent(digests, piece_length, hex_pieces):
+    if hex_pieces:
+        pieces = ''.join(digest.hex() for digest in digests).encode('ascii')
+    else:
+        pieces = b''.join(digests)
+    files = [{'length': len(digests) * piece_length // 4, 'path': [f'part{i}.bin']} for i in range(4)]
+    info = {'pieceLength': piece_length, 'pieces': pieces, 'name': 'dataset',
+            'length': len(digests) * piece_length, 'files': files}
+    return {'info': info, 'announce': 'http://localhost:5050', 'comment': 'No comment', 'author': 'benchmark'}
+
+
+def measure(function, repeat=5):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    num_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    digests = [hashlib.sha1(i.to_bytes(4, 'big')).digest() for i in range(num_pieces)]
+
+    print(f"{num_pieces} pieces")
+    for label, hex_pieces in (('hex (old)', True), ('binary', False)):
+        torrent = build_torrent(digests, PIECE_LENGTH, hex_pieces)
+        encode_time, encoded = measure(lambda: bencodepy.encode(torrent))
+        decode_time, decoded = measure(lambda: bencodepy.decode(encoded))
+        load_time, file_manager = measure(lambda: FileManager('/tmp', decoded[b'info']))
+        assert file_manager.piece_hashes == digests
+        print(f"  {label:<10} {len(encoded) / (1 << 20):6.2f} MB  encode {encode_time * 1000:7.1f} ms  "
+              f"decode {decode_time * 1000:7.1f} ms  FileManager {load_time * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
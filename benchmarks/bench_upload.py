@@ -0,0 +1,135 @@
+"""
+Loopback benchmark đường upload PIECE: CPU (của thread gửi) trên mỗi GB đã gửi.
+So sánh cách cũ (pread + struct.pack + nối bytes hai lần + send) với PeerHandler.send_piece
+dùng sendmsg cho block trong bộ nhớ và os.sendfile cho block đọc thẳng từ file, và với
+AsyncPeerHandler.send_piece trên PeerEngine (pread rồi ghi qua transport, không có sendfile).
+Với engine, CPU là tổng của thread gọi send_piece và thread của event loop.
+
+    python benchmarks/bench_upload.py [size_mb] [block_kb]
+"""
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PeerEngine import AsyncPeerHandler, get_peer_engine
+from PeerHandler import PeerHandler, MessageType
+from PieceStorage import PieceStorage
+
+HANDSHAKE_LENGTH = 68
+
+
+def drain(conn, total, done):
+    buffer = bytearray(1 << 20)
+    received = 0
+    while received < total:
+        read = conn.recv_into(buffer)
+        if not read:
+            break
+        received += read
+    done.set()
+
+
+def connect():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return client, conn
+
+
+def send_legacy(handler, storage, offset, index, begin, length):
+    block = storage.read(offset, length)
+    payload = struct.pack('>II', index, begin) + block
+    message = struct.pack('>IB', len(payload) + 1, MessageType.PIECE.value) + payload
+    handler.conn.sendall(message)
+
+
+def send_sendfile(handler, storage, offset, index, begin, length):
+    handler.send_piece({'index': index, 'begin': begin, 'segments': storage.get_file_segments(offset, length)})
+
+
+def send_memoryview(handler, storage, offset, index, begin, length):
+    # Block đã nằm trong cache đọc (nạp sẵn trước khi đo)
+    handler.send_piece({'index': index, 'begin': begin, 'block': storage.cached[offset:offset + length]})
+
+
+def run(label, send, storage, block_length, engine=None):
+    sender, receiver = connect()
+    total = storage.total_length
+    count = total // block_length
+    expected = count * (13 + block_length)
+    if engine is None:
+        handler = PeerHandler(sender, ('127.0.0.1', 0), b'\x00' * 20, '-PY0001-benchmark000', None)
+    else:
+        handler = AsyncPeerHandler(engine, ('127.0.0.1', 0), b'\x00' * 20, '-PY0001-benchmark000',
+                                   lambda *args: None)
+        engine.run(engine.loop.connect_accepted_socket(lambda: handler, sender))
+        # connection_made gửi handshake
+        expected += HANDSHAKE_LENGTH
+    done = threading.Event()
+    threading.Thread(target=drain, args=(receiver, expected, done), daemon=True).start()
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    start_loop_cpu = loop_cpu(engine)
+    for block_index in range(count):
+        offset = block_index * block_length
+        send(handler, storage, offset, block_index, 0, block_length)
+        # Như thread pool của engine: không gửi thêm khi transport đang báo bộ đệm gửi đầy
+        while engine is not None and handler.writing_paused:
+            time.sleep(0.0005)
+    cpu = time.thread_time() - start_cpu
+    done.wait()
+    wall = time.perf_counter() - start_wall
+    cpu += loop_cpu(engine) - start_loop_cpu
+
+    gb = count * block_length / (1 << 30)
+    print(f"  {label:<22} {cpu / gb:8.3f} CPU s/GB  {gb * 1024 / wall:9.1f} MB/s")
+    if engine is not None:
+        handler.close()
+    sender.close()
+    receiver.close()
+
+
+def loop_cpu(engine):
+    """Thời gian CPU của thread event loop, 0 khi không dùng engine."""
+    if engine is None:
+        return 0.0
+
+    async def thread_time():
+        return time.thread_time()
+    return engine.run(thread_time())
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    block_length = (int(sys.argv[2]) if len(sys.argv) > 2 else 16) * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1 << 20))
+        storage = PieceStorage([(path, size_mb << 20)])
+
+        print(f"{size_mb} MB in {block_length // 1024} KiB blocks")
+        run("concat + send (old)", send_legacy, storage, block_length)
+        run("sendfile", send_sendfile, storage, block_length)
+        engine = get_peer_engine()
+        run("engine pread + write", send_sendfile, storage, block_length, engine)
+        storage.cached = memoryview(storage.read(0, storage.total_length))
+        run("sendmsg memoryview", send_memoryview, storage, block_length)
+        run("engine memoryview", send_memoryview, storage, block_length, engine)
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
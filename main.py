@@ -1,7 +1,9 @@
 import User
 import uuid
+from LogPipeline import setup_logging
 
 def main():
+    setup_logging(console=True)
     user = User.User(str(uuid.uuid4()), "Anonymous")
     x = int(input("Enter 1 to share, 2 to download, 3 to get scrape info of the file, 4 to stop peer with peer_id, 5 to stop all: "))
     if x == 1:
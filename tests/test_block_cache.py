@@ -0,0 +1,43 @@
+import unittest
+
+from BlockCache import ReadCache
+
+
+class ReadCacheStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+
+        def loader(piece_id):
+            self.loads.append(piece_id)
+            return bytes(16)
+
+        self.cache = ReadCache(loader, capacity=1024, read_ahead=0)
+
+    def assertCounts(self, hits, misses):
+        statistics = self.cache.get_statistics()
+        self.assertEqual((statistics['hits'], statistics['misses']), (hits, misses))
+
+    def test_each_access_counted_once(self):
+        self.assertIsNone(self.cache.get(3, admit_first_miss=False))
+        self.assertCounts(0, 1)
+        self.assertEqual(self.loads, [])
+
+        # Hỏi lại: piece nóng được nạp vào cache, vẫn chỉ một miss
+        self.assertIsNotNone(self.cache.get(3, admit_first_miss=False))
+        self.assertCounts(0, 2)
+        self.assertEqual(self.loads, [3])
+
+        self.assertIsNotNone(self.cache.get(3, admit_first_miss=False))
+        self.assertIsNotNone(self.cache.peek(3))
+        self.assertCounts(2, 2)
+
+    def test_admitted_miss(self):
+        self.assertIsNotNone(self.cache.get(5))
+        self.assertIsNotNone(self.cache.get(5))
+        self.assertCounts(1, 1)
+        self.assertEqual(self.loads, [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
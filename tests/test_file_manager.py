@@ -0,0 +1,96 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import bencodepy
+
+from FileManager import FileManager
+
+PIECE_LENGTH = 16384
+
+
+def digests(count):
+    return [hashlib.sha1(str(index).encode()).digest() for index in range(count)]
+
+
+class ParsePieceHashesTest(unittest.TestCase):
+
+    def test_binary_digests(self):
+        hashes = digests(5)
+        self.assertEqual(FileManager.parse_piece_hashes(b''.join(hashes), 5 * 1000 - 10, 1000), hashes)
+
+    def test_legacy_hex_is_detected(self):
+        hashes = digests(5)
+        pieces = b''.join(hashes).hex().encode('ascii')
+        self.assertEqual(FileManager.parse_piece_hashes(pieces, 5 * 1000, 1000), hashes)
+        self.assertEqual(FileManager.parse_piece_hashes(pieces.upper(), 5 * 1000, 1000), hashes)
+
+    def test_binary_made_of_hex_characters_is_kept(self):
+        # Độ dài đúng 20 byte mỗi piece: là digest nhị phân dù chỉ chứa ký tự hex
+        pieces = b'0123456789abcdef0123' * 3
+        self.assertEqual(FileManager.parse_piece_hashes(pieces, 3 * 1000, 1000),
+                         [b'0123456789abcdef0123'] * 3)
+
+    def test_double_length_without_hex_is_not_decoded(self):
+        pieces = b'\xff' * 80
+        self.assertEqual(FileManager.parse_piece_hashes(pieces, 2 * 1000, 1000), [b'\xff' * 20] * 4)
+
+
+class ReusableHashesTest(unittest.TestCase):
+    """a.bin: piece 0-2, b.bin: piece 2-4, c.bin: piece 4-5."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, 'share')
+        os.makedirs(self.root)
+        for name, length in (('a.bin', 40000), ('b.bin', 30000), ('c.bin', 20000)):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(os.urandom(length))
+        original = self.share()
+        self.hashes = original.piece_hashes
+        # Bản ghi đi qua bencode như khi đọc lại từ HashCache hoặc ResumeData
+        self.record = bencodepy.decode(bencodepy.encode(original.get_resume_record()))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def share(self):
+        file_manager = FileManager(piece_length=PIECE_LENGTH)
+        file_manager.hash_cache = None
+        file_manager.split_dir(self.root)
+        self.addCleanup(file_manager.close)
+        return file_manager
+
+    def touch(self, name):
+        path = os.path.join(self.root, name)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_unchanged_files_reuse_every_hash(self):
+        self.assertEqual(len(self.hashes), 6)
+        self.assertEqual(self.share().get_reusable_hashes(self.record), self.hashes)
+
+    def test_changed_file_invalidates_only_its_pieces(self):
+        self.touch('b.bin')
+        hashes = self.share().get_reusable_hashes(self.record)
+        self.assertEqual([piece_id for piece_id, value in enumerate(hashes) if value is None], [2, 3, 4])
+        self.assertEqual([hashes[0], hashes[1], hashes[5]], [self.hashes[0], self.hashes[1], self.hashes[5]])
+
+    def test_grown_last_file(self):
+        with open(os.path.join(self.root, 'c.bin'), 'ab') as f:
+            f.write(os.urandom(20000))
+        hashes = self.share().get_reusable_hashes(self.record)
+        self.assertEqual(hashes[:4], self.hashes[:4])
+        self.assertEqual(hashes[4:], [None] * 3)
+
+    def test_other_piece_length_reuses_nothing(self):
+        self.record[b'pieceLength'] = 2 * PIECE_LENGTH
+        self.assertEqual(self.share().get_reusable_hashes(self.record), [None] * 6)
+
+    def test_no_record(self):
+        self.assertEqual(self.share().get_reusable_hashes(None), [None] * 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
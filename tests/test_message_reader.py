@@ -0,0 +1,126 @@
+import struct
+import unittest
+
+from MemoryBudget import MemoryBudget
+from MessageReader import MessageReader, MAX_MESSAGE_LENGTH, HANDSHAKE_LENGTH
+
+
+def message(message_type, payload=b''):
+    return struct.pack('>IB', len(payload) + 1, message_type) + payload
+
+
+class FakeSocket:
+    """Trả về dữ liệu có sẵn, tối đa read_size byte mỗi lần recv_into."""
+
+    def __init__(self, data, read_size):
+        self.data = data
+        self.position = 0
+        self.read_size = read_size
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.read_size, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def read_all(reader, conn):
+    messages = []
+    while reader.recv_from(conn):
+        for message_type, payload in reader.messages():
+            messages.append((message_type, bytes(payload)))
+    return messages
+
+
+class MessageReaderTest(unittest.TestCase):
+
+    def test_several_messages_in_one_read(self):
+        data = message(2) + message(4, struct.pack('>I', 7)) + message(6, struct.pack('>III', 1, 0, 16384))
+        reader = MessageReader()
+        reader.get_buffer()[:len(data)] = data
+        reader.advance(len(data))
+        self.assertEqual([(t, bytes(p)) for t, p in reader.messages()],
+                         [(2, b''), (4, struct.pack('>I', 7)), (6, struct.pack('>III', 1, 0, 16384))])
+        self.assertEqual(reader.start, reader.end)
+
+    def test_short_reads(self):
+        payloads = [bytes([index]) * (index * 37) for index in range(1, 20)]
+        data = b''.join(message(7, payload) for payload in payloads)
+        for read_size in (1, 3, 5, 64):
+            with self.subTest(read_size=read_size):
+                messages = read_all(MessageReader(size=256), FakeSocket(data, read_size))
+                self.assertEqual(messages, [(7, payload) for payload in payloads])
+
+    def test_keep_alive_is_skipped(self):
+        data = b'\x00\x00\x00\x00' + message(1) + b'\x00\x00\x00\x00'
+        self.assertEqual(read_all(MessageReader(), FakeSocket(data, 1)), [(1, b'')])
+
+    def test_partial_message_waits_for_the_rest(self):
+        data = message(5, b'\xff' * 10)
+        reader = MessageReader()
+        reader.get_buffer()[:6] = data[:6]
+        reader.advance(6)
+        self.assertEqual(list(reader.messages()), [])
+        self.assertEqual(reader.needed, len(data))
+        reader.get_buffer()[:len(data) - 6] = data[6:]
+        reader.advance(len(data) - 6)
+        self.assertEqual([(t, bytes(p)) for t, p in reader.messages()], [(5, b'\xff' * 10)])
+
+    def test_buffer_grows_for_a_large_message_and_shrinks_back(self):
+        payload = bytes(range(256)) * 64  # 16 KiB, bốn lần bộ đệm
+        reader = MessageReader(size=4096)
+        messages = read_all(reader, FakeSocket(message(7, payload) + message(0), 1000))
+        self.assertEqual(messages, [(7, payload), (0, b'')])
+        self.assertEqual(len(reader.buffer), 4096)
+
+    def test_unprocessed_bytes_are_compacted(self):
+        reader = MessageReader(size=64)
+        first = message(7, b'a' * 40)
+        second = message(7, b'b' * 40)
+        data = first + second[:10]
+        reader.get_buffer()[:len(data)] = data
+        reader.advance(len(data))
+        self.assertEqual([bytes(p) for _, p in reader.messages()], [b'a' * 40])
+
+        # Phần còn thiếu của message thứ hai vừa với bộ đệm cũ sau khi dồn về đầu
+        buffer = reader.buffer
+        free = reader.get_buffer()
+        self.assertIs(reader.buffer, buffer)
+        self.assertEqual(reader.start, 0)
+        free[:len(second) - 10] = second[10:]
+        reader.advance(len(second) - 10)
+        self.assertEqual([bytes(p) for _, p in reader.messages()], [b'b' * 40])
+
+    def test_oversize_message_is_rejected(self):
+        reader = MessageReader()
+        data = struct.pack('>IB', MAX_MESSAGE_LENGTH + 1, 7)
+        reader.get_buffer()[:len(data)] = data
+        reader.advance(len(data))
+        with self.assertRaises(ValueError):
+            list(reader.messages())
+
+    def test_handshake_then_messages(self):
+        handshake = b'\x13BitTorrent protocol' + b'\x00' * 8 + b'h' * 20 + b'p' * 20
+        data = handshake + message(5, b'\x80')
+        reader = MessageReader()
+        reader.get_buffer()[:30] = data[:30]
+        reader.advance(30)
+        self.assertIsNone(reader.read_handshake())
+        reader.get_buffer()[:len(data) - 30] = data[30:]
+        reader.advance(len(data) - 30)
+        self.assertEqual(reader.read_handshake(), handshake)
+        self.assertEqual(len(handshake), HANDSHAKE_LENGTH)
+        self.assertEqual([(t, bytes(p)) for t, p in reader.messages()], [(5, b'\x80')])
+
+    def test_buffer_is_counted_in_the_memory_budget(self):
+        budget = MemoryBudget()
+        reader = MessageReader(size=4096, memory_budget=budget)
+        self.assertEqual(budget.get_statistics()['receive'], 4096)
+        read_all(reader, FakeSocket(message(7, b'x' * 10000), 4096))
+        self.assertEqual(budget.get_statistics()['receive'], 4096)
+        reader.close()
+        self.assertEqual(budget.get_statistics()['receive'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
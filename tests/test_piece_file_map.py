@@ -0,0 +1,37 @@
+import unittest
+
+from PieceFileMap import PieceFileMap
+
+
+class PieceFileMapTest(unittest.TestCase):
+
+    def test_range_inside_one_file(self):
+        file_map = PieceFileMap([100, 200, 300], piece_length=64)
+        self.assertEqual(list(file_map.segments(120, 50)), [(1, 20, 50)])
+
+    def test_range_across_files(self):
+        file_map = PieceFileMap([100, 200, 300], piece_length=64)
+        self.assertEqual(list(file_map.segments(90, 220)), [(0, 90, 10), (1, 0, 200), (2, 0, 10)])
+
+    def test_zero_length_files_are_skipped(self):
+        file_map = PieceFileMap([0, 100, 0, 0, 50, 0], piece_length=64)
+        self.assertEqual(file_map.offsets.tolist(), [0, 0, 100, 100, 100, 150])
+        self.assertEqual(list(file_map.segments(0, 150)), [(1, 0, 100), (4, 0, 50)])
+        self.assertEqual(list(file_map.segments(100, 10)), [(4, 0, 10)])
+        self.assertEqual(file_map.get_block_segments(1, 30, 40), [(1, 94, 6), (4, 0, 34)])
+
+    def test_empty_and_out_of_range(self):
+        file_map = PieceFileMap([10, 0], piece_length=64)
+        self.assertEqual(list(file_map.segments(0, 0)), [])
+        self.assertEqual(list(file_map.segments(5, 100)), [(0, 5, 5)])
+
+    def test_pieces_of_file(self):
+        file_map = PieceFileMap([100, 0, 28, 64], piece_length=64)
+        self.assertEqual(file_map.get_pieces_of_file(0), range(0, 2))
+        self.assertEqual(file_map.get_pieces_of_file(1), range(0))
+        self.assertEqual(file_map.get_pieces_of_file(2), range(1, 2))
+        self.assertEqual(file_map.get_pieces_of_file(3), range(2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()